@@ -1,5 +1,16 @@
 """
 JSONAPI Spec implementation of API for models.
+
+Every request has its own models.db session, committed when the response is a success and rolled
+back otherwise, then removed when the request ends. Safe requests to the JSONAPI resources are read
+only, see models.db.read_only, and aren't committed. Reads release the session's connection as soon
+as their rows are loaded, see models.db.release, and a request ending with connections still
+checked out by its thread fails with models.db.ConnectionLeakError.
+
+The statements of each request are counted, see models.db.count_queries. Outside of prod the count
+and the time they took are sent in the X-DB-Statements and X-DB-Time (ms) response headers, in prod
+they are logged as metrics by endpoint every QUERY_METRICS_INTERVAL seconds. A request running the
+same statement more than models.db.N_PLUS_ONE_THRESHOLD times is logged as a likely N+1.
 """
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 try:
@@ -8,9 +19,21 @@ except ImportError:
     import sys
     print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
 
+import atexit
+import logging
+import os
+
 import flask
 from werkzeug.contrib.fixers import ProxyFix
 
+from common import background
+from models import authentication_tokens, db, logins
+from ourapi import base
+
+
+# Seconds between logging the query metrics in prod.
+QUERY_METRICS_INTERVAL = float(os.environ.get('QUERY_METRICS_INTERVAL', 60))
+
 
 def _add_response_headers(response):
     """
@@ -41,6 +64,63 @@ def _add_response_headers(response):
     response.headers.extend(response_headers)
     return response
 
+def _count_queries():
+    """ Count the statements of the request. """
+    flask.g.queries = db.start_counting()
+
+def _report_queries(response):
+    """
+    Report the statements of the request, in headers outside of prod and as metrics in prod, and
+    log the statements repeated often enough to be an N+1.
+    :param flask.Response response: Current response to a request.
+    :return flask.Response: The response
+    """
+    counter = flask.g.get('queries')
+    if counter is None:
+        return response
+    repeated = counter.repeated()
+    if repeated:
+        logger = logging.getLogger(__name__)
+        logger.warning('Likely N+1 in %s %s, statements run more than %d times: %s',
+                       flask.request.method, flask.request.path, db.N_PLUS_ONE_THRESHOLD, repeated)
+    if db.ENV == 'prod':
+        db.QUERY_METRICS.record(flask.request.endpoint or 'unknown', counter)
+    else:
+        response.headers['X-DB-Statements'] = str(counter.statements)
+        response.headers['X-DB-Time'] = f'{counter.seconds * 1000:.3f}'
+    return response
+
+def _end_session(response):
+    """
+    Commit the request's session for successful responses, roll it back for errors. Safe requests
+    have nothing to commit, their session is only closed, without flushing and dirty checking.
+    :param flask.Response response: Current response to a request.
+    :return flask.Response: The response
+    """
+    if db.FACTORY.registry.has() and flask.request.method not in base.SAFE_METHODS:
+        if response.status_code < 400:
+            db.commit()
+        else:
+            db.rollback()
+    return response
+
+def _remove_session(exception):  # pylint: disable=unused-argument
+    """
+    Stop counting the request's statements, remove the request's session, rolling back anything not
+    committed, and check that all of the request's connections went back to the pools.
+    :param Exception or None exception: Unhandled exception of the request.
+    :raises db.ConnectionLeakError: Connections checked out during the request weren't returned.
+    """
+    counter = flask.g.pop('queries', None)
+    if counter is not None:
+        db.stop_counting(counter)
+    db.close()
+    leaked = db.checked_out()
+    if leaked:
+        raise db.ConnectionLeakError(
+            f'{leaked} connections still checked out at the end of {flask.request.method} '
+            f'{flask.request.path}.')
+
 def _create_app():
     """
     Flask Application factory.
@@ -52,6 +132,30 @@ def _create_app():
     app.wsgi_app = ProxyFix(app.wsgi_app)
     return app
 
+def _start_flushers(app):
+    """
+    Start the threads that write the buffered token renewals and password rehashes. Runs before the
+    first request, so the threads are started in each worker process after gunicorn forks, and
+    stopped at exit which flushes anything still buffered.
+    :param flask.Flask app: API app, the threads are kept in app.extensions['flushers'].
+    """
+    threads = [authentication_tokens.AuthenticationTokens.start_renewal_flusher(),
+               logins.Logins.start_rehash_flusher()]
+    for thread in threads:
+        atexit.register(thread.stop)
+    app.extensions['flushers'] = threads
+
+def _start_query_metrics(app):
+    """
+    Start the thread logging the query metrics in prod, after gunicorn forks like the flushers.
+    :param flask.Flask app: API app, the thread is kept in app.extensions['query_metrics'].
+    """
+    thread = background.PeriodicThread(db.QUERY_METRICS.log_stats, QUERY_METRICS_INTERVAL,
+                                       name='query-metrics', run_on_stop=True)
+    thread.start()
+    atexit.register(thread.stop)
+    app.extensions['query_metrics'] = thread
+
 def _health_check():
     """ Responds with True if the App is nominally handling requests """
     return flask.make_response("True", {'Content-Type': 'text/plain'})
@@ -62,7 +166,15 @@ def create_api():
     :rtype: flask.Flask
     """
     app = _create_app()
+    app.before_request(_count_queries)
     app.after_request(_add_response_headers)
+    # After request functions run last registered first, so the commit is counted too.
+    app.after_request(_report_queries)
+    app.after_request(_end_session)
+    app.teardown_request(_remove_session)
+    app.before_first_request(lambda: _start_flushers(app))
+    if db.ENV == 'prod':
+        app.before_first_request(lambda: _start_query_metrics(app))
     app.add_url_rule('/health', 'health_check', _health_check)
 
     return app
@@ -0,0 +1,199 @@
+"""
+Benchmarks of the database access patterns of the API's requests: how long reads hold their pool
+connection, and what read only sessions save. They load generated Groups the way the JSONAPI
+resources do, and delete them afterwards.
+
+Example Usage:
+$ ENV=dev python -m api.benchmarks bench-pool --concurrency 8 --requests 400 --rows 100
+$ ENV=dev python -m api.benchmarks bench-read-only --requests 200 --rows 100
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import threading
+import time
+import uuid
+
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+
+from common import log
+from models import db, groups
+
+
+def benchmark_pool(concurrency=8, requests=400, rows=100):
+    """
+    Measure the pool utilization of reads at a fixed concurrency, as the API's GET requests do them:
+    load rows Groups in the thread's session, serialize them, then end the session. Once holding
+    the connection while serializing, once releasing it as soon as the rows are loaded, see
+    db.release. The Groups have a pool-bench.invalid name and are deleted afterwards.
+    :param int concurrency: Threads making requests at the same time.
+    :param int requests: Requests made in each mode.
+    :param int rows: Groups loaded per request.
+    :return dict: concurrency, requests, rows, pool_size and for each of hold and release the
+                  requests_per_sec, peak and mean connections checked out and utilization, mean
+                  connections over pool_size.
+    """
+    group_table = groups.Groups.__table__
+    suffix = f'{uuid.uuid4().hex[:12]}@pool-bench.invalid'
+    now = datetime.datetime.utcnow()
+    pool = db.ENGINE.pool
+    usage = {'out': 0, 'peak': 0, 'area': 0.0, 'at': time.perf_counter()}
+    lock = threading.Lock()
+
+    def _count(change):
+        with lock:
+            at = time.perf_counter()
+            usage['area'] += usage['out'] * (at - usage['at'])
+            usage.update(out=usage['out'] + change, at=at)
+            usage['peak'] = max(usage['peak'], usage['out'])
+
+    def _checkout(*args):  # pylint: disable=unused-argument
+        _count(1)
+
+    def _checkin(*args):  # pylint: disable=unused-argument
+        _count(-1)
+
+    def _request(release):
+        try:
+            models = db.query(groups.Groups).filter(groups.Groups.name.like(f'% {suffix}'))\
+                .order_by(groups.Groups.id).all()
+            if release:
+                db.release()
+            keys = saorm.class_mapper(groups.Groups).columns.keys()
+            json.dumps([{key: getattr(model, key) for key in keys} for model in models],
+                       default=str)
+            db.commit()
+        finally:
+            db.close()
+
+    stats = {'concurrency': concurrency, 'requests': requests, 'rows': rows,
+             'pool_size': pool.size()}
+    sa.event.listen(db.ENGINE, 'checkout', _checkout)
+    sa.event.listen(db.ENGINE, 'checkin', _checkin)
+    try:
+        db.ENGINE.execute(group_table.insert(), [{'name': f'{idx} {suffix}', 'modified_at': now}
+                                                 for idx in range(rows)])
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            for mode in ('hold', 'release'):
+                start = time.perf_counter()
+                usage.update(out=pool.checkedout(), peak=pool.checkedout(), area=0.0, at=start)
+                list(executor.map(_request, [mode == 'release'] * requests))
+                _count(0)
+                elapsed = usage['at'] - start
+                mean = usage['area'] / elapsed
+                stats[mode] = {'requests_per_sec': requests / elapsed, 'peak': usage['peak'],
+                               'mean': mean, 'utilization': mean / pool.size()}
+    finally:
+        sa.event.remove(db.ENGINE, 'checkout', _checkout)
+        sa.event.remove(db.ENGINE, 'checkin', _checkin)
+        db.ENGINE.execute(group_table.delete().where(group_table.c.name.like(f'% {suffix}')))
+    return stats
+
+def benchmark_read_only(requests=200, rows=100):
+    """
+    Time list reads made like the API's GET requests, loading rows Groups, releasing the connection
+    and serializing them, once in a read write session committed at the end of the request and
+    once in a read only session, see db.read_only, that is only closed. The requests are made one
+    after the other, alternating modes, so the CPU time is the request's. The Groups have a
+    pool-bench.invalid name and are deleted afterwards.
+    :param int requests: Requests made in each mode.
+    :param int rows: Groups loaded per request.
+    :return dict: requests, rows and for each of read_write and read_only the cpu_ms and db_ms per
+                  request, the time spent executing statements, and statements per request.
+    """
+    group_table = groups.Groups.__table__
+    suffix = f'{uuid.uuid4().hex[:12]}@pool-bench.invalid'
+    now = datetime.datetime.utcnow()
+    usage = {'statements': 0, 'db': 0.0, 'started': 0.0}
+
+    def _before(*args):  # pylint: disable=unused-argument
+        usage['started'] = time.perf_counter()
+
+    def _after(*args):  # pylint: disable=unused-argument
+        usage['statements'] += 1
+        usage['db'] += time.perf_counter() - usage['started']
+
+    def _request():
+        models = db.query(groups.Groups).filter(groups.Groups.name.like(f'% {suffix}'))\
+            .order_by(groups.Groups.id).all()
+        db.release()
+        keys = saorm.class_mapper(groups.Groups).columns.keys()
+        return json.dumps([{key: getattr(model, key) for key in keys} for model in models],
+                          default=str)
+
+    stats = {'requests': requests, 'rows': rows}
+    try:
+        db.ENGINE.execute(group_table.insert(), [{'name': f'{idx} {suffix}', 'modified_at': now}
+                                                 for idx in range(rows)])
+        sa.event.listen(db.ENGINE, 'before_cursor_execute', _before)
+        sa.event.listen(db.ENGINE, 'after_cursor_execute', _after)
+        totals = {mode: {'cpu': 0.0, 'db': 0.0, 'statements': 0}
+                  for mode in ('read_write', 'read_only')}
+        # The modes take turns, so warming up and drift don't favor either.
+        for _ in range(requests):
+            for mode, total in totals.items():
+                usage.update(statements=0, db=0.0)
+                start = time.process_time()
+                try:
+                    if mode == 'read_only':
+                        with db.read_only():
+                            _request()
+                    else:
+                        _request()
+                        db.commit()
+                finally:
+                    db.close()
+                total['cpu'] += time.process_time() - start
+                total['db'] += usage['db']
+                total['statements'] += usage['statements']
+        for mode, total in totals.items():
+            stats[mode] = {'cpu_ms': total['cpu'] * 1000 / requests,
+                           'db_ms': total['db'] * 1000 / requests,
+                           'statements': total['statements'] / requests}
+    finally:
+        sa.event.remove(db.ENGINE, 'before_cursor_execute', _before)
+        sa.event.remove(db.ENGINE, 'after_cursor_execute', _after)
+        db.ENGINE.execute(group_table.delete().where(group_table.c.name.like(f'% {suffix}')))
+    return stats
+
+def main(argv=None):
+    """
+    Command line entry point for the benchmarks.
+    :param list(str) argv: Arguments, default sys.argv.
+    """
+    log.init_logging()
+
+    parser = argparse.ArgumentParser(prog='python -m api.benchmarks', description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    bench_pool = subparsers.add_parser('bench-pool',
+                                       help='Measure pool utilization of reads holding or '
+                                            'releasing the connection while serializing.')
+    bench_pool.add_argument('--concurrency', type=int, default=8)
+    bench_pool.add_argument('--requests', type=int, default=400)
+    bench_pool.add_argument('--rows', type=int, default=100)
+
+    bench_read_only = subparsers.add_parser('bench-read-only',
+                                            help='Time list reads in read write and read only '
+                                                 'sessions.')
+    bench_read_only.add_argument('--requests', type=int, default=200)
+    bench_read_only.add_argument('--rows', type=int, default=100)
+
+    args = parser.parse_args(argv)
+    if args.command == 'bench-pool':
+        print(benchmark_pool(args.concurrency, args.requests, args.rows))
+    elif args.command == 'bench-read-only':
+        print(benchmark_read_only(args.requests, args.rows))
+
+if __name__ == '__main__':
+    main()
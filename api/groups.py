@@ -0,0 +1,22 @@
+"""
+JSONAPI Schema for Groups.
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import ourmarshmallow
+from ourmarshmallow import fields
+
+from models import groups
+
+
+class GroupsSchema(ourmarshmallow.Schema):
+    """ JSONAPI Schema for Groups. The member count is read only, so it is metadata. """
+    member_count = fields.MetaData(fields.Integer())
+
+    class Meta:  # pylint: disable=missing-docstring,too-few-public-methods
+        model = groups.Groups
@@ -0,0 +1,98 @@
+"""
+Background helpers for running maintenance work inside an API or worker process.
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import logging
+import threading
+
+
+class PeriodicThread(threading.Thread):
+    """ Daemon thread that calls a function every interval seconds until it is stopped. """
+
+    def __init__(self, function, interval, name=None, args=(), kwargs=None, run_on_stop=False):  # pylint: disable=too-many-arguments
+        """
+        :param callable function: Work to run each interval.
+        :param float interval: Seconds to wait between the end of one run and the start of the next.
+        :param str name: Thread name for logging.
+        :param tuple args: Positional arguments for function.
+        :param dict kwargs: Keyword arguments for function.
+        :param bool run_on_stop: Call function one last time when stopped, for flushing buffers.
+        """
+        super().__init__(name=name or getattr(function, '__name__', None), daemon=True)
+        self.function = function
+        self.interval = interval
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.run_on_stop = run_on_stop
+        self._stopped = threading.Event()
+
+    def run(self):
+        """ Call function every interval. Errors are logged so one bad run doesn't end the loop. """
+        while not self._stopped.wait(self.interval):
+            self._call()
+        if self.run_on_stop:
+            self._call()
+
+    def _call(self):
+        """ Run function once, logging any errors. """
+        logger = logging.getLogger(__name__)
+        try:
+            self.function(*self.args, **self.kwargs)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Periodic task %s failed.', self.name)
+
+    def stop(self, timeout=None):
+        """
+        Stop calling function and wait for the current run to finish.
+        :param float timeout: Seconds to wait for the thread to finish.
+        """
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
+class CoalescingBuffer(object):
+    """
+    Thread safe buffer of pending writes keyed by record. Putting a key that is already pending
+    replaces the value, so many updates to the same record between flushes become one write.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, key, value):
+        """
+        Queue value for key, replacing any pending value.
+        :param key: Identifier of the record to write.
+        :param value: Data to write for the record.
+        """
+        with self._lock:
+            self._pending[key] = value
+
+    def drain(self):
+        """
+        Take all of the pending writes, leaving the buffer empty.
+        :return dict: Pending values by key.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, pending):
+        """
+        Put back writes that failed to flush. Values queued since the drain take precedence.
+        :param dict pending: Values by key returned from drain.
+        """
+        with self._lock:
+            for key, value in pending.items():
+                self._pending.setdefault(key, value)
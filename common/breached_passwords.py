@@ -0,0 +1,259 @@
+"""
+Check passwords against a large corpus of breached passwords without loading it into memory.
+
+The corpus is compiled into a file of sorted 64 bit SHA-1 prefixes that is memory mapped read only,
+so every gunicorn worker on a host shares the same page cache instead of its own copy on the heap.
+Lookups use a 16 bit fan-out table to find a small range of the file and binary search inside it.
+The chance of a false positive for a password that isn't in the corpus is about count / 2**64.
+
+File layout (all integers big-endian):
+    8 bytes   MAGIC
+    8 bytes   number of entries
+    65537 x 4 bytes fan-out, index of the first entry for each 16 bit prefix, plus the end
+    n x 8 bytes sorted unique SHA-1 prefixes
+
+Example Usage:
+$ python -m common.breached_passwords build passwords.txt breached.idx
+$ python -m common.breached_passwords build --sha1 pwned-passwords-sha1.txt breached.idx
+$ python -m common.breached_passwords bench breached.idx
+$ BREACHED_PASSWORDS_PATH=breached.idx gunicorn ...
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import argparse
+import array
+import hashlib
+import logging
+import mmap
+import os
+import resource
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from . import log
+
+
+# Compiled index to check passwords against, unset to only use the common passwords list.
+INDEX_PATH = os.environ.get('BREACHED_PASSWORDS_PATH')
+
+MAGIC = b'BPWIDX1\0'
+_HEADER = struct.Struct('>8sQ')
+_FANOUT = struct.Struct('>I')
+_FANOUT_SIZE = 65537
+_ENTRY = struct.Struct('>Q')
+_ENTRIES_OFFSET = _HEADER.size + _FANOUT.size * _FANOUT_SIZE
+
+
+def password_key(password):
+    """
+    :param str password: Password exactly as entered.
+    :return int: First 64 bits of the SHA-1 of the utf8 password.
+    """
+    return _ENTRY.unpack_from(hashlib.sha1(password.encode('utf8')).digest())[0]
+
+def _line_keys(lines, sha1):
+    """
+    Convert corpus lines to keys. Blank lines are skipped.
+    :param iterable(str) lines: Passwords, or SHA-1 hex digests optionally followed by ':count'.
+    :param bool sha1: Lines are hex digests (Have I Been Pwned format) instead of passwords.
+    :yield int: Key for each line.
+    """
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        if sha1:
+            yield int(line.split(':', 1)[0][:16], 16)
+        else:
+            yield password_key(line)
+
+def build(lines, path, sha1=False):
+    """
+    Compile a corpus into an index file. The keys are first split into 256 temporary bucket files
+    by their first byte so only one bucket needs to be sorted in memory at a time.
+    :param iterable(str) lines: Corpus lines, see _line_keys.
+    :param str path: Index file to write. Written to a temporary file first then renamed.
+    :param bool sha1: Lines are hex digests instead of passwords.
+    :return int: Number of unique entries in the index.
+    """
+    logger = logging.getLogger(__name__)
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.TemporaryDirectory(dir=directory) as workdir:
+        buckets = [open(os.path.join(workdir, f'{idx:02x}'), 'wb') for idx in range(256)]
+        pending = [array.array('Q') for _ in range(256)]
+        for key in _line_keys(lines, sha1):
+            bucket = key >> 56
+            pending[bucket].append(key)
+            if len(pending[bucket]) >= 8192:
+                pending[bucket].tofile(buckets[bucket])
+                del pending[bucket][:]
+        for bucket, keys in zip(buckets, pending):
+            keys.tofile(bucket)
+            bucket.close()
+
+        fanout = array.array('I', [0]) * _FANOUT_SIZE
+        count = 0
+        tmp_path = os.path.join(workdir, 'index')
+        with open(tmp_path, 'wb') as out:
+            out.seek(_ENTRIES_OFFSET)
+            for bucket in buckets:
+                keys = array.array('Q')
+                with open(bucket.name, 'rb') as infile:
+                    keys.frombytes(infile.read())
+                os.unlink(bucket.name)
+                keys = array.array('Q', sorted(set(keys)))
+                for key in keys:
+                    fanout[(key >> 48) + 1] += 1
+                count += len(keys)
+                if sys.byteorder == 'little':
+                    keys.byteswap()
+                keys.tofile(out)
+
+            for idx in range(1, _FANOUT_SIZE):
+                fanout[idx] += fanout[idx - 1]
+            if sys.byteorder == 'little':
+                fanout.byteswap()
+            out.seek(0)
+            out.write(_HEADER.pack(MAGIC, count))
+            fanout.tofile(out)
+        os.replace(tmp_path, path)
+
+    logger.info('Compiled %d breached password entries into %s.', count, path)
+    return count
+
+
+class BreachedPasswordIndex(object):
+    """ Read only, memory mapped view of a compiled breached passwords index. """
+
+    def __init__(self, path):
+        """
+        :param str path: Index file written by build.
+        :raises ValueError: File isn't a breached passwords index.
+        """
+        with open(path, 'rb') as infile:
+            self._map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = _HEADER.unpack_from(self._map)
+        if magic != MAGIC or len(self._map) != _ENTRIES_OFFSET + self.count * _ENTRY.size:
+            self._map.close()
+            raise ValueError(f'{path} is not a breached passwords index.')
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, password):
+        """
+        :param str password: Password exactly as entered.
+        :return bool: Password (almost certainly) appears in the corpus.
+        """
+        key = password_key(password)
+        prefix = key >> 48
+        low = _FANOUT.unpack_from(self._map, _HEADER.size + _FANOUT.size * prefix)[0]
+        high = _FANOUT.unpack_from(self._map, _HEADER.size + _FANOUT.size * (prefix + 1))[0]
+        while low < high:
+            mid = (low + high) // 2
+            value = _ENTRY.unpack_from(self._map, _ENTRIES_OFFSET + _ENTRY.size * mid)[0]
+            if value == key:
+                return True
+            if value < key:
+                low = mid + 1
+            else:
+                high = mid
+        return False
+
+    def close(self):
+        """ Unmap the index file. """
+        self._map.close()
+
+
+_INDEX = None
+_INDEX_LOCK = threading.Lock()
+
+def get_index():
+    """
+    Open the index at INDEX_PATH once per process. Opening it before gunicorn forks its workers
+    (preload) is fine, the mapping is read only and shared.
+    :return BreachedPasswordIndex: Index or None when INDEX_PATH isn't set.
+    """
+    global _INDEX  # pylint: disable=global-statement
+    if _INDEX is None and INDEX_PATH:
+        with _INDEX_LOCK:
+            if _INDEX is None:
+                _INDEX = BreachedPasswordIndex(INDEX_PATH)
+    return _INDEX
+
+def is_breached(passwd):
+    """
+    Check passwd against the breached passwords index, if one is configured.
+    :param str passwd: Password to test
+    :return bool: Password appears in the breached corpus
+    """
+    index = get_index()
+    return index is not None and passwd in index
+
+
+def _rss_kb():
+    """
+    :return int: Resident set size of this process in KiB.
+    """
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+
+def benchmark(path, lookups=100000):
+    """
+    Measure the RSS cost of opening an index and the latency of lookups that miss.
+    :param str path: Index file to benchmark.
+    :param int lookups: Number of lookups to time.
+    :return dict: entries, rss_kb_before, rss_kb_after and usec_per_lookup
+    """
+    rss_before = _rss_kb()
+    index = BreachedPasswordIndex(path)
+    passwords = [uuid.uuid4().hex for _ in range(lookups)]
+    start = time.perf_counter()
+    for password in passwords:
+        password in index  # pylint: disable=pointless-statement
+    elapsed = time.perf_counter() - start
+    stats = {'entries': len(index), 'rss_kb_before': rss_before, 'rss_kb_after': _rss_kb(),
+             'usec_per_lookup': elapsed / lookups * 1e6}
+    index.close()
+    return stats
+
+def main(argv=None):
+    """
+    Command line entry point to build and benchmark indexes.
+    :param list(str) argv: Arguments, default sys.argv.
+    """
+    log.init_logging()
+
+    parser = argparse.ArgumentParser(prog='python -m common.breached_passwords',
+                                     description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    build_cmd = subparsers.add_parser('build', help='Compile a corpus into an index file.')
+    build_cmd.add_argument('corpus', help='One password (or SHA-1 hex with --sha1) per line.')
+    build_cmd.add_argument('index', help='Index file to write.')
+    build_cmd.add_argument('--sha1', action='store_true', help='Corpus lines are SHA-1 hex.')
+
+    bench_cmd = subparsers.add_parser('bench', help='Measure lookup latency and RSS.')
+    bench_cmd.add_argument('index')
+    bench_cmd.add_argument('--lookups', type=int, default=100000)
+
+    args = parser.parse_args(argv)
+    if args.command == 'build':
+        with open(args.corpus, encoding='utf8', errors='replace') as corpus:
+            build(corpus, args.index, sha1=args.sha1)
+    elif args.command == 'bench':
+        print(benchmark(args.index, args.lookups))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+"""
+Password hashing service. bcrypt is slow on purpose, so hashing and verification run on a bounded
+process pool instead of in the request thread. Requests wait for a slot in the pool's queue for at
+most max_wait seconds before being turned away so a burst of logins can't starve the worker.
+
+Pick BCRYPT_ROUNDS for the hardware the API runs on with the calibrate command:
+$ python -m common.hashing calibrate --target-ms 250
+
+Time password reuse checks against the history of a Login:
+$ python -m common.hashing bench-history --depth 5 --workers 4
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import argparse
+import concurrent.futures
+import logging
+import os
+import re
+import threading
+import time
+
+import bcrypt
+
+
+# bcrypt cost for new hashes, each extra round doubles the hash time.
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+# Number of hashing processes per API worker, 0 hashes inline in the calling thread.
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', 2))
+# Requests admitted to the pool (running or queued) at once.
+HASH_MAX_PENDING = int(os.environ.get('HASH_MAX_PENDING', 16))
+# Seconds a request waits for admission before HasherBusyError.
+HASH_MAX_WAIT = float(os.environ.get('HASH_MAX_WAIT', 5))
+
+# $2b$12$ then 22 characters of salt and 31 of hash in bcrypt's base64 alphabet, 60 in all.
+_BCRYPT_HASH = re.compile(rb'\$2[aby]\$(0[4-9]|[12][0-9]|3[01])\$[./A-Za-z0-9]{53}')
+
+
+class HasherBusyError(Exception):
+    """ Raised when a request to the hashing pool can't be admitted within max_wait seconds. """
+    pass
+
+
+def is_bcrypt_hash(hashed):
+    """
+    Check that a hash from elsewhere, like a bulk import, is a complete bcrypt hash that
+    bcrypt.checkpw accepts, without spending a bcrypt check on it.
+    :param bytes hashed: Supposed bcrypt hash
+    :return bool: hashed is a well formed bcrypt hash
+    """
+    return _BCRYPT_HASH.fullmatch(hashed) is not None
+
+def hash_rounds(hashed):
+    """
+    Read the cost out of a bcrypt hash.
+    :param bytes hashed: bcrypt hash like b'$2b$12$...'
+    :return int: bcrypt rounds used for the hash
+    """
+    return int(hashed.split(b'$')[2])
+
+def _hashpw(password, rounds):
+    """
+    Hash and salt a password. Runs in the pool processes.
+    :param bytes password: utf8 encoded password
+    :param int rounds: bcrypt cost
+    :return tuple(bytes, float): bcrypt hash, seconds spent hashing
+    """
+    start = time.perf_counter()
+    hashed = bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+    return hashed, time.perf_counter() - start
+
+def _checkpw(password, hashed):
+    """
+    Check a password against a hash. Runs in the pool processes.
+    :param bytes password: utf8 encoded password
+    :param bytes hashed: bcrypt hash
+    :return tuple(bool, float): password matches, seconds spent hashing
+    """
+    start = time.perf_counter()
+    matches = bcrypt.checkpw(password, hashed)
+    return matches, time.perf_counter() - start
+
+
+class PasswordHasher(object):
+    """ Bounded pool for bcrypt work with an admission queue and metrics. """
+
+    def __init__(self, workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING, max_wait=HASH_MAX_WAIT,
+                 rounds=BCRYPT_ROUNDS):
+        """
+        :param int workers: Number of hashing processes, 0 hashes inline in the calling thread.
+        :param int max_pending: Requests admitted to the pool (running or queued) at once.
+        :param float max_wait: Seconds to wait for admission before raising HasherBusyError.
+        :param int rounds: bcrypt cost for new hashes.
+        """
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = 0
+        self._hashes = 0
+        self._hash_seconds = 0.0
+        self._rejected = 0
+
+    def _get_executor(self):
+        """
+        Start the pool on first use, after any fork by gunicorn.
+        :return concurrent.futures.ProcessPoolExecutor: hashing pool
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _drop_executor(self, executor):
+        """
+        Forget a pool that broke, for example when a worker process was killed, so the next request
+        starts a new one. Work still queued on the broken pool fails with BrokenProcessPool.
+        :param concurrent.futures.ProcessPoolExecutor executor: The broken pool
+        """
+        with self._lock:
+            if self._executor is not executor:
+                return  # Already replaced
+            self._executor = None
+        logger = logging.getLogger(__name__)
+        logger.warning('Password hashing pool is broken, starting a new one.')
+        # Not shutdown(), a broken pool has already stopped its processes and on Python 3.7
+        # shutting it down makes the interpreter's exit handler fail on the closed wakeup pipe.
+
+    def _start(self, func, *args):
+        """
+        Run func on the pool, replacing the pool once if it is broken.
+        :param callable func: _hashpw or _checkpw
+        :return tuple(concurrent.futures.Future, ProcessPoolExecutor): Resolves to what func
+                                                                      returns, pool it runs on.
+        """
+        if not self.workers:
+            work = concurrent.futures.Future()
+            try:
+                work.set_result(func(*args))
+            except Exception as exc:  # pylint: disable=broad-except
+                work.set_exception(exc)
+            return work, None
+
+        executor = self._get_executor()
+        try:
+            return executor.submit(func, *args), executor
+        except concurrent.futures.process.BrokenProcessPool:
+            self._drop_executor(executor)
+        executor = self._get_executor()
+        return executor.submit(func, *args), executor
+
+    def _submit(self, func, *args):
+        """
+        Wait for admission and run func on the pool.
+        :param callable func: _hashpw or _checkpw
+        :return concurrent.futures.Future: Resolves to the first value returned by func.
+        :raises HasherBusyError: No slot available within max_wait seconds.
+        """
+        if not self._slots.acquire(timeout=self.max_wait):
+            with self._lock:
+                self._rejected += 1
+            raise HasherBusyError('Password hashing queue is full.')
+
+        with self._lock:
+            self._pending += 1
+
+        result = concurrent.futures.Future()
+
+        def _done(work):
+            """ Release the slot, record the hash time and pass the result on. """
+            self._slots.release()
+            with self._lock:
+                self._pending -= 1
+            if not result.set_running_or_notify_cancel():
+                return  # Cancelled by verify_any
+            try:
+                value, elapsed = work.result()
+            except Exception as exc:  # pylint: disable=broad-except
+                if isinstance(exc, concurrent.futures.process.BrokenProcessPool) and executor:
+                    self._drop_executor(executor)
+                result.set_exception(exc)
+                return
+
+            with self._lock:
+                self._hashes += 1
+                self._hash_seconds += elapsed
+            result.set_result(value)
+
+        try:
+            work, executor = self._start(func, *args)
+        except BaseException:
+            # Nothing will call _done, give the slot back.
+            self._slots.release()
+            with self._lock:
+                self._pending -= 1
+            raise
+        work.add_done_callback(_done)
+        # Cancelling the result drops the work if the pool hasn't started it yet.
+        result.add_done_callback(lambda future: future.cancelled() and work.cancel())
+        return result
+
+    def hash(self, password):
+        """
+        Hash and salt a password with the configured rounds.
+        :param str password: Password to hash
+        :return concurrent.futures.Future: Resolves to the bcrypt hash bytes.
+        :raises HasherBusyError: The pool is too busy to admit the request.
+        """
+        return self._submit(_hashpw, password.encode('utf8'), self.rounds)
+
+    def needs_rehash(self, hashed):
+        """
+        Check if a hash was made with a different cost than the configured rounds.
+        :param bytes hashed: bcrypt hash
+        :return bool: hash should be replaced the next time the password is known
+        """
+        return hash_rounds(hashed) != self.rounds
+
+    def verify(self, password, hashed):
+        """
+        Check a password against a bcrypt hash.
+        :param str password: Password to check
+        :param bytes hashed: bcrypt hash to compare with
+        :return concurrent.futures.Future: Resolves to True if the password matches.
+        :raises HasherBusyError: The pool is too busy to admit the request.
+        """
+        return self._submit(_checkpw, password.encode('utf8'), hashed)
+
+    def verify_any(self, password, hashes):
+        """
+        Check a password against several bcrypt hashes in parallel, stopping at the first match.
+        Checks that haven't started when a match is found are cancelled.
+        :param str password: Password to check
+        :param list(bytes) hashes: bcrypt hashes to compare with
+        :return bool: True if the password matches any of the hashes.
+        :raises HasherBusyError: The pool is too busy to admit the request.
+        """
+        futures = []
+        try:
+            for hashed in hashes:
+                futures.append(self.verify(password, hashed))
+            for future in concurrent.futures.as_completed(futures):
+                if future.result():
+                    return True
+            return False
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def stats(self):
+        """
+        Metrics for the hashing pool.
+        :return dict: queue_depth, max_pending, hashes, mean_hash_seconds and rejected counts.
+        """
+        with self._lock:
+            return {'queue_depth': self._pending,
+                    'max_pending': self.max_pending,
+                    'hashes': self._hashes,
+                    'mean_hash_seconds': self._hash_seconds / self._hashes if self._hashes else 0.0,
+                    'rejected': self._rejected}
+
+    def log_stats(self):
+        """ Log the hashing pool's metrics, suitable for a common.background.PeriodicThread """
+        logger = logging.getLogger(__name__)
+        logger.info('Password hashing: %s', self.stats())
+
+    def shutdown(self, wait=True):
+        """
+        Stop the pool processes. A new pool is started if the hasher is used again.
+        :param bool wait: Wait for queued work to finish.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+HASHER = PasswordHasher()
+
+
+def calibrate(target_seconds=0.25, min_rounds=10, max_rounds=16):
+    """
+    Time bcrypt on this machine for a range of rounds.
+    :param float target_seconds: Longest acceptable time for one hash.
+    :param int min_rounds: Lowest cost to consider.
+    :param int max_rounds: Highest cost to consider.
+    :return tuple(int, dict): Highest rounds within target_seconds (or min_rounds), seconds by
+                              rounds
+    """
+    timings = {}
+    best = min_rounds
+    for rounds in range(min_rounds, max_rounds + 1):
+        _, elapsed = _hashpw(b'calibration password', rounds)
+        timings[rounds] = elapsed
+        if elapsed > target_seconds:
+            break
+        best = rounds
+    return best, timings
+
+def benchmark_verify_any(depth=5, workers=HASH_WORKERS, rounds=BCRYPT_ROUNDS):
+    """
+    Time a password reuse check against depth hashes that don't match, the worst case, one hash at
+    a time and in parallel with verify_any.
+    :param int depth: Number of hashes to check.
+    :param int workers: Hashing processes for the parallel check.
+    :param int rounds: bcrypt cost of the hashes.
+    :return dict: depth, workers, sequential_seconds and parallel_seconds
+    """
+    hashes = [_hashpw(f'old password {idx}'.encode('utf8'), rounds)[0] for idx in range(depth)]
+    start = time.perf_counter()
+    for hashed in hashes:
+        bcrypt.checkpw(b'new password', hashed)
+    sequential = time.perf_counter() - start
+
+    hasher = PasswordHasher(workers=workers, max_pending=max(depth, 1), rounds=rounds)
+    try:
+        if hashes:
+            hasher.verify('warm up the pool', hashes[0]).result()
+        start = time.perf_counter()
+        hasher.verify_any('new password', hashes)
+        parallel = time.perf_counter() - start
+    finally:
+        hasher.shutdown()
+    return {'depth': depth, 'workers': workers, 'sequential_seconds': sequential,
+            'parallel_seconds': parallel}
+
+def main(argv=None):
+    """
+    Command line entry point to calibrate BCRYPT_ROUNDS and benchmark the hashing pool.
+    :param list(str) argv: Arguments, default sys.argv.
+    """
+    parser = argparse.ArgumentParser(prog='python -m common.hashing', description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    calibrate_cmd = subparsers.add_parser('calibrate', help='Measure bcrypt hash time per cost.')
+    calibrate_cmd.add_argument('--target-ms', type=float, default=250,
+                               help='Longest acceptable time for one hash in milliseconds.')
+    calibrate_cmd.add_argument('--min-rounds', type=int, default=10)
+    calibrate_cmd.add_argument('--max-rounds', type=int, default=16)
+
+    history_cmd = subparsers.add_parser('bench-history',
+                                        help='Time password reuse checks, sequential vs parallel.')
+    history_cmd.add_argument('--depth', type=int, default=5)
+    history_cmd.add_argument('--workers', type=int, default=HASH_WORKERS)
+
+    args = parser.parse_args(argv)
+    if args.command == 'bench-history':
+        print(benchmark_verify_any(args.depth, args.workers))
+    elif args.command == 'calibrate':
+        best, timings = calibrate(args.target_ms / 1000, args.min_rounds, args.max_rounds)
+        for rounds, elapsed in timings.items():
+            print(f'rounds={rounds:2d} {elapsed * 1000:8.1f} ms')
+        print(f'BCRYPT_ROUNDS={best}  (current {BCRYPT_ROUNDS})')
+
+if __name__ == '__main__':
+    main()
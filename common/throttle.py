@@ -0,0 +1,195 @@
+"""
+Login throttling with sliding window counters shared by every worker process on a host.
+
+The counters live in a fixed size hash table in a memory mapped file (in /dev/shm by default) so
+all gunicorn workers see the same counts without a round trip to the database or another service.
+Each slot keeps the count for the current and the previous fixed window, and the sliding window
+count is estimated as previous * (unelapsed part of the window) + current. Updates take an
+exclusive lock on the file, they only touch a few slots so the lock is held very briefly.
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+
+_SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+# Counter table shared by the workers on this host.
+THROTTLE_PATH = os.environ.get('THROTTLE_PATH', os.path.join(_SHM_DIR, 'saas-api-throttle'))
+# Number of counters in the table, more distinct keys than this start evicting each other.
+THROTTLE_SLOTS = int(os.environ.get('THROTTLE_SLOTS', 65536))
+# Login attempts allowed per window for each email address and for each client IP.
+LOGIN_EMAIL_LIMIT = int(os.environ.get('LOGIN_EMAIL_LIMIT', 5))
+LOGIN_IP_LIMIT = int(os.environ.get('LOGIN_IP_LIMIT', 20))
+LOGIN_WINDOW = float(os.environ.get('LOGIN_WINDOW', 300))
+
+# key hash, window number, count in that window, count in the window before it
+_SLOT = struct.Struct('<QIII4x')
+_PROBES = 8
+
+
+class ThrottledError(Exception):
+    """ Raised when too many attempts have been made recently. """
+    pass
+
+
+def _key_hash(key):
+    """
+    :param str key: Counter key
+    :return int: Non zero 64 bit hash of key, zero marks an empty slot.
+    """
+    value = struct.unpack('<Q', hashlib.blake2b(key.encode('utf8'), digest_size=8).digest())[0]
+    return value or 1
+
+
+class SlidingWindowCounters(object):
+    """ Fixed size table of sliding window counters in a shared memory mapped file. """
+
+    def __init__(self, path=THROTTLE_PATH, slots=THROTTLE_SLOTS):
+        """
+        :param str path: File for the table, created if it doesn't exist.
+        :param int slots: Number of counters in the table. Must be the same for every process.
+        """
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = slots * _SLOT.size
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+    def _find_slot(self, key_hash, window_no):
+        """
+        Find the slot for key_hash in its probe sequence. If it isn't there use an empty or expired
+        slot, or failing that evict the least used one.
+        :param int key_hash: Hash of the key
+        :param int window_no: Current window number
+        :return tuple(int, int, int): Slot offset, current and previous window counts for the key.
+        """
+        start = key_hash % self.slots
+        victim = None
+        victim_count = None
+        for probe in range(_PROBES):
+            offset = ((start + probe) % self.slots) * _SLOT.size
+            slot_hash, slot_window, current, previous = _SLOT.unpack_from(self._map, offset)
+            if slot_hash == key_hash:
+                return offset, self._shift(window_no, slot_window, current, previous)
+            live = slot_hash and slot_window >= window_no - 1
+            count = current + previous if live else -1
+            if victim is None or count < victim_count:
+                victim, victim_count = offset, count
+        return victim, (0, 0)
+
+    @staticmethod
+    def _shift(window_no, slot_window, current, previous):
+        """
+        Roll a slot's counts forward to the current window.
+        :return tuple(int, int): current and previous window counts
+        """
+        if slot_window == window_no:
+            return current, previous
+        if slot_window == window_no - 1:
+            return 0, current
+        return 0, 0
+
+    def hit(self, key, limit, window, now=None):
+        """
+        Count an attempt for key, unless it is already at the limit.
+        :param str key: Counter key, prefix keys so different kinds of keys can't collide.
+        :param int limit: Attempts allowed per sliding window.
+        :param float window: Length of the window in seconds.
+        :param float now: Current time, default time.time().
+        :return bool: Attempt is allowed.
+        """
+        now = time.time() if now is None else now
+        window_no = int(now // window)
+        elapsed = (now % window) / window
+        key_hash = _key_hash(key)
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                offset, (current, previous) = self._find_slot(key_hash, window_no)
+                allowed = previous * (1 - elapsed) + current < limit
+                if allowed:
+                    current += 1
+                _SLOT.pack_into(self._map, offset, key_hash, window_no, current, previous)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return allowed
+
+    def reset(self, key):
+        """
+        Forget the attempts for key, for example after a successful login.
+        :param str key: Counter key
+        """
+        key_hash = _key_hash(key)
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                start = key_hash % self.slots
+                for probe in range(_PROBES):
+                    offset = ((start + probe) % self.slots) * _SLOT.size
+                    if _SLOT.unpack_from(self._map, offset)[0] == key_hash:
+                        _SLOT.pack_into(self._map, offset, 0, 0, 0, 0)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        """ Unmap and close the table file. """
+        self._map.close()
+        os.close(self._fd)
+
+
+_COUNTERS = None
+_COUNTERS_LOCK = threading.Lock()
+
+def get_counters():
+    """
+    Open the shared counters table once per process, after gunicorn forks its workers.
+    :return SlidingWindowCounters: Counters at THROTTLE_PATH
+    """
+    global _COUNTERS  # pylint: disable=global-statement
+    if _COUNTERS is None:
+        with _COUNTERS_LOCK:
+            if _COUNTERS is None:
+                _COUNTERS = SlidingWindowCounters()
+    return _COUNTERS
+
+def check_login(email, remote_addr=None, now=None):
+    """
+    Count a login attempt for the email address and client IP. Call before any password hashing.
+    :param str email: Email address the login attempt is for.
+    :param str remote_addr: IP address of the client, if known.
+    :param float now: Current time, default time.time().
+    :raises ThrottledError: Too many recent attempts for the email address or client IP.
+    """
+    counters = get_counters()
+    # The client IP first, so attempts from a throttled IP don't use up the email's attempts and
+    # lock out the owner of the address.
+    if remote_addr and not counters.hit('ip:' + remote_addr, LOGIN_IP_LIMIT, LOGIN_WINDOW, now):
+        raise ThrottledError('Too many login attempts from this address.')
+    if not counters.hit('email:' + email.lower(), LOGIN_EMAIL_LIMIT, LOGIN_WINDOW, now):
+        raise ThrottledError('Too many login attempts for this email address.')
+
+def reset_login(email):
+    """
+    Clear the attempts for an email address after a successful login.
+    :param str email: Email address that logged in.
+    """
+    get_counters().reset('email:' + email.lower())
@@ -10,7 +10,12 @@ except ImportError:
 
 import re
 
-from . import common_passwords
+from . import breached_passwords, common_passwords
+
+
+# From http://stackoverflow.com/questions/8022530/python-check-for-valid-email-address
+# Compiled once, bulk imports validate hundreds of thousands of addresses.
+VALID_EMAIL_ADDRESS = re.compile(r'^[^@ ]+@[^@. ]+(?:\.[^@. ]+)+$')
 
 
 def camel_to_delimiter_separated(name, glue='_'):
@@ -33,14 +38,14 @@ def is_valid_email_address(address):
     :param str address: Email Address to test
     :return bool: If it looks like a valid email address.
     """
-    # From http://stackoverflow.com/questions/8022530/python-check-for-valid-email-address
-    valid_email_address_pattern = re.compile(r'^[^@ ]+@[^@. ]+(?:\.[^@. ]+)+$')
-    return bool(valid_email_address_pattern.match(address))
+    return bool(VALID_EMAIL_ADDRESS.match(address))
 
 def is_common_password(passwd):
     """
-    Check passwd against a list of common passwords.
+    Check passwd against a list of common passwords, and the breached passwords index if one is
+    configured with BREACHED_PASSWORDS_PATH.
     :param str passwd: Password to test
     :return bool: Password is common
     """
-    return passwd.lower() in common_passwords.COMMON_PASSWORDS
+    return passwd.lower() in common_passwords.COMMON_PASSWORDS or \
+        breached_passwords.is_breached(passwd)
@@ -8,9 +8,10 @@ except ImportError:
     import sys
     print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
 
-from sqlalchemy_continuum import make_versioned
+import sqlalchemy.orm as saorm
 
-from . import authentication_tokens, forgot_password_tokens, groups, logins, memberships, profiles
+from . import (authentication_tokens, forgot_password_tokens, groups, logins, memberships,
+               password_histories, permissions, profiles, tenancy, version_archives)
 
 def __create_tables():
     """
@@ -24,7 +25,7 @@ def __create_tables():
     """
     from . import db
     from . import bases
-    make_versioned(user_cls=None)
+    saorm.configure_mappers()  # Builds the version tables.
     bases.Base.metadata.create_all(db.ENGINE)  # pylint: disable=no-member
 
 def __drop_tables():
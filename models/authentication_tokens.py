@@ -9,15 +9,25 @@ except ImportError:
     print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
 
 import datetime
+import logging
+import os
 import uuid
 
 import sqlalchemy as sa
 import sqlalchemy.orm as saorm
 
+from common import background
 from . import bases
 from . import db
 
 
+# Tokens expire this long after they were last used.
+SESSION_LENGTH = datetime.timedelta(minutes=30)
+# Sliding the expiration forward is only written to the DB once per interval for each token.
+RENEWAL_INTERVAL = datetime.timedelta(seconds=int(os.environ.get('TOKEN_RENEWAL_INTERVAL', 300)))
+# Renewals waiting to be written by flush_renewals, new expiration_dt by token id.
+RENEWALS = background.CoalescingBuffer()
+
 class AuthenticationTokens(bases.BaseModel):
     """ Track tokens used to authenticate API requests. """
     login_id = sa.Column(sa.Integer, sa.ForeignKey('logins.id', ondelete='CASCADE'), nullable=False)
@@ -26,6 +36,11 @@ class AuthenticationTokens(bases.BaseModel):
 
     login = saorm.relationship('Logins')
 
+    # Expired tokens are swept in (expiration_dt, id) order by models.maintenance.
+    __table_args__ = (sa.Index('ix_authentication_tokens_expiration_dt', 'expiration_dt', 'id'),)
+    # Issued on every login and renewed while in use, a version row per write isn't worth it.
+    __versioned__ = {'versioning': False}
+
     def __init__(self, *args, **kwargs):
         if 'token' not in kwargs:
             kwargs['token'] = self._gen_token()
@@ -40,7 +55,7 @@ class AuthenticationTokens(bases.BaseModel):
         Tokens expire in 30 minutes from creation by default.
         :return datetime.datetime: DateTime for Token Expiration
         """
-        return datetime.datetime.utcnow() + datetime.timedelta(minutes=30)
+        return datetime.datetime.utcnow() + SESSION_LENGTH
 
     @staticmethod
     def _gen_token():
@@ -51,11 +66,92 @@ class AuthenticationTokens(bases.BaseModel):
         return uuid.uuid4().hex
 
     @classmethod
-    def get_by_token(cls, token):
+    def get_by_token(cls, token, renew=True):
         """
-        Select forgot password token record by token. Excluding expired tokens.
+        Select authentication token record by token. Excluding expired tokens.
         :param str token: hex token string to lookup
-        :return ForgotPasswordTokens: Record matching token or None.
+        :param bool renew: Slide the expiration of the token found forward, see renew.
+        :return AuthenticationTokens: Record matching token or None.
         """
         now = datetime.datetime.utcnow()
-        return db.query(cls).filter(cls.token == token, cls.expiration_dt >= now).one_or_none()
+        the_token = db.query(cls).filter(cls.token == token, cls.expiration_dt >= now)\
+            .one_or_none()
+        if the_token is not None and renew:
+            the_token.renew(now)
+        return the_token
+
+    def renew(self, now=None):
+        """
+        Slide the expiration forward to SESSION_LENGTH from now. The new expiration is queued in
+        RENEWALS for flush_renewals instead of being written by this session, and only when it
+        moves the expiration by at least RENEWAL_INTERVAL, so authenticated reads stay read only.
+        :param datetime.datetime now: Time the token was used, default utcnow.
+        :return bool: A renewal was queued.
+        """
+        now = now or datetime.datetime.utcnow()
+        expiration_dt = now + SESSION_LENGTH
+        if self.id is None or expiration_dt - self.expiration_dt < RENEWAL_INTERVAL:
+            return False
+
+        RENEWALS.put(self.id, expiration_dt)
+        return True
+
+    @classmethod
+    def _renewals_statement(cls, renewals):
+        """
+        Build a single UPDATE ... FROM (VALUES ...) for a batch of renewals.
+        :param list(tuple(int, datetime.datetime)) renewals: token id and new expiration_dt pairs.
+        :return tuple(sqlalchemy.sql.expression.TextClause, dict): Statement and bind parameters.
+        """
+        values = []
+        params = {}
+        for idx, (token_id, expiration_dt) in enumerate(renewals):
+            values.append(f'(:id{idx}, CAST(:exp{idx} AS TIMESTAMP))')
+            params[f'id{idx}'] = token_id
+            params[f'exp{idx}'] = expiration_dt
+        table = cls.__tablename__
+        statement = sa.text(f'UPDATE {table} SET expiration_dt = renewals.expiration_dt '
+                            f'FROM (VALUES {", ".join(values)}) AS renewals (id, expiration_dt) '
+                            f'WHERE {table}.id = renewals.id '
+                            f'AND {table}.expiration_dt < renewals.expiration_dt')
+        return statement, params
+
+    @classmethod
+    def flush_renewals(cls, batch_size=1000):
+        """
+        Write the queued renewals with one UPDATE ... FROM (VALUES ...) per batch. An expiration is
+        never moved backwards. Renewals are put back in the queue if the write fails.
+        :param int batch_size: Maximum number of tokens per UPDATE statement.
+        :return int: Number of tokens updated.
+        """
+        logger = logging.getLogger(__name__)
+        renewals = RENEWALS.drain()
+        if not renewals:
+            return 0
+
+        items = list(renewals.items())
+        updated = 0
+        try:
+            # Use a connection of our own so the caller's session transaction is left alone.
+            with db.ENGINE.begin() as connection:
+                for start in range(0, len(items), batch_size):
+                    statement, params = cls._renewals_statement(items[start:start + batch_size])
+                    updated += connection.execute(statement, params).rowcount
+        except Exception:
+            RENEWALS.restore(renewals)
+            raise
+
+        logger.debug('Renewed %d of %d queued tokens.', updated, len(items))
+        return updated
+
+    @classmethod
+    def start_renewal_flusher(cls, interval=5):
+        """
+        Flush renewals on a daemon thread in this process. Pending renewals are flushed on stop.
+        :param float interval: Seconds between flushes, should be much less than RENEWAL_INTERVAL.
+        :return common.background.PeriodicThread: Started thread, call stop() to end it.
+        """
+        thread = background.PeriodicThread(cls.flush_renewals, interval, name='token-renewals',
+                                           run_on_stop=True)
+        thread.start()
+        return thread
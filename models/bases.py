@@ -8,10 +8,15 @@ except ImportError:
     import sys
     print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
 
+import datetime
 import logging
+import os
 
 import sqlalchemy as sa
+import sqlalchemy.orm as saorm
 from sqlalchemy.ext.declarative import as_declarative, declared_attr
+import sqlalchemy_continuum
+from sqlalchemy_continuum import make_versioned
 from sqlalchemy.sql.expression import func as sa_func
 from sqlalchemy.util.langhelpers import symbol as sa_symbol
 
@@ -20,6 +25,108 @@ from . import db
 
 
 NO_VALUE = sa_symbol('NO_VALUE')
+# Write version rows with PostgreSQL triggers instead of from the session, needs hstore installed.
+NATIVE_VERSIONING = os.environ.get('NATIVE_VERSIONING', '') == '1'
+
+# Versions read per page of BaseModel.history.
+HISTORY_PAGE_SIZE = 100
+# Changes returned per page of a sync.
+SYNC_PAGE_SIZE = 500
+# modified_at is the start of the transaction writing the row, so a transaction still running
+# during a sync could commit rows older than the cursor handed out. A sync leaves out the changes
+# from the start of the oldest transaction open on the primaries, see sync_until, and of the last
+# SYNC_LAG seconds, for the replicas to catch up and the clocks of the API and the DB to differ.
+SYNC_LAG = datetime.timedelta(seconds=int(os.environ.get('SYNC_LAG', 5)))
+# Start of the oldest transaction open in the database, UTC. The API's role sees the transactions
+# of its own sessions, the sessions of other roles writing the models need pg_read_all_stats.
+_OLDEST_TRANSACTION = sa.text(
+    "SELECT min(xact_start) AT TIME ZONE 'UTC' FROM pg_stat_activity "
+    "WHERE datname = current_database() AND backend_type = 'client backend'")
+
+# Versioning has to be set up before the models are declared.
+make_versioned(user_cls=None, options={'native_versioning': NATIVE_VERSIONING})
+
+
+@sa.event.listens_for(saorm.Mapper, 'after_configured')
+def _history_indexes():
+    """
+    Index the version tables continuum built for reading history in (transaction_id, id) order,
+    by tenant first for tenant scoped models, replacing continuum's transaction_id index. Index
+    the transactions by issued_at, for history since a time.
+    """
+    manager = sqlalchemy_continuum.versioning_manager
+    for version_class in manager.version_class_map.values():
+        table = version_class.__table__
+        name = f'ix_{table.name}_transaction_id_id'
+        if name in {index.name for index in table.indexes}:
+            continue
+        for index in list(table.indexes):
+            if index.name == f'ix_{table.name}_transaction_id':
+                table.indexes.discard(index)
+        sa.Index(name, table.c.transaction_id, table.c.id)
+        if 'tenant_id' in table.c:
+            sa.Index(f'ix_{table.name}_tenant_id_transaction_id', table.c.tenant_id,
+                     table.c.transaction_id, table.c.id)
+    table = getattr(manager.transaction_cls, '__table__', None)
+    if table is not None and 'ix_transaction_issued_at' not in {idx.name for idx in table.indexes}:
+        sa.Index('ix_transaction_issued_at', table.c.issued_at)
+
+def oldest_transaction():
+    """
+    :return datetime.datetime or None: Start of the oldest transaction open on the PostgreSQL
+                                       shards, UTC, None without any.
+    """
+    starts = [engine.scalar(_OLDEST_TRANSACTION) for engine in set(db.SHARDS.values())
+              if engine.dialect.name == 'postgresql']
+    starts = [start for start in starts if start is not None]
+    return min(starts) if starts else None
+
+def sync_until():
+    """
+    Transactions started before the oldest one still open have all committed, or rolled back, so
+    the rows and versions up to its start are final, however long the transactions writing them.
+    A long transaction holds back every sync until it ends.
+    :return tuple(datetime.datetime, int): High-watermark of a sync started now, changes are
+                                           synced up to this modified_at and transaction id.
+    """
+    until = datetime.datetime.utcnow() - SYNC_LAG
+    oldest = oldest_transaction()
+    if oldest is not None:
+        until = min(until, oldest - datetime.timedelta(microseconds=1))
+    transaction = sqlalchemy_continuum.versioning_manager.transaction_cls
+    last = db.query(sa.func.max(transaction.id)).filter(transaction.issued_at <= until).scalar()
+    return until, last or 0
+
+def write_versions(connection, model, ids, operation, transaction_id=None):
+    """
+    Write the version rows of models changed by SQL statements, which the sessions don't version,
+    copying the rows from the model's table. Call it after INSERTs and UPDATEs, and before DELETEs.
+    The native versioning triggers version those statements themselves.
+    :param sqlalchemy.engine.Connection connection: Connection in the statements' transaction
+    :param BaseModel.__class__ model: Model changed
+    :param list(int) ids: ids of the models changed
+    :param int operation: sqlalchemy_continuum.Operation of the statements
+    :param int or None transaction_id: Continuum transaction of the versions, None adds one.
+    :return int or None: The transaction id, to write the versions of the statements' other models.
+    """
+    if not ids or NATIVE_VERSIONING or not model.__versioned__.get('versioning', True):
+        return transaction_id
+    manager = sqlalchemy_continuum.versioning_manager
+    if transaction_id is None:
+        transaction_id = connection.execute(
+            manager.transaction_cls.__table__.insert()).inserted_primary_key[0]
+    table = model.__table__
+    version_table = sqlalchemy_continuum.version_class(model).__table__
+    in_ids = sa.any_(sa.bindparam('ids', ids, type_=sa.ARRAY(sa.Integer)))
+    # Validity strategy: the versions replaced end at this transaction.
+    connection.execute(version_table.update().where(version_table.c.id == in_ids).where(
+        version_table.c.end_transaction_id.is_(None)).values(end_transaction_id=transaction_id))
+    columns = [column.name for column in table.c]
+    connection.execute(version_table.insert().from_select(
+        columns + ['transaction_id', 'operation_type'],
+        sa.select([table.c[name] for name in columns] + [
+            sa.literal(transaction_id), sa.literal(operation)]).where(table.c.id == in_ids)))
+    return transaction_id
 
 @as_declarative()  # pylint: disable=too-few-public-methods
 class Base(object):
@@ -79,13 +186,34 @@ class BaseModel(Base):
     models.
     """
     __abstract__ = True
-    __versioned__ = {}  # Activate sqlalchemy_continuum versioning for all Resource Models
+    # Activate sqlalchemy_continuum versioning for all Resource Models. High churn models opt out
+    # with __versioned__ = {'versioning': False}, which skips their version table. History is kept
+    # until pruned by models.versioning_maintenance.prune_versions, see version_retention for the
+    # policy.
+    __versioned__ = {}
 
     id = sa.Column(sa.Integer, primary_key=True)  # pylint: disable=invalid-name
+    # Optimistic concurrency: every UPDATE and DELETE is conditional on the version_id read with
+    # the model and increments it, a concurrent write in between raises StaleDataError on flush
+    # instead of being silently overwritten. The API exposes it as the ETag of the resource.
+    version_id = sa.Column(sa.Integer, nullable=False, server_default='1')
 
-    def delete(self):
-        """ Delete this model in the session. Does not flush the session. """
+    @declared_attr
+    def __mapper_args__(cls):  # pylint: disable=no-self-argument
+        """
+        Count the versions of every model in version_id.
+        :return dict: mapper arguments
+        """
+        return {'version_id_col': cls.version_id}
+
+    def delete(self, flush=False):
+        """
+        Delete this model in the session. Does not flush the session.
+        :param bool flush: Also flush the session after deleting model.
+        """
         db.delete(self)
+        if flush:
+            db.flush()
 
     @classmethod
     def _prepare_conditions(cls, conditions):
@@ -111,12 +239,13 @@ class BaseModel(Base):
     @classmethod
     def get_all(cls, conditions=None):
         """
-        Lookup all of the records in the table.
+        Lookup all of the records in the table, ordered by id. Also the order of the merged results
+        when the rows are spread over several shards.
         :param dict or None conditions: filter conditions for SQL query
         :return list(BaseModel): Collection of subclass of BaseModel or []
         """
         criterion = cls._prepare_conditions(conditions or {})
-        return db.query(cls).filter(*criterion).all()
+        return db.query(cls).filter(*criterion).order_by(cls.id).all()
 
     @classmethod
     def get_by_pk(cls, the_id):
@@ -127,6 +256,106 @@ class BaseModel(Base):
         """
         return db.query(cls).filter(cls.id == the_id).one_or_none()
 
+    @classmethod
+    def _versions(cls):
+        """
+        :return sqlalchemy.orm.query.Query: Versions of this model, only the session's tenant's for
+                                            tenant scoped models, with their transaction.
+        """
+        version_class = sqlalchemy_continuum.version_class(cls)
+        query = db.query(version_class).options(saorm.selectinload(version_class.transaction))
+        tenant_id = db.connect().info.get(db.TENANT_ID)
+        if tenant_id is not None and hasattr(version_class, 'tenant_id'):
+            query = query.filter(version_class.tenant_id == tenant_id)
+        return query
+
+    @classmethod
+    def history_page(cls, model_id=None, after=None, since=None, limit=HISTORY_PAGE_SIZE):
+        """
+        A page of this model's versions in (transaction_id, id) order, read with a keyset so pages
+        deep into a large version table are as fast as the first. Versions of tenant scoped models
+        are limited to the session's tenant.
+        :param int or None model_id: Only the versions of this model, default the versions of all.
+        :param tuple(int, int) or None after: (transaction_id, id) of the last version of the
+                                              previous page, None for the first page.
+        :param datetime.datetime or None since: Only versions of transactions issued since, UTC.
+        :param int limit: Number of versions in the page.
+        :return list: Versions, with their transaction loaded.
+        """
+        version_class = sqlalchemy_continuum.version_class(cls)
+        query = cls._versions()
+        if model_id is not None:
+            query = query.filter(version_class.id == model_id)
+        if after is not None:
+            query = query.filter(sa.tuple_(version_class.transaction_id, version_class.id) >
+                                 sa.tuple_(*after))
+        if since is not None:
+            # The first transaction issued since, read from ix_transaction_issued_at.
+            transaction = sqlalchemy_continuum.versioning_manager.transaction_cls
+            first = db.query(transaction.id).filter(transaction.issued_at >= since)\
+                .order_by(transaction.issued_at).limit(1)
+            query = query.filter(version_class.transaction_id >= first.as_scalar())
+        return query.order_by(version_class.transaction_id, version_class.id).limit(limit).all()
+
+    @classmethod
+    def changed_since(cls, after=None, until=None, limit=SYNC_PAGE_SIZE):
+        """
+        Models created or modified after a (modified_at, id) key, in that order, read with the
+        (modified_at, id) index.
+        :param tuple(datetime.datetime, int) or None after: Key of the last model synced, None for
+                                                            all of them.
+        :param datetime.datetime or None until: Leave out the models modified after this.
+        :param int limit: Number of models to return.
+        :return list(BaseModel): Changed models
+        """
+        query = db.query(cls)
+        if after is not None:
+            query = query.filter(sa.tuple_(cls.modified_at, cls.id) > sa.tuple_(*after))
+        if until is not None:
+            query = query.filter(cls.modified_at <= until)
+        return query.order_by(cls.modified_at, cls.id).limit(limit).all()
+
+    @classmethod
+    def deleted_since(cls, after, until=None, limit=SYNC_PAGE_SIZE):
+        """
+        Versions recording the deletion of models, the tombstones of a sync, in (transaction_id,
+        id) order.
+        :param tuple(int, int or None) after: (transaction_id, id) of the last deletion synced, id
+                                              None when all of the transaction's are synced.
+        :param int or None until: Leave out the deletions of later transactions.
+        :param int limit: Number of deletions to return.
+        :return list: Delete versions
+        """
+        version_class = sqlalchemy_continuum.version_class(cls)
+        query = cls._versions().filter(
+            version_class.operation_type == sqlalchemy_continuum.Operation.DELETE)
+        if after[1] is None:
+            query = query.filter(version_class.transaction_id > after[0])
+        else:
+            query = query.filter(
+                sa.tuple_(version_class.transaction_id, version_class.id) > sa.tuple_(*after))
+        if until is not None:
+            query = query.filter(version_class.transaction_id <= until)
+        return query.order_by(version_class.transaction_id, version_class.id).limit(limit).all()
+
+    @classmethod
+    def history(cls, model_id=None, since=None, page_size=HISTORY_PAGE_SIZE):
+        """
+        Iterate over this model's versions in (transaction_id, id) order, a page at a time, so a
+        long history is never loaded at once like the versions relationship does.
+        :param int or None model_id: Only the versions of this model, default the versions of all.
+        :param datetime.datetime or None since: Only versions of transactions issued since, UTC.
+        :param int page_size: Number of versions read per query.
+        :return generator: Versions, see history_page.
+        """
+        after = None
+        while True:
+            page = cls.history_page(model_id, after, since, page_size)
+            yield from page
+            if len(page) < page_size:
+                return
+            after = (page[-1].transaction_id, page[-1].id)
+
     def save(self, flush=False):
         """
         Add this model to the session. Does not flush the session.
@@ -137,3 +366,18 @@ class BaseModel(Base):
         if flush:
             db.flush() # Send INSERT/UPDATE to DB, but don't commit the transaction.
         logger.info('Added %r', self)
+
+
+@sa.event.listens_for(BaseModel, 'instrument_class', propagate=True)
+def _sync_index(mapper, class_):
+    """
+    Index the tables of versioned models by (modified_at, id) for changed_since, by tenant first
+    for tenant scoped models. Unversioned models can't report deletions, so aren't synced.
+    """
+    if not class_.__versioned__.get('versioning', True):
+        return
+    table = mapper.local_table
+    columns = [table.c.modified_at, table.c.id]
+    if 'tenant_id' in table.c:
+        columns.insert(0, table.c.tenant_id)
+    sa.Index(f'ix_{table.name}_modified_at_id', *columns)
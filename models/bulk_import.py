@@ -0,0 +1,413 @@
+"""
+Bulk import of people, Profiles with optional Logins and Memberships, from CSV or NDJSON files.
+
+Records are streamed from the file and handled a batch at a time: validated, checked for duplicates
+in the file and against existing Profiles (using the lower(email) index), passwords hashed on a
+dedicated hashing pool, then written with one multi-row INSERT per table, and their versions, in a
+single transaction.
+After every batch the number of records done is saved to a checkpoint file so a crashed import
+resumes after the last committed batch. Records already imported are skipped as existing, so
+replaying a batch is harmless.
+
+Record fields:
+    email          required
+    full_name      required
+    password       optional, creates a Login
+    password_hash  optional bcrypt hash, creates a Login without hashing
+    group_ids      optional Groups to add Memberships in, ';' separated in CSV, a list in NDJSON
+
+Example Usage:
+$ ENV=stage python -m models.bulk_import run people.csv --checkpoint people.csv.ckpt
+$ ENV=dev python -m models.bulk_import bench --rows 100000
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import argparse
+import csv
+import itertools
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+import psycopg2.extras
+import sqlalchemy as sa
+from sqlalchemy_continuum import Operation
+
+from common import hashing, log, utilities
+from . import groups, logins, memberships, profiles
+from . import bases
+from . import db
+
+
+# Invalid records kept in the import stats, all of them are logged.
+MAX_ERRORS = 100
+
+
+def read_records(path):
+    """
+    Stream records from a CSV file with a header row, or a file of one JSON object per line.
+    :param str path: File to read, .csv files are CSV, anything else NDJSON.
+    :yield tuple(int, dict): Record number starting at 1, and fields. None for invalid JSON.
+    """
+    if path.endswith('.csv'):
+        with open(path, newline='', encoding='utf8') as infile:
+            for number, record in enumerate(csv.DictReader(infile), 1):
+                record['group_ids'] = [group_id for group_id in
+                                       (record.get('group_ids') or '').split(';') if group_id]
+                yield number, record
+    else:
+        with open(path, encoding='utf8') as infile:
+            lines = (line for line in infile if line.strip())
+            for number, line in enumerate(lines, 1):
+                try:
+                    yield number, json.loads(line)
+                except ValueError:
+                    yield number, None
+
+def validate_record(record):
+    """
+    Check one record with the same rules as the models, password history aside.
+    :param dict record: Fields read from the file
+    :return dict: email, full_name, password, password_hash (bytes) and group_ids (list(int))
+    :raises ValueError: Record isn't valid.
+    """
+    if not isinstance(record, dict):
+        raise ValueError('Record is not an object.')
+    email = (record.get('email') or '').strip()
+    if len(email) > 50 or not utilities.is_valid_email_address(email):
+        raise ValueError('Invalid Email Address')
+    full_name = (record.get('full_name') or '').strip()
+    if not full_name or len(full_name) > 100:
+        raise ValueError('full_name is required, up to 100 characters.')
+
+    password = record.get('password') or None
+    password_hash = record.get('password_hash') or None
+    if password_hash:
+        password_hash = password_hash.encode('ascii', 'replace')
+        if not hashing.is_bcrypt_hash(password_hash):
+            raise ValueError('password_hash is not a bcrypt hash.')
+        password = None
+    elif password:
+        logins.check_password_policy(password, email)
+
+    group_ids = record.get('group_ids') or []
+    if not isinstance(group_ids, list):
+        raise ValueError('group_ids must be a list.')
+    return {'email': email, 'full_name': full_name, 'password': password,
+            'password_hash': password_hash, 'group_ids': [int(group_id) for group_id in group_ids]}
+
+def _batches(records, size):
+    """
+    :param iterable records: Records to group
+    :param int size: Records per batch
+    :yield list: Batches of up to size records
+    """
+    iterator = iter(records)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def _load_checkpoint(checkpoint_path, source):
+    """
+    :param str checkpoint_path: Checkpoint file, may not exist.
+    :param str source: File being imported.
+    :return dict: Saved state for source, or None to start from the beginning.
+    """
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, encoding='utf8') as infile:
+        state = json.load(infile)
+    if state.get('source') != os.path.abspath(source) or \
+            state.get('source_size') != os.path.getsize(source):
+        raise ValueError(f'Checkpoint {checkpoint_path} is for a different file.')
+    return state
+
+def _save_checkpoint(checkpoint_path, state):
+    """
+    Replace the checkpoint file atomically, so a crash never leaves half a checkpoint.
+    :param str checkpoint_path: Checkpoint file
+    :param dict state: State to save
+    """
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as outfile:
+        json.dump(state, outfile)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def _insert_rows(connection, table, rows):
+    """
+    Insert rows with a single statement. SQLAlchemy spends longer compiling a multi-row INSERT
+    than PostgreSQL takes to run it, so with psycopg2 the rows go straight to execute_values.
+    :param sqlalchemy.engine.Connection connection: Connection in the batch's transaction
+    :param sqlalchemy.Table table: Table to insert into, modified_at is set to now().
+    :param list(dict) rows: Column values by column name, the same columns in every row.
+    :return list(int): ids of the rows inserted.
+    """
+    if not rows:
+        return []
+    if connection.dialect.driver != 'psycopg2':
+        return [connection.execute(table.insert(), row).inserted_primary_key[0] for row in rows]
+
+    columns = list(rows[0])
+    template = '(' + ', '.join(['%s'] * len(columns)) + ', now())'
+    cursor = connection.connection.cursor()
+    try:
+        return [row[0] for row in psycopg2.extras.execute_values(
+            cursor, f'INSERT INTO {table.name} ({", ".join(columns)}, modified_at) VALUES %s '
+                    f'RETURNING id',
+            [tuple(row[column] for column in columns) for row in rows], template=template,
+            page_size=len(rows), fetch=True)]
+    finally:
+        cursor.close()
+
+_EXISTING_EMAILS = sa.select([sa.func.lower(profiles.Profiles.email)])\
+    .where(sa.func.lower(profiles.Profiles.email).in_(sa.bindparam('keys', expanding=True)))
+_PROFILE_IDS = sa.select([profiles.Profiles.email, profiles.Profiles.id])\
+    .where(profiles.Profiles.email.in_(sa.bindparam('emails', expanding=True)))
+
+
+class Importer(object):
+    """ Imports one file in batches, keeping the stats and the emails seen so far. """
+
+    def __init__(self, batch_size=1000, hash_workers=None, rounds=hashing.BCRYPT_ROUNDS):
+        """
+        :param int batch_size: Records per transaction.
+        :param int hash_workers: Hashing processes for passwords, default one per CPU. Separate
+                                 from the API's hashing pool so an import doesn't starve logins.
+        :param int rounds: bcrypt cost for imported passwords.
+        """
+        self.batch_size = batch_size
+        self.hasher = hashing.PasswordHasher(workers=hash_workers or os.cpu_count(),
+                                             max_pending=batch_size, max_wait=60, rounds=rounds)
+        self.stats = {'read': 0, 'created': 0, 'logins': 0, 'memberships': 0, 'existing': 0,
+                      'duplicates': 0, 'invalid': 0, 'errors': []}
+        self._seen = set()
+        self._groups = set()
+
+    def _error(self, number, message):
+        """
+        Record an invalid record.
+        :param int number: Record number in the file
+        :param str message: What is wrong with it
+        """
+        logger = logging.getLogger(__name__)
+        logger.warning('Record %d skipped: %s', number, message)
+        self.stats['invalid'] += 1
+        if len(self.stats['errors']) < MAX_ERRORS:
+            self.stats['errors'].append([number, str(message)])
+
+    def _validate(self, batch):
+        """
+        :param list(tuple(int, dict)) batch: Numbered records
+        :return list(tuple(int, dict)): Valid records not seen before in this import.
+        """
+        valid = []
+        for number, record in batch:
+            try:
+                row = validate_record(record)
+            except (TypeError, ValueError, AttributeError, IndexError) as exc:
+                self._error(number, exc)
+                continue
+            key = row['email'].lower()
+            if key in self._seen:
+                self.stats['duplicates'] += 1
+                continue
+            self._seen.add(key)
+            valid.append((number, row))
+
+        group_ids = {group_id for _, row in valid for group_id in row['group_ids']} - self._groups
+        if group_ids:
+            table = groups.Groups.__table__
+            self._groups.update(group_id for group_id, in db.ENGINE.execute(
+                sa.select([table.c.id]).where(table.c.id.in_(group_ids))))
+            missing = group_ids - self._groups
+            if missing:
+                checked = []
+                for number, row in valid:
+                    unknown = missing.intersection(row['group_ids'])
+                    if unknown:
+                        self._error(number, f'Unknown group_ids {sorted(unknown)}')
+                    else:
+                        checked.append((number, row))
+                valid = checked
+        return valid
+
+    def _existing_emails(self, rows):
+        """
+        :param list(dict) rows: Validated rows
+        :return set(str): Lower cased emails of rows that already have a Profile.
+        """
+        if not rows:
+            return set()
+        return {email for email, in db.ENGINE.execute(
+            _EXISTING_EMAILS, keys=[row['email'].lower() for row in rows])}
+
+    def import_batch(self, batch):
+        """
+        Validate and write one batch of records in a single transaction.
+        :param list(tuple(int, dict)) batch: Numbered records
+        """
+        self.stats['read'] += len(batch)
+        rows = [row for _, row in self._validate(batch)]
+        existing = self._existing_emails(rows)
+        self.stats['existing'] += len(existing)
+        rows = [row for row in rows if row['email'].lower() not in existing]
+        if not rows:
+            return
+
+        # Hash the whole batch in parallel before the transaction starts.
+        hashes = {idx: self.hasher.hash(row['password'])
+                  for idx, row in enumerate(rows) if row['password']}
+        login_rows = []
+        for idx, row in enumerate(rows):
+            if idx in hashes:
+                login_rows.append({'email': row['email'], '_password': hashes[idx].result()})
+            elif row['password_hash']:
+                login_rows.append({'email': row['email'], '_password': row['password_hash']})
+
+        with db.ENGINE.begin() as connection:
+            profile_ids = _insert_rows(
+                connection, profiles.Profiles.__table__,
+                [{'email': row['email'], 'full_name': row['full_name']} for row in rows])
+            ids = dict(connection.execute(
+                _PROFILE_IDS, emails=[row['email'] for row in rows]).fetchall())
+            login_ids = _insert_rows(connection, logins.Logins.__table__, login_rows)
+            membership_rows = [{'group_id': group_id, 'profile_id': ids[row['email']]}
+                               for row in rows for group_id in row['group_ids']]
+            membership_ids = _insert_rows(connection, memberships.Memberships.__table__,
+                                          membership_rows)
+            # The batch's versions, in a continuum transaction of their own.
+            transaction_id = None
+            for model, model_ids in ((profiles.Profiles, profile_ids), (logins.Logins, login_ids),
+                                     (memberships.Memberships, membership_ids)):
+                transaction_id = bases.write_versions(connection, model, model_ids,
+                                                      Operation.INSERT, transaction_id)
+
+        self.stats['created'] += len(rows)
+        self.stats['logins'] += len(login_rows)
+        self.stats['memberships'] += len(membership_rows)
+
+    def run(self, path, checkpoint_path=None):
+        """
+        Import a file, resuming from checkpoint_path when it has a checkpoint for path.
+        :param str path: CSV or NDJSON file
+        :param str checkpoint_path: File to save progress to after every batch, removed when done.
+        :return dict: Counts of records read, created, logins, memberships, existing, duplicates
+                      and invalid, the first MAX_ERRORS errors, seconds and rows_per_sec.
+        """
+        logger = logging.getLogger(__name__)
+        state = _load_checkpoint(checkpoint_path, path)
+        done = 0
+        if state is not None:
+            done = state['records_done']
+            self.stats = state['stats']
+            logger.info('Resuming import of %s after record %d.', path, done)
+
+        start = time.perf_counter()
+        read = 0
+        try:
+            records = itertools.islice(read_records(path), done, None)
+            for batch in _batches(records, self.batch_size):
+                self.import_batch(batch)
+                done += len(batch)
+                read += len(batch)
+                if checkpoint_path:
+                    _save_checkpoint(checkpoint_path, {
+                        'source': os.path.abspath(path), 'source_size': os.path.getsize(path),
+                        'records_done': done, 'stats': self.stats})
+                logger.debug('Imported %d records of %s.', done, path)
+        finally:
+            self.hasher.shutdown()
+
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            os.unlink(checkpoint_path)
+        elapsed = time.perf_counter() - start
+        stats = dict(self.stats, seconds=elapsed, rows_per_sec=read / elapsed if elapsed else 0.0)
+        logger.info('Imported %s: %d created, %d existing, %d duplicates, %d invalid in %.2fs '
+                    '(%.0f rows/sec).', path, stats['created'], stats['existing'],
+                    stats['duplicates'], stats['invalid'], elapsed, stats['rows_per_sec'])
+        return stats
+
+def import_file(path, checkpoint_path=None, batch_size=1000, hash_workers=None):
+    """
+    Import people from a CSV or NDJSON file. See the module docstring for the fields.
+    :param str path: CSV or NDJSON file
+    :param str checkpoint_path: File to save progress to, resumes from it if it exists.
+    :param int batch_size: Records per transaction.
+    :param int hash_workers: Hashing processes for passwords, default one per CPU.
+    :return dict: Stats from Importer.run
+    """
+    return Importer(batch_size, hash_workers).run(path, checkpoint_path)
+
+
+def benchmark(rows=100000, batch_size=1000, passwords=0, rounds=4):
+    """
+    Import rows generated people from a temporary CSV file, then delete them. The generated
+    Profiles use the import-bench.invalid email domain.
+    :param int rows: Number of people to import.
+    :param int batch_size: Records per transaction.
+    :param int passwords: Number of the people that also get a Login with a password.
+    :param int rounds: bcrypt cost for the passwords.
+    :return dict: Stats from Importer.run
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'people.csv')
+        with open(path, 'w', newline='', encoding='utf8') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(('email', 'full_name', 'password'))
+            for idx in range(rows):
+                name = uuid.uuid4().hex
+                writer.writerow((f'{name[:12]}@import-bench.invalid',
+                                 f'{name[12:20]} {name[20:]}', name if idx < passwords else ''))
+        try:
+            return Importer(batch_size, rounds=rounds).run(path)
+        finally:
+            for model in (logins.Logins, profiles.Profiles):
+                table = model.__table__
+                db.ENGINE.execute(table.delete().where(
+                    table.c.email.like('%@import-bench.invalid')))
+
+def main(argv=None):
+    """
+    Command line entry point for imports.
+    :param list(str) argv: Arguments, default sys.argv.
+    """
+    log.init_logging()
+
+    parser = argparse.ArgumentParser(prog='python -m models.bulk_import', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_cmd = subparsers.add_parser('run', help='Import a CSV or NDJSON file.')
+    run_cmd.add_argument('path')
+    run_cmd.add_argument('--checkpoint', help='Progress file, default PATH.ckpt')
+    run_cmd.add_argument('--batch-size', type=int, default=1000)
+    run_cmd.add_argument('--hash-workers', type=int, default=None)
+
+    bench_cmd = subparsers.add_parser('bench', help='Time an import of generated people.')
+    bench_cmd.add_argument('--rows', type=int, default=100000)
+    bench_cmd.add_argument('--batch-size', type=int, default=1000)
+    bench_cmd.add_argument('--passwords', type=int, default=0,
+                           help='Number of people with a password to hash.')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        stats = import_file(args.path, args.checkpoint or args.path + '.ckpt', args.batch_size,
+                            args.hash_workers)
+    else:
+        stats = benchmark(args.rows, args.batch_size, args.passwords)
+    print(json.dumps(stats, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,25 @@
 """
 Database connection for models
+
+Tenants can be spread over several databases, shards. Sessions route the models of a tenant scoped
+session, see models.tenancy, to the tenant's shard. Everything else, global models and plain SQL,
+goes to the default shard, ENGINE. Queries of tenant scoped models in a session without a tenant are
+sent to every shard in parallel and the results merged in the query's order.
+
+Every shard has the full schema, and the ids of tenant scoped tables must not overlap between
+shards, give each shard's sequences their own range.
+
+Example Configuration:
+DB_SHARDS='{"big": "postgresql://api@big-db/saas_prod"}' TENANT_SHARDS='{"42": "big"}'
+
+Sessions made read only with read_only, for safe requests, don't autoflush, run their transactions
+as READ ONLY on PostgreSQL and read from the shard's replica when one is configured. Replicas lag
+behind, reads that must see a write just made should stay on the primary.
+DB_REPLICAS='{"default": "postgresql://api@replica-db/saas_prod"}'
+
+Pool connections are tracked by the thread that checked them out, so a request can check that it
+returned all of its connections, see checked_out, and count the statements it ran on them, see
+count_queries.
 """
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 try:
@@ -8,11 +28,22 @@ except ImportError:
     import sys
     print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
 
+import collections
+import concurrent.futures
+import contextlib
+import json
 import logging
 import os
+import re
+import threading
+import time
 
 import sqlalchemy
+from sqlalchemy.ext import horizontal_shard
+from sqlalchemy.orm import exc as orm_exc
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.sql import elements, functions, operators
+from sqlalchemy.sql import util as sql_util
 
 
 CONNECTIONS = {
@@ -26,12 +57,414 @@ ENV = os.environ.get('ENV', 'dev')
 # Needed for BaseModel.metadata.create_all(ENGINE)
 ENGINE = sqlalchemy.create_engine(CONNECTIONS[ENV])
 
+# session.info key for the tenant the session is scoped to.
+TENANT_ID = 'tenant_id'
+# session.info key set on read only sessions, whether they read from the replicas.
+READ_ONLY = 'read_only'
+# Shard of the global models, and of tenants not in TENANT_SHARDS.
+DEFAULT_SHARD = 'default'
+# Engines by shard name. Other shards are configured as JSON {"name": "database url"}.
+SHARDS = {DEFAULT_SHARD: ENGINE}
+SHARDS.update((name, sqlalchemy.create_engine(url))
+              for name, url in json.loads(os.environ.get('DB_SHARDS', '{}')).items())
+# Read replicas by shard name, configured as JSON {"name": "database url"}.
+REPLICAS = {name: sqlalchemy.create_engine(url)
+            for name, url in json.loads(os.environ.get('DB_REPLICAS', '{}')).items()}
+# The shard map, tenant ids to shard names, configured as JSON {"tenant id": "name"}.
+TENANT_SHARDS = {int(tenant_id): name
+                 for tenant_id, name in json.loads(os.environ.get('TENANT_SHARDS', '{}')).items()}
+# Threads sending a query to the shards at the same time.
+SCATTER_WORKERS = int(os.environ.get('SCATTER_WORKERS', 8))
+
+_SCATTER_POOL = concurrent.futures.ThreadPoolExecutor(SCATTER_WORKERS)
+
+# Times the same normalized statement may run while counting before it's reported as an N+1.
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 10))
+
+# Threads holding each checked out pool connection, by connection record.
+_CHECKOUTS = {}
+_CHECKOUTS_LOCK = threading.Lock()
+# connection.info key for the thread that checked the connection out.
+_OWNER = 'owner_thread'
+# QueryCounters counting the statements of each thread's connections, by thread.
+_COUNTERS = collections.defaultdict(list)
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|\?")
+_SQL_LISTS = re.compile(r'\(\?(?:\s*,\s*\?)+\)')
+_SQL_SPACE = re.compile(r'\s+')
+
+
+class ConnectionLeakError(RuntimeError):
+    """ Connections are still checked out after the session was closed. """
+    pass
+
+
+class QueryCounter(object):
+    """ Statements run on the connections of a thread while counting, and the time they took. """
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.by_statement = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add(self, statement, seconds):
+        """
+        :param str statement: SQL sent to the database
+        :param float seconds: Time it took
+        """
+        normalized = normalize_sql(statement)
+        # Shards queried in parallel add from the scatter threads.
+        with self._lock:
+            self.statements += 1
+            self.seconds += seconds
+            self.by_statement[normalized] += 1
+
+    def repeated(self, threshold=None):
+        """
+        :param int or None threshold: Times a statement may run, default N_PLUS_ONE_THRESHOLD.
+        :return list(tuple(str, int)): Normalized statements run more often, the likely N+1
+                                       queries, with their counts, most first.
+        """
+        threshold = N_PLUS_ONE_THRESHOLD if threshold is None else threshold
+        return [(statement, count) for statement, count in self.by_statement.most_common()
+                if count > threshold]
+
+
+class QueryMetrics(object):
+    """ Statements and database time of requests by endpoint, for logging as metrics. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, counter):
+        """
+        :param str endpoint: Name of the endpoint of the request
+        :param QueryCounter counter: Statements of the request
+        """
+        with self._lock:
+            metrics = self._endpoints.setdefault(
+                endpoint, {'requests': 0, 'statements': 0, 'max_statements': 0, 'db_seconds': 0.0,
+                           'n_plus_one': 0})
+            metrics['requests'] += 1
+            metrics['statements'] += counter.statements
+            metrics['max_statements'] = max(metrics['max_statements'], counter.statements)
+            metrics['db_seconds'] += counter.seconds
+            metrics['n_plus_one'] += bool(counter.repeated())
+
+    def stats(self):
+        """
+        Metrics since the last call, which starts them over.
+        :return dict: By endpoint the requests, statements, max_statements in a request, db_seconds
+                      and n_plus_one, requests that repeated a statement.
+        """
+        with self._lock:
+            endpoints, self._endpoints = self._endpoints, {}
+        return endpoints
+
+    def log_stats(self):
+        """ Log the metrics, suitable for a common.background.PeriodicThread """
+        logger = logging.getLogger(__name__)
+        for endpoint, metrics in sorted(self.stats().items()):
+            logger.info('Queries of %s: %s', endpoint, metrics)
+
+
+QUERY_METRICS = QueryMetrics()
+
+
+def normalize_sql(statement):
+    """
+    :param str statement: SQL
+    :return str: The statement with its literals and parameters replaced by ?, lists of them by
+                 (?), and whitespace collapsed, the same for every run of a query.
+    """
+    statement = _SQL_LITERALS.sub('?', statement)
+    return _SQL_SPACE.sub(' ', _SQL_LISTS.sub('(?)', statement)).strip()
+
+def _checkout(dbapi_connection, connection_record, connection_proxy):  # pylint: disable=unused-argument
+    """ Pool checkout event, remember the thread the connection was checked out by. """
+    thread = threading.get_ident()
+    connection_record.info[_OWNER] = thread
+    with _CHECKOUTS_LOCK:
+        _CHECKOUTS[connection_record] = thread
+
+def _checkin(dbapi_connection, connection_record):
+    """ Pool checkin event, the connection's transactions are read write again. """
+    with _CHECKOUTS_LOCK:
+        _CHECKOUTS.pop(connection_record, None)
+    if getattr(dbapi_connection, 'readonly', None):
+        dbapi_connection.readonly = dbapi_connection.deferrable = None
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument,too-many-arguments
+    """ Statement execution event, time it when its connection's thread is counting. """
+    if _COUNTERS.get(conn.info.get(_OWNER)):
+        conn.info['query_start'] = time.perf_counter()
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument,too-many-arguments
+    """ Statement executed event, add it to the counters of its connection's thread. """
+    start = conn.info.pop('query_start', None)
+    if start is None:
+        return
+    seconds = time.perf_counter() - start
+    for counter in _COUNTERS.get(conn.info.get(_OWNER), ()):
+        counter.add(statement, seconds)
+
+def _track(engine):
+    """
+    Track the connections checked out of engine's pool, and the statements run on them.
+    :param sqlalchemy.engine.Engine engine: Engine of a shard
+    """
+    if not sqlalchemy.event.contains(engine, 'checkout', _checkout):
+        sqlalchemy.event.listen(engine, 'checkout', _checkout)
+        sqlalchemy.event.listen(engine, 'checkin', _checkin)
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', _before_execute)
+        sqlalchemy.event.listen(engine, 'after_cursor_execute', _after_execute)
+
+def start_counting():
+    """
+    Count the statements run on the current thread's connections, until stop_counting.
+    :return QueryCounter: The counter
+    """
+    counter = QueryCounter()
+    _COUNTERS[threading.get_ident()].append(counter)
+    return counter
+
+def stop_counting(counter):
+    """
+    :param QueryCounter counter: Counter from start_counting on this thread
+    :return QueryCounter: The counter, no longer counting.
+    """
+    thread = threading.get_ident()
+    counters = _COUNTERS.get(thread, [])
+    if counter in counters:
+        counters.remove(counter)
+    if not counters:
+        _COUNTERS.pop(thread, None)
+    return counter
+
+@contextlib.contextmanager
+def count_queries():
+    """
+    Count the statements run on the current thread's connections in the block, including those of
+    the shards queried in parallel for it. Counts can be nested.
+    :yield QueryCounter: The counter
+    """
+    counter = start_counting()
+    try:
+        yield counter
+    finally:
+        stop_counting(counter)
+
+def checked_out(thread=None):
+    """
+    :param int or None thread: threading.get_ident of a thread, default the current thread.
+    :return int: Number of pool connections the thread has checked out, of every shard.
+    """
+    thread = threading.get_ident() if thread is None else thread
+    with _CHECKOUTS_LOCK:
+        return sum(1 for owner in _CHECKOUTS.values() if owner == thread)
+
+def add_shard(name, bind):
+    """
+    Add a database to route tenants to.
+    :param str name: Name of the shard
+    :param str or sqlalchemy.engine.Engine bind: Database url or engine
+    """
+    SHARDS[name] = sqlalchemy.create_engine(bind) if isinstance(bind, str) else bind
+    _track(SHARDS[name])
+
+def assign_tenant(tenant_id, shard):
+    """
+    Update the shard map, new sessions of the tenant go to the shard.
+    :param int tenant_id: Tenant to route
+    :param str shard: Name of the shard
+    :raises KeyError: Unknown shard
+    """
+    if shard not in SHARDS:
+        raise KeyError(f'Unknown shard {shard}.')
+    if shard == DEFAULT_SHARD:
+        TENANT_SHARDS.pop(tenant_id, None)
+    else:
+        TENANT_SHARDS[tenant_id] = shard
+
+def shard_for(tenant_id):
+    """
+    :param int tenant_id: Tenant to route
+    :return str: Name of the shard with the tenant's models.
+    """
+    return TENANT_SHARDS.get(tenant_id, DEFAULT_SHARD)
+
+def _is_tenant_scoped(entity):
+    """
+    :param entity: Mapper, mapped class or alias, or None
+    :return bool: The model has a tenant_id column, its rows live on the tenants' shards.
+    """
+    return entity is not None and 'tenant_id' in sqlalchemy.inspect(entity).mapper.columns
+
+def _order_keys(query):
+    """
+    :param sqlalchemy.orm.query.Query query: Query of a single model
+    :return list(tuple(str, bool)) or None: Attribute and descending flag of each ORDER BY column,
+                                            None when the order can't be applied in python.
+    """
+    if len(query.column_descriptions) != 1 or query.column_descriptions[0]['entity'] is None:
+        return None
+    mapper = sqlalchemy.inspect(query.column_descriptions[0]['entity']).mapper
+    keys = []
+    for clause in query._order_by or ():  # pylint: disable=protected-access
+        descending = getattr(clause, 'modifier', None) is operators.desc_op
+        column = clause.element if descending else clause
+        try:
+            keys.append((mapper.get_property_by_column(column).key, descending))
+        except (AttributeError, orm_exc.UnmappedColumnError):
+            return None
+    return keys
+
+# Merge of the values an aggregate function returns on each shard.
+_MERGES = {'count': sum, 'sum': sum, 'min': min, 'max': max}
+
+def _aggregate_merges(query):
+    """
+    :param sqlalchemy.orm.query.Query query: Query to run on several shards
+    :return list(callable) or None: Function merging the shards' values of each column,
+                                    None when the query doesn't select aggregates.
+    :raises NotImplementedError: The aggregates can't be merged from the shards' values.
+    """
+    merges = []
+    for description in query.column_descriptions:
+        expr = description['expr']
+        if isinstance(expr, elements.Label):
+            expr = expr.element
+        merges.append(_MERGES.get(expr.name) if isinstance(expr, functions.FunctionElement)
+                      else None)
+    if not any(merges):
+        return None
+    if not all(merges) or query._group_by:  # pylint: disable=protected-access
+        raise NotImplementedError('Only ungrouped count, sum, min and max merge across shards.')
+    return merges
+
+def _merge(merge, values):
+    """
+    :param callable merge: Function merging the values, from _aggregate_merges
+    :param iterable values: Value of an aggregate on each shard, None on shards without rows
+    :return: The aggregate of all the shards
+    """
+    values = [value for value in values if value is not None]
+    return merge(values) if values else None
+
+
+class ScatterGatherQuery(horizontal_shard.ShardedQuery):
+    """ Query sending the statement to its shards in parallel, and merging the results in order. """
+    def _execute_and_instances(self, context):
+        shard_ids = None
+        if context.identity_token is None and self._shard_id is None:
+            shard_ids = self.query_chooser(self)
+        if not shard_ids or len(shard_ids) == 1:
+            return super()._execute_and_instances(context)
+
+        merges = _aggregate_merges(self)
+        keys = _order_keys(self)
+        if keys is None and self._order_by:
+            raise NotImplementedError('The ORDER BY of queries across shards must be of columns '
+                                      'of the single model queried.')
+        start = self._offset or 0
+        stop = None if self._limit is None else start + self._limit
+        if start:
+            # The offset applies to the merged rows, each shard returns all the rows before stop.
+            context = self.offset(None).limit(stop)._compile_context()  # pylint: disable=protected-access
+
+        connections = [self._connection_from_session(mapper=self._mapper_zero(), shard_id=shard_id)
+                       for shard_id in shard_ids]
+        results = list(_SCATTER_POOL.map(
+            lambda connection: connection.execute(context.statement, self._params), connections))
+        rows = []
+        for shard_id, result in zip(shard_ids, results):
+            context.attributes['shard_id'] = context.identity_token = shard_id
+            rows.extend(context.query.instances(result, context))
+
+        if merges:
+            rows = [type(rows[0])([_merge(merge, column)
+                                   for merge, column in zip(merges, zip(*rows))])]
+        # Each shard's rows are sorted already, the stable sort merges those runs.
+        for key, descending in reversed(keys or ()):
+            rows.sort(key=lambda row, key=key: (getattr(row, key) is None, getattr(row, key)),
+                      reverse=descending)
+        return iter(rows[start:stop])
+
+
+class ShardedSession(horizontal_shard.ShardedSession):
+    """ Session routing tenant scoped models to the shard of the session's tenant. """
+    def __init__(self, **kwargs):
+        super().__init__(shard_chooser=self._shard_chooser, id_chooser=self._id_chooser,
+                         query_chooser=self._query_chooser, query_cls=ScatterGatherQuery, **kwargs)
+
+    def get_bind(self, mapper=None, shard_id=None, instance=None, clause=None, **kw):  # pylint: disable=arguments-differ
+        if shard_id is None:
+            shard_id = self._choose_shard_and_assign(mapper, instance, clause=clause)
+        if self.info.get(READ_ONLY) and shard_id in REPLICAS:
+            return REPLICAS[shard_id]
+        return SHARDS[shard_id]
+
+    def _shard_chooser(self, mapper, instance, clause=None):  # pylint: disable=unused-argument
+        """
+        :return str: Shard to write instance to, or run a statement for mapper on.
+        """
+        if not _is_tenant_scoped(mapper):
+            return DEFAULT_SHARD
+        tenant_id = getattr(instance, 'tenant_id', None)
+        if tenant_id is None:
+            tenant_id = self.info.get(TENANT_ID)
+        return shard_for(tenant_id)
+
+    def _id_chooser(self, query, ident):  # pylint: disable=unused-argument
+        """
+        :return list(str): Shards that may have the model with the primary key ident.
+        """
+        return self._query_chooser(query)
+
+    def _query_chooser(self, query):
+        """
+        :return list(str): Shards to run query on.
+        """
+        # Aggregates of a query's rows, like count(), select from the query as a subquery.
+        if not any(_is_tenant_scoped(description['entity'])
+                   for description in query.column_descriptions) and \
+                not any('tenant_id' in table.c for selectable in query._from_obj  # pylint: disable=protected-access
+                        for table in sql_util.find_tables(selectable)):
+            return [DEFAULT_SHARD]
+        tenant_id = self.info.get(TENANT_ID)
+        if tenant_id is None:
+            return list(SHARDS)
+        return [shard_for(tenant_id)]
+
+
+@sqlalchemy.event.listens_for(ShardedSession, 'after_begin')
+def _begin_read_only(session, transaction, connection):  # pylint: disable=unused-argument
+    """ Start the transactions of read only sessions as READ ONLY, DEFERRABLE when serializable. """
+    if READ_ONLY not in session.info or connection.dialect.name != 'postgresql':
+        return
+    options = connection._execution_options  # pylint: disable=protected-access
+    level = options.get('isolation_level', connection.dialect.default_isolation_level)
+    # A deferrable serializable read waits for a safe snapshot, then never fails to serialize.
+    deferrable = level == 'SERIALIZABLE'
+    dbapi_connection = connection.connection.connection
+    if connection.dialect.driver == 'psycopg2' and dbapi_connection.get_transaction_status() == \
+            connection.dialect.dbapi.extensions.TRANSACTION_STATUS_IDLE:
+        # Sent with the BEGIN psycopg2 issues before the first statement, saving a round trip.
+        dbapi_connection.readonly = True
+        dbapi_connection.deferrable = deferrable or None
+    else:
+        connection.execute('SET TRANSACTION READ ONLY' + (' DEFERRABLE' if deferrable else ''))
+
 def _init():
     """
     Initalize the FACTORY constant
     :return sqlalchemy.orm.scoped_session: contextual/thread local session factory.
     """
-    factory = scoped_session(sessionmaker(bind=ENGINE))
+    for engine in list(SHARDS.values()) + list(REPLICAS.values()):
+        _track(engine)
+    factory = scoped_session(sessionmaker(class_=ShardedSession))
     env_name = {'dev': '\033[0;32mDEV\033[0m',
                 'stage': '\033[1;33mSTAGE\033[0m',
                 'prod': '\033[4;31mPROD\033[0m'}.get(ENV)
@@ -98,6 +531,49 @@ def query(entity):
     logger.debug('Query Entity: %r.', entity)
     return FACTORY.query(entity)  # pylint: disable=no-member
 
+@contextlib.contextmanager
+def read_only(replica=True):
+    """
+    Make the current session read only for the block, for safe requests. It doesn't autoflush, its
+    transactions are READ ONLY on PostgreSQL, and with replica they go to the shard's replica. Enter
+    before the session's first query, the transaction running then isn't changed. On exit the
+    transaction is released, or rolled back on errors, and the session is read write again.
+    :param bool replica: Read from the replicas in REPLICAS.
+    :yield sqlalchemy.orm.session.Session: The read only session
+    """
+    session = FACTORY()
+    if READ_ONLY in session.info:
+        yield session  # Already read only.
+        return
+    autoflush, session.autoflush = session.autoflush, False
+    session.info[READ_ONLY] = replica
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    else:
+        release()
+    finally:
+        session.autoflush = autoflush
+        del session.info[READ_ONLY]
+
+def release():
+    """
+    End the current transaction, returning its connections to the pools, without expiring the
+    loaded models like commit does. Reads call it once their rows are loaded, so connections aren't
+    held while the response is serialized. Loading anything else afterwards checks a connection
+    out again.
+    """
+    logger = logging.getLogger(__name__)
+    logger.debug('Release Session Connections: %r.', FACTORY)
+    session = FACTORY()
+    expire_on_commit, session.expire_on_commit = session.expire_on_commit, False
+    try:
+        session.commit()
+    finally:
+        session.expire_on_commit = expire_on_commit
+
 def rollback():
     """ Rollback the current session from DB. """
     logger = logging.getLogger(__name__)
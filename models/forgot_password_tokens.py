@@ -26,6 +26,11 @@ class ForgotPasswordTokens(bases.BaseModel):
 
     login = saorm.relationship('Logins')
 
+    # Expired tokens are swept in (expiration_dt, id) order by models.maintenance.
+    __table_args__ = (sa.Index('ix_forgot_password_tokens_expiration_dt', 'expiration_dt', 'id'),)
+    # Tokens are only valid for 3 days, their history isn't needed much longer.
+    __versioned__ = {'retention': {'days': 30}}
+
     def __init__(self, *args, **kwargs):
         if 'token' not in kwargs:
             kwargs['token'] = self._gen_token()
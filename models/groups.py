@@ -16,5 +16,7 @@ from . import bases
 class Groups(bases.BaseModel):
     """ Collection of Profiles for users in the app. """
     name = sa.Column(sa.String(100), nullable=False)
+    # Kept in step with memberships by the triggers in models.memberships, never set it directly.
+    member_count = sa.Column(sa.Integer, nullable=False, server_default='0')
 
     memberships = saorm.relationship('Memberships', back_populates='group')
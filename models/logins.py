@@ -10,14 +10,39 @@ except ImportError:
     import sys
     print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
 
-import bcrypt
+import logging
+import os
+
 import sqlalchemy as sa
 from sqlalchemy.ext.hybrid import hybrid_property
 import sqlalchemy.orm as saorm
 
-from common import utilities
+from common import background, hashing, throttle, utilities
 from . import bases
 from . import db
+from . import password_histories
+
+
+# Number of most recent passwords, including the current one, that can't be reused.
+PASSWORD_HISTORY_DEPTH = int(os.environ.get('PASSWORD_HISTORY_DEPTH', 5))
+# Upgraded password hashes waiting for Logins.flush_rehashes, (old hash, new hash) by login id.
+REHASHES = background.CoalescingBuffer()
+
+
+def check_password_policy(password, email=None):
+    """
+    Password rules that don't depend on a Login's history, shared with bulk imports.
+    Requirements: https://blog.codinghorror.com/password-rules-are-bullshit/
+    :param str password: New password
+    :param str email: Email address of the Login, if known.
+    :raises ValueError: Password doesn't meet the requirements.
+    """
+    if len(password) < 10:
+        raise ValueError('Minimum password length is 10 characters.')
+    if email and password.lower() == email.lower():
+        raise ValueError('Using email as password forbidden')
+    if utilities.is_common_password(password):
+        raise ValueError('Commong passwords are forbidden')
 
 
 class Logins(bases.BaseModel):
@@ -35,16 +60,40 @@ class Logins(bases.BaseModel):
     # chars)
     _password = sa.Column(sa.LargeBinary, nullable=False)
 
+    __table_args__ = (sa.Index('ix_logins_email_lower', sa.func.lower(email)),)
+
     profile = saorm.relationship('Profiles', back_populates='login')
+    password_history = saorm.relationship('PasswordHistories', back_populates='login',
+                                          order_by='PasswordHistories.id',
+                                          cascade='all, delete-orphan')
 
     @classmethod
     def get_by_email(cls, email):
         """
-        Lookup Logins by email address.
+        Lookup Logins by email address, ignoring case. Uses the ix_logins_email_lower index.
         :param str email: email address to lookup
         :return Logins: Matching Login or None
         """
-        return db.query(cls).filter(cls.email == email).one_or_none()
+        return db.query(cls).filter(sa.func.lower(cls.email) == email.lower()).one_or_none()
+
+    @classmethod
+    def authenticate(cls, email, password, remote_addr=None):
+        """
+        Find the enabled Login for email and check the password. The attempt is counted against the
+        email and client IP throttles first, so throttled attempts cost no bcrypt work.
+        :param str email: email address to login as
+        :param str password: Password to check
+        :param str remote_addr: IP address of the client, if known.
+        :return Logins: Matching Login or None when the email or password is wrong.
+        :raises common.throttle.ThrottledError: Too many recent attempts for the email or client IP.
+        :raises common.hashing.HasherBusyError: Too many passwords are being checked right now.
+        """
+        throttle.check_login(email, remote_addr)
+        login = cls.get_by_email(email)
+        if login is None or not login.enabled or not login.is_valid_password(password):
+            return None
+        throttle.reset_login(email)
+        return login
 
     def is_valid_password(self, password):
         """
@@ -57,8 +106,87 @@ class Logins(bases.BaseModel):
 
         :param str password: Password to compare to Login's hash
         :return bool: Password matches
+        :raises common.hashing.HasherBusyError: Too many passwords are being checked right now.
+        """
+        valid = self.verify_password(password).result()
+        if valid and hashing.HASHER.needs_rehash(self._password):
+            self._schedule_rehash(password)
+        return valid
+
+    def _schedule_rehash(self, password):
+        """
+        Hash the password again with the current cost on the hashing pool, and queue the new hash
+        for flush_rehashes so the login request doesn't wait for it or write it.
+        :param str password: The verified password
+        """
+        logger = logging.getLogger(__name__)
+        if self.id is None:
+            return
+
+        login_id = self.id
+        old_hash = self._password
+        try:
+            future = hashing.HASHER.hash(password)
+        except hashing.HasherBusyError:
+            logger.debug('Hashing pool busy, rehash of login %s skipped.', login_id)
+            return
+
+        def _queue(work):
+            """ Queue the new hash once it has been computed. """
+            if work.exception() is None:
+                REHASHES.put(login_id, (old_hash, work.result()))
+        future.add_done_callback(_queue)
+
+    @classmethod
+    def flush_rehashes(cls):
+        """
+        Write the queued password hash upgrades. A hash is only replaced if the password hasn't
+        been changed since it was verified. Rehashes are put back in the queue if the write fails.
+        :return int: Number of logins updated.
+        """
+        logger = logging.getLogger(__name__)
+        rehashes = REHASHES.drain()
+        if not rehashes:
+            return 0
+
+        table = cls.__table__
+        statement = table.update()\
+            .where(table.c.id == sa.bindparam('login_id'))\
+            .where(table.c._password == sa.bindparam('old_hash'))\
+            .values(_password=sa.bindparam('new_hash'))
+        params = [{'login_id': login_id, 'old_hash': old_hash, 'new_hash': new_hash}
+                  for login_id, (old_hash, new_hash) in rehashes.items()]
+        try:
+            # Use a connection of our own so the caller's session transaction is left alone.
+            with db.ENGINE.begin() as connection:
+                updated = connection.execute(statement, params).rowcount
+        except Exception:
+            REHASHES.restore(rehashes)
+            raise
+
+        logger.info('Upgraded %d of %d queued password hashes.', updated, len(params))
+        return updated
+
+    @classmethod
+    def start_rehash_flusher(cls, interval=5):
+        """
+        Flush password hash upgrades on a daemon thread in this process.
+        :param float interval: Seconds between flushes.
+        :return common.background.PeriodicThread: Started thread, call stop() to end it.
+        """
+        thread = background.PeriodicThread(cls.flush_rehashes, interval, name='login-rehashes',
+                                           run_on_stop=True)
+        thread.start()
+        return thread
+
+    def verify_password(self, password):
+        """
+        Check the password against the Login's hash on the hashing pool without waiting for it.
+        :param str password: Password to compare to Login's hash
+        :return concurrent.futures.Future: Resolves to True if the password matches.
+        :raises common.hashing.HasherBusyError: Too many passwords are being checked right now.
         """
-        return bcrypt.checkpw(password.encode('utf8'), self._password)
+        return hashing.HASHER.verify(password, self._password)
 
     @hybrid_property
     def password(self):
@@ -68,30 +196,46 @@ class Logins(bases.BaseModel):
     @password.setter
     def password(self, value):
         """
-        Ensure that passwords are always stored hashed and salted.
-        Requirements: https://blog.codinghorror.com/password-rules-are-bullshit/
+        Ensure that passwords are always stored hashed and salted, and meet check_password_policy.
+        The last PASSWORD_HISTORY_DEPTH passwords can't be reused, those hashes are checked in
+        parallel on the hashing pool.
         :param str value: New password for login
+        :raises ValueError: Password doesn't meet the requirements.
         """
-        if len(value) < 10:
-            raise ValueError('Minimum password length is 10 characters.')
-        if self.email and value.lower() == self.email.lower():
-            raise ValueError('Using email as password forbidden')
-        if utilities.is_common_password(value):
-            raise ValueError('Commong passwords are forbidden')
+        check_password_policy(value, self.email)
+        if self._password is not None and PASSWORD_HISTORY_DEPTH > 0:
+            history = self.password_history[1 - PASSWORD_HISTORY_DEPTH:] \
+                if PASSWORD_HISTORY_DEPTH > 1 else []
+            recent = [self._password] + [old._password for old in history]  # pylint: disable=protected-access
+            if hashing.HASHER.verify_any(value, recent):
+                raise ValueError('Reusing a recent password is forbidden')
 
         # When a login is first created, give them a salt
-        self._password = bcrypt.hashpw(value.encode('utf8'), bcrypt.gensalt())
+        new_hash = hashing.HASHER.hash(value).result()
+        if self._password is not None and PASSWORD_HISTORY_DEPTH > 1:
+            # Oldest first, appending keeps the ids of new rows in the same order when flushed.
+            self.password_history.append(password_histories.PasswordHistories(
+                _password=self._password))
+            # Older history is no longer needed, delete-orphan removes it from the DB.
+            del self.password_history[:1 - PASSWORD_HISTORY_DEPTH]
+        self._password = new_hash
 
     @saorm.validates('email')
     def validate_email(self, key, address):  # pylint: disable=unused-argument,no-self-use
         """
         No need to validate email here as it is a foreign key to the validated email in Profiles.
-        But we do want to make sure that the password and email don't match.
+        But we do want to make sure that the password and email don't match, that is checked with
+        bcrypt. Except when the flush copies the email of a saved Login's Profile into it, after
+        the ON UPDATE CASCADE, Profiles.change_email did the check already and bulk email updates
+        cost no bcrypt work.
         :param str key: name of the field to validate.
         :param str address: email address
         :return str: the email address
         :raises ValueError: Invalid email
         """
-        if self._password and self.is_valid_password(address):
+        state = sa.inspect(self)
+        cascaded = state.has_identity and state.session is not None and \
+            state.session._flushing  # pylint: disable=protected-access
+        if self._password and not cascaded and self.is_valid_password(address):
             raise ValueError('Using email as password forbidden')
         return address
@@ -0,0 +1,831 @@
+"""
+Database maintenance jobs for models. Each job works in small batches with short transactions so it
+can run alongside API traffic, either from the command line or on a thread inside a worker.
+
+Example Usage:
+$ ENV=stage python -m models.maintenance sweep-tokens --batch-size 500 --pause 0.1
+$ ENV=stage python -m models.maintenance token-indexes
+$ ENV=stage python -m models.maintenance membership-indexes
+$ ENV=stage python -m models.maintenance member-counts --batch-size 1000
+$ ENV=dev python -m models.maintenance bench-memberships --rows 1000000 --groups 1000
+$ ENV=dev python -m models.maintenance bench-tenants --tenants 10 100 1000 --rows-per-tenant 100
+$ ENV=stage python -m models.maintenance email-indexes
+$ ENV=stage python -m models.maintenance explain-email someone@example.com
+$ ENV=stage python -m models.maintenance search-indexes
+$ ENV=dev python -m models.maintenance bench-search --rows 100000 --target-ms 50
+$ ENV=stage python -m models.maintenance drop-password-fingerprints
+$ ENV=stage python -m models.maintenance move-tenant 42 big --batch-size 1000
+$ ENV=stage python -m models.maintenance purge-tenant 42 default --batch-size 1000
+$ ENV=stage python -m models.maintenance history-indexes
+$ ENV=stage python -m models.maintenance sync-indexes
+$ ENV=stage python -m models.maintenance version-counters
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import argparse
+import datetime
+import json
+import logging
+import random
+import statistics
+import sys
+import time
+import uuid
+
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+from sqlalchemy.ext.declarative import declarative_base
+import sqlalchemy_continuum
+
+from common import background, log
+from . import authentication_tokens, forgot_password_tokens, groups, logins, memberships, profiles
+from . import bases
+from . import db
+from . import tenancy
+
+
+TOKEN_MODELS = (authentication_tokens.AuthenticationTokens,
+                forgot_password_tokens.ForgotPasswordTokens)
+# Case insensitive email indexes used by get_by_email.
+EMAIL_MODELS = (profiles.Profiles, logins.Logins)
+
+
+def sweep_expired(model, batch_size=500, pause=0.1, now=None):
+    """
+    Delete expired rows of a token model in batches ordered by (expiration_dt, id). Every batch is
+    its own transaction so row locks are only held briefly. The keyset on (expiration_dt, id) lets
+    each batch start after the last deleted row instead of re-reading dead index entries that have
+    not been vacuumed yet.
+    :param bases.BaseModel.__class__ model: Model with an indexed expiration_dt column.
+    :param int batch_size: Number of rows to delete per transaction.
+    :param float pause: Seconds to sleep between batches to throttle the load on the DB.
+    :param datetime.datetime now: Delete rows that expired before this time, default utcnow.
+    :return dict: rows deleted, seconds elapsed and rows_per_sec
+    """
+    logger = logging.getLogger(__name__)
+    now = now or datetime.datetime.utcnow()
+    start = time.perf_counter()
+    deleted = 0
+    last_key = None
+    while True:
+        query = db.query(model).with_entities(model.expiration_dt, model.id)\
+            .filter(model.expiration_dt < now)
+        if last_key is not None:
+            query = query.filter(sa.tuple_(model.expiration_dt, model.id) > sa.tuple_(*last_key))
+        batch = query.order_by(model.expiration_dt, model.id).limit(batch_size).all()
+        if not batch:
+            break
+
+        ids = [row.id for row in batch]
+        deleted += db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        last_key = tuple(batch[-1])
+
+        if len(batch) < batch_size:
+            break
+        time.sleep(pause)
+
+    elapsed = time.perf_counter() - start
+    stats = {'rows': deleted, 'seconds': elapsed,
+             'rows_per_sec': deleted / elapsed if elapsed else 0.0}
+    logger.info('Swept %d expired %s in %.2fs (%.0f rows/sec).', deleted, model.__tablename__,
+                elapsed, stats['rows_per_sec'])
+    return stats
+
+def sweep_expired_tokens(batch_size=500, pause=0.1):
+    """
+    Sweep expired AuthenticationTokens and ForgotPasswordTokens. Closes the session when done so
+    it is safe to call repeatedly from a background thread.
+    :param int batch_size: Number of rows to delete per transaction.
+    :param float pause: Seconds to sleep between batches.
+    :return dict: Stats from sweep_expired by table name.
+    """
+    try:
+        return {model.__tablename__: sweep_expired(model, batch_size=batch_size, pause=pause)
+                for model in TOKEN_MODELS}
+    finally:
+        db.close()
+
+def start_token_sweeper(interval=300, batch_size=500, pause=0.1):
+    """
+    Schedule sweep_expired_tokens on a daemon thread in this process.
+    :param float interval: Seconds between sweeps.
+    :param int batch_size: Number of rows to delete per transaction.
+    :param float pause: Seconds to sleep between batches.
+    :return common.background.PeriodicThread: Started thread, call stop() to end it.
+    """
+    thread = background.PeriodicThread(sweep_expired_tokens, interval, name='token-sweeper',
+                                       kwargs={'batch_size': batch_size, 'pause': pause})
+    thread.start()
+    return thread
+
+def _create_indexes(indexes):
+    """
+    Build the indexes on plain columns that don't exist yet with CREATE INDEX CONCURRENTLY, so
+    PostgreSQL fills them from the existing rows without blocking writes.
+    :param list(sqlalchemy.schema.Index) indexes: Indexes from the models' tables
+    :return list(str): Names of the indexes created.
+    """
+    logger = logging.getLogger(__name__)
+    created = []
+    with db.ENGINE.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        for index in indexes:
+            if connection.scalar(sa.select([sa.func.to_regclass(index.name)])) is not None:
+                continue
+            unique = 'UNIQUE ' if index.unique else ''
+            columns = ', '.join(column.name for column in index.columns)
+            start = time.perf_counter()
+            connection.execute(f'CREATE {unique}INDEX CONCURRENTLY {index.name} '
+                               f'ON {index.table.name} ({columns})')
+            logger.info('Created %s in %.2fs.', index.name, time.perf_counter() - start)
+            created.append(index.name)
+    return created
+
+def create_token_indexes():
+    """
+    Add the (expiration_dt, id) indexes used by sweep_expired to existing token tables. Without
+    them every sweep batch scans the whole table.
+    :return list(str): Names of the indexes created.
+    """
+    return _create_indexes([index for model in TOKEN_MODELS for index in model.__table__.indexes
+                            if index.name == f'ix_{model.__tablename__}_expiration_dt'])
+
+def create_history_indexes():
+    """
+    Add the indexes used by BaseModel.history to existing version and transaction tables, then
+    drop the transaction_id indexes of the version tables they replace.
+    :return list(str): Names of the indexes created.
+    """
+    saorm.configure_mappers()  # Builds the version tables and their indexes.
+    manager = sqlalchemy_continuum.versioning_manager
+    tables = [version.__table__ for version in manager.version_class_map.values()]
+    tables.append(manager.transaction_cls.__table__)
+    created = _create_indexes([index for table in sorted(tables, key=lambda table: table.name)
+                               for index in sorted(table.indexes, key=lambda index: index.name)
+                               if index.name.endswith(('_transaction_id_id', '_transaction_id',
+                                                       '_issued_at'))])
+    with db.ENGINE.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        for table in tables[:-1]:
+            connection.execute(f'DROP INDEX CONCURRENTLY IF EXISTS ix_{table.name}_transaction_id')
+    return created
+
+def create_sync_indexes():
+    """
+    Add the (modified_at, id) indexes used by the sync endpoints to the existing tables of
+    versioned models.
+    :return list(str): Names of the indexes created.
+    """
+    tables = bases.Base.metadata.sorted_tables  # pylint: disable=no-member
+    return _create_indexes([index for table in tables for index in table.indexes
+                            if index.name == f'ix_{table.name}_modified_at_id'])
+
+def install_version_counters():
+    """
+    Add the version_id counter of optimistic concurrency to the existing tables of the models, and
+    to their version tables. Existing rows start at version 1. Run native-versioning of
+    models.versioning_maintenance again afterwards when the versions are written by triggers.
+    :return list(str): Names of the tables the column was added to.
+    """
+    logger = logging.getLogger(__name__)
+    added = []
+    with db.ENGINE.begin() as connection:
+        for table in bases.Base.metadata.sorted_tables:  # pylint: disable=no-member
+            if 'version_id' not in table.c or connection.scalar(
+                    "SELECT count(*) FROM information_schema.columns "
+                    f"WHERE table_name = '{table.name}' AND column_name = 'version_id'"):
+                continue
+            not_null = '' if table.c.version_id.nullable else ' NOT NULL DEFAULT 1'
+            connection.execute(f'ALTER TABLE {table.name} ADD COLUMN version_id integer{not_null}')
+            logger.info('Added %s.version_id.', table.name)
+            added.append(table.name)
+    return added
+
+def delete_duplicate_memberships():
+    """
+    Delete all but the first of Memberships of a Profile in the same Group, so the unique index
+    can be built.
+    :return int: Number of duplicates deleted.
+    """
+    with db.ENGINE.begin() as connection:
+        return connection.execute(
+            'DELETE FROM memberships AS duplicate USING memberships AS first '
+            'WHERE duplicate.group_id = first.group_id '
+            'AND duplicate.profile_id = first.profile_id AND duplicate.id > first.id').rowcount
+
+def create_membership_indexes():
+    """
+    Add the (group_id, profile_id) unique index and the (profile_id, group_id) index to an existing
+    memberships table, deleting duplicate Memberships first.
+    :return list(str): Names of the indexes created.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info('Deleted %d duplicate memberships.', delete_duplicate_memberships())
+    return _create_indexes(sorted(memberships.Memberships.__table__.indexes,
+                                  key=lambda index: index.name))
+
+def install_member_counts():
+    """
+    Add groups.member_count and its triggers to an existing database. Run reconcile_member_counts
+    afterwards to fill in the counts.
+    :return bool: The column was added.
+    """
+    logger = logging.getLogger(__name__)
+    with db.ENGINE.begin() as connection:
+        added = connection.scalar(
+            "SELECT count(*) FROM information_schema.columns "
+            "WHERE table_name = 'groups' AND column_name = 'member_count'") == 0
+        if added:
+            connection.execute(
+                'ALTER TABLE groups ADD COLUMN member_count integer NOT NULL DEFAULT 0')
+            logger.info('Added groups.member_count.')
+        memberships.create_member_count_triggers(connection)
+    return added
+
+def reconcile_member_counts(batch_size=1000, pause=0.1):
+    """
+    Recompute groups.member_count from memberships, batch_size Groups per transaction, to correct
+    counts that drifted, e.g. memberships changed while the triggers were disabled. Each batch
+    locks its Groups the way the triggers do, so Memberships changed concurrently are counted
+    exactly once.
+    :param int batch_size: Groups recounted per transaction.
+    :param float pause: Seconds to sleep between batches, to leave room for other writers.
+    :return dict: groups recounted, fixed counts, groups_per_sec
+    """
+    logger = logging.getLogger(__name__)
+    stats = {'groups': 0, 'fixed': 0}
+    last_id = 0
+    start = time.perf_counter()
+    while True:
+        with db.ENGINE.begin() as connection:
+            group_ids = [row[0] for row in connection.execute(
+                sa.text('SELECT id FROM groups WHERE id > :last_id '
+                        'ORDER BY id LIMIT :batch_size FOR NO KEY UPDATE'),
+                last_id=last_id, batch_size=batch_size)]
+            if not group_ids:
+                break
+            stats['fixed'] += connection.execute(sa.text(
+                'UPDATE groups SET member_count = counts.member_count, modified_at = now() '
+                'FROM (SELECT groups.id, count(memberships.id) AS member_count FROM groups '
+                'LEFT JOIN memberships ON memberships.group_id = groups.id '
+                'WHERE groups.id = ANY(:group_ids) GROUP BY groups.id) AS counts '
+                'WHERE groups.id = counts.id AND groups.member_count <> counts.member_count'),
+                group_ids=group_ids).rowcount
+        stats['groups'] += len(group_ids)
+        last_id = group_ids[-1]
+        if len(group_ids) < batch_size:
+            break
+        time.sleep(pause)
+    elapsed = time.perf_counter() - start
+    stats['groups_per_sec'] = stats['groups'] / elapsed if elapsed else 0.0
+    logger.info('Recounted %(groups)d groups, fixed %(fixed)d, %(groups_per_sec).0f groups/s.',
+                stats)
+    return stats
+
+def email_case_conflicts():
+    """
+    Find Profiles with email addresses that only differ by case. They have to be merged by hand
+    before the unique ix_profiles_email_lower index can be created.
+    :return list(list(str)): Conflicting email addresses, grouped.
+    """
+    lower_email = sa.func.lower(profiles.Profiles.email)
+    rows = db.query(profiles.Profiles)\
+        .with_entities(sa.func.array_agg(profiles.Profiles.email))\
+        .group_by(lower_email).having(sa.func.count() > 1).order_by(lower_email).all()
+    return [sorted(row[0]) for row in rows]
+
+def _email_index(model):
+    """
+    :param bases.BaseModel.__class__ model: Profiles or Logins
+    :return sqlalchemy.schema.Index: The lower(email) index of model
+    """
+    return next(index for index in model.__table__.indexes
+                if index.name == f'ix_{model.__tablename__}_email_lower')
+
+def create_email_indexes():
+    """
+    Add the lower(email) indexes to existing Profiles and Logins tables. The indexes are built
+    with CREATE INDEX CONCURRENTLY, so PostgreSQL fills them from the existing rows without
+    blocking writes, and indexes that already exist are skipped.
+    :return list(str): Names of the indexes created.
+    :raises ValueError: Emails that only differ by case have to be resolved first.
+    """
+    logger = logging.getLogger(__name__)
+    conflicts = email_case_conflicts()
+    db.close()
+    if conflicts:
+        raise ValueError(f'Emails differing only by case must be merged first: {conflicts}')
+
+    created = []
+    with db.ENGINE.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        for model in EMAIL_MODELS:
+            index = _email_index(model)
+            if connection.scalar(sa.select([sa.func.to_regclass(index.name)])) is not None:
+                continue
+            unique = 'UNIQUE ' if index.unique else ''
+            start = time.perf_counter()
+            connection.execute(f'CREATE {unique}INDEX CONCURRENTLY {index.name} '
+                               f'ON {model.__tablename__} (lower(email))')
+            logger.info('Created %s in %.2fs.', index.name, time.perf_counter() - start)
+            created.append(index.name)
+    return created
+
+def explain_email_lookup(model, email, seqscan=True):
+    """
+    Query plan for get_by_email, to check the lower(email) index is used.
+    :param bases.BaseModel.__class__ model: Profiles or Logins
+    :param str email: email address to lookup
+    :param bool seqscan: Let the planner pick a table scan, turn off for tiny dev tables where a
+                         table scan is cheaper than any index.
+    :return list(str): Lines of the EXPLAIN output.
+    """
+    query = db.query(model).filter(sa.func.lower(model.email) == email.lower())
+    statement = query.statement.compile(dialect=db.ENGINE.dialect)
+    with db.ENGINE.begin() as connection:
+        if not seqscan:
+            connection.execute('SET LOCAL enable_seqscan = off')
+        rows = connection.execute(f'EXPLAIN {statement}', statement.params)
+        return [row[0] for row in rows]
+
+def create_search_indexes():
+    """
+    Install pg_trgm and add the indexes used by Profiles.search to an existing profiles table,
+    without blocking writes. Run as a role that may create extensions. New tables only get them
+    from create_all when pg_trgm is already installed. The prefix indexes are in the model.
+    :return list(str): Names of the indexes created, [] when pg_trgm isn't available.
+    """
+    logger = logging.getLogger(__name__)
+    created = []
+    with db.ENGINE.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        if not profiles.has_trigram(connection):
+            logger.warning('pg_trgm is not available, search will scan the profiles table.')
+            return created
+        connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for name, column in profiles.TRIGRAM_INDEXES:
+            if connection.scalar(sa.select([sa.func.to_regclass(name)])) is not None:
+                continue
+            start = time.perf_counter()
+            connection.execute(profiles.trigram_index_sql(name, column, concurrently=True))
+            logger.info('Created %s in %.2fs.', name, time.perf_counter() - start)
+            created.append(name)
+    return created
+
+def benchmark_profile_search(rows=100000, queries=200, target_ms=50.0, batch_size=5000):
+    """
+    Time Profiles.search against rows generated Profiles. The generated Profiles all use the
+    bench.invalid email domain and are deleted afterwards.
+    :param int rows: Number of Profiles to generate.
+    :param int queries: Number of searches to time, half prefix and half substring.
+    :param float target_ms: p95 latency target in milliseconds.
+    :param int batch_size: Profiles inserted per statement.
+    :return dict: rows, queries, target_ms, trigram when the pg_trgm indexes exist, p50 and p95
+                  ms for prefix and substring searches, ok when both p95 are within target_ms
+    """
+    table = profiles.Profiles.__table__
+    names = [uuid.uuid4().hex for _ in range(rows)]
+    try:
+        for offset in range(0, rows, batch_size):
+            db.ENGINE.execute(table.insert(), [
+                {'full_name': f'{name[:8]} {name[8:20]}', 'email': f'{name[20:]}@bench.invalid',
+                 'modified_at': datetime.datetime.utcnow()}
+                for name in names[offset:offset + batch_size]])
+        db.ENGINE.execute('ANALYZE profiles')
+
+        timings = {'prefix': [], 'substring': []}
+        for idx in range(queries):
+            name = random.choice(names)
+            kind, term = ('prefix', name[:2]) if idx % 2 else ('substring', name[10:16])
+            start = time.perf_counter()
+            profiles.Profiles.search(term)
+            timings[kind].append((time.perf_counter() - start) * 1000)
+            db.close()
+    finally:
+        db.ENGINE.execute(table.delete().where(table.c.email.like('%@bench.invalid')))
+
+    with db.ENGINE.connect() as connection:
+        trigram = all(connection.scalar(sa.select([sa.func.to_regclass(name)])) is not None
+                      for name, _ in profiles.TRIGRAM_INDEXES)
+    stats = {'rows': rows, 'queries': queries, 'target_ms': target_ms, 'trigram': trigram}
+    for kind, values in timings.items():
+        values.sort()
+        stats[f'{kind}_p50_ms'] = statistics.median(values) if values else 0.0
+        stats[f'{kind}_p95_ms'] = values[max(int(len(values) * 0.95) - 1, 0)] if values else 0.0
+    stats['ok'] = max(stats['prefix_p95_ms'], stats['substring_p95_ms']) <= target_ms
+    return stats
+
+def _percentiles(values):
+    """
+    :param list(float) values: Timings in milliseconds
+    :return tuple(float, float): p50 and p95 of values, 0.0 when there are none.
+    """
+    if not values:
+        return 0.0, 0.0
+    values = sorted(values)
+    return statistics.median(values), values[max(int(len(values) * 0.95) - 1, 0)]
+
+def benchmark_memberships(rows=1000000, group_count=1000, queries=200, batch_size=5000):
+    """
+    Time Memberships.add_many, remove_many and the lookups by Group and by Profile on rows generated
+    Memberships, between group_count generated Groups and rows / group_count generated Profiles.
+    The generated Profiles use the membership-bench.invalid email domain, everything generated is
+    deleted afterwards.
+    :param int rows: Number of Memberships to generate.
+    :param int group_count: Number of Groups to spread them over.
+    :param int queries: Number of lookups to time, of each kind.
+    :param int batch_size: Memberships per statement.
+    :return dict: rows, add_rows_per_sec, readd_rows_per_sec (all conflicts), remove_rows_per_sec,
+                  p50 and p95 ms of the members of a Group and the Groups of a Profile.
+    """
+    group_table = groups.Groups.__table__
+    profile_table = profiles.Profiles.__table__
+    table = memberships.Memberships.__table__
+    profile_count = -(-rows // group_count)
+    now = datetime.datetime.utcnow()
+    tag = uuid.uuid4().hex[:8]
+    stats = {'rows': rows}
+    try:
+        db.ENGINE.execute(group_table.insert(), [
+            {'name': f'membership-bench {tag} {idx}', 'modified_at': now}
+            for idx in range(group_count)])
+        db.ENGINE.execute(profile_table.insert(), [
+            {'full_name': f'Member {idx}', 'email': f'{tag}.{idx}@membership-bench.invalid',
+             'modified_at': now} for idx in range(profile_count)])
+        group_ids = [row[0] for row in db.ENGINE.execute(
+            sa.select([group_table.c.id])
+            .where(group_table.c.name.like(f'membership-bench {tag} %')))]
+        profile_ids = [row[0] for row in db.ENGINE.execute(
+            sa.select([profile_table.c.id])
+            .where(profile_table.c.email.like(f'{tag}.%@membership-bench.invalid')))]
+        pairs = [(group_id, profile_id) for group_id in group_ids
+                 for profile_id in profile_ids][:rows]
+
+        start = time.perf_counter()
+        memberships.Memberships.add_many(pairs, batch_size)
+        db.commit()
+        stats['add_rows_per_sec'] = len(pairs) / (time.perf_counter() - start)
+        db.ENGINE.execute('ANALYZE memberships')
+
+        sample = random.sample(pairs, min(len(pairs), 10 * batch_size))
+        start = time.perf_counter()
+        memberships.Memberships.add_many(sample, batch_size)
+        db.commit()
+        stats['readd_rows_per_sec'] = len(sample) / (time.perf_counter() - start)
+
+        for kind, column, ids in (('group_members', table.c.group_id, group_ids),
+                                  ('profile_groups', table.c.profile_id, profile_ids)):
+            other = table.c.profile_id if column is table.c.group_id else table.c.group_id
+            timings = []
+            for _ in range(queries):
+                query = sa.select([other]).where(column == random.choice(ids))
+                start = time.perf_counter()
+                db.FACTORY.execute(query).fetchall()  # pylint: disable=no-member
+                timings.append((time.perf_counter() - start) * 1000)
+            stats[f'{kind}_p50_ms'], stats[f'{kind}_p95_ms'] = _percentiles(timings)
+        db.close()
+
+        start = time.perf_counter()
+        memberships.Memberships.remove_many(sample, batch_size)
+        db.commit()
+        stats['remove_rows_per_sec'] = len(sample) / (time.perf_counter() - start)
+    finally:
+        db.close()
+        bench_groups = sa.select([group_table.c.id])\
+            .where(group_table.c.name.like(f'membership-bench {tag} %'))
+        db.ENGINE.execute(table.delete().where(table.c.group_id.in_(bench_groups)))
+        db.ENGINE.execute(group_table.delete().where(group_table.c.id.in_(bench_groups)))
+        db.ENGINE.execute(profile_table.delete()
+                          .where(profile_table.c.email.like(f'{tag}.%@membership-bench.invalid')))
+    return stats
+
+_BENCH_BASE = declarative_base()
+
+class _TenantBench(_BENCH_BASE, tenancy.TenantScoped):  # pylint: disable=too-few-public-methods
+    """ Throwaway tenant scoped table for benchmark_tenants. """
+    __tablename__ = 'tenant_bench'
+    id = sa.Column(sa.Integer, primary_key=True)  # pylint: disable=invalid-name
+    name = sa.Column(sa.String(100), nullable=False, index=True)
+
+
+def benchmark_tenants(tenant_counts=(10, 100, 1000), rows_per_tenant=100, queries=200,
+                      batch_size=5000):
+    """
+    Time a tenant's queries as the number of tenants sharing a table grows, with the same number of
+    rows per tenant. With the tenant-leading indexes the timings should stay flat. Uses its own
+    tenant_bench table, dropped afterwards.
+    :param tuple(int) tenant_counts: Increasing numbers of tenants to time.
+    :param int rows_per_tenant: Rows generated for each tenant.
+    :param int queries: Number of queries to time, of each kind, for each tenant count.
+    :param int batch_size: Rows inserted per statement.
+    :return list(dict): For each tenant count: tenants, rows, p50 and p95 ms of listing a tenant's
+                        rows and of looking up one of them by name.
+    """
+    table = _TenantBench.__table__
+    results = []
+    table.create(db.ENGINE)
+    try:
+        tenants = 0
+        for tenant_count in tenant_counts:
+            rows = [{'tenant_id': tenant_id, 'name': uuid.uuid4().hex}
+                    for tenant_id in range(tenants, tenant_count)
+                    for _ in range(rows_per_tenant)]
+            for offset in range(0, len(rows), batch_size):
+                db.ENGINE.execute(table.insert(), rows[offset:offset + batch_size])
+            tenants = tenant_count
+            db.ENGINE.execute('ANALYZE tenant_bench')
+
+            names = [row[0] for row in db.ENGINE.execute(
+                sa.select([table.c.name]).order_by(sa.func.random()).limit(queries))]
+            stats = {'tenants': tenant_count, 'rows': tenant_count * rows_per_tenant}
+            timings = {'list': [], 'lookup': []}
+            session = db.connect()
+            for name in names:
+                tenancy.set_tenant(random.randrange(tenant_count), session)
+                start = time.perf_counter()
+                session.query(_TenantBench).all()
+                timings['list'].append((time.perf_counter() - start) * 1000)
+                start = time.perf_counter()
+                session.query(_TenantBench).filter(_TenantBench.name == name).one_or_none()
+                timings['lookup'].append((time.perf_counter() - start) * 1000)
+                session.expunge_all()
+            db.close()
+            for kind, values in timings.items():
+                stats[f'{kind}_p50_ms'], stats[f'{kind}_p95_ms'] = _percentiles(values)
+            results.append(stats)
+    finally:
+        db.close()
+        table.drop(db.ENGINE)
+    return results
+
+def drop_password_fingerprints():
+    """
+    Drop the logins._password_fingerprint column. Databases created while Logins stored a
+    truncated keyed hash of the password have it, it makes offline guessing cheaper so it must go.
+    :return bool: The column existed and was dropped.
+    """
+    logger = logging.getLogger(__name__)
+    with db.ENGINE.begin() as connection:
+        exists = connection.scalar(
+            "SELECT count(*) FROM information_schema.columns "
+            "WHERE table_name = 'logins' AND column_name = '_password_fingerprint'") > 0
+        if exists:
+            connection.execute('ALTER TABLE logins DROP COLUMN _password_fingerprint')
+            logger.info('Dropped logins._password_fingerprint.')
+    return exists
+
+def tenant_tables():
+    """
+    :return list(sqlalchemy.Table): Tables of the tenant scoped models, referenced tables first.
+    """
+    return [table for table in bases.Base.metadata.sorted_tables if 'tenant_id' in table.c]
+
+def _delete_tenant(engine, tables, tenant_id, batch_size, pause=0.0):
+    """
+    Delete a tenant's rows from a shard, batch_size rows per transaction, referencing tables first.
+    :param sqlalchemy.engine.Engine engine: Shard to delete from
+    :param list(sqlalchemy.Table) tables: Tenant scoped tables
+    :param int tenant_id: Tenant to delete
+    :param int batch_size: Rows deleted per transaction.
+    :param float pause: Seconds to sleep between batches to throttle the load on the DB.
+    :return dict: rows deleted, by table
+    """
+    deleted = {}
+    for table in reversed(tables):
+        key = sa.tuple_(*table.primary_key.columns)
+        batch = sa.select(table.primary_key.columns).where(table.c.tenant_id == tenant_id)\
+            .limit(batch_size)
+        deleted[table.name] = 0
+        while True:
+            rowcount = engine.execute(table.delete().where(key.in_(batch))).rowcount
+            deleted[table.name] += rowcount
+            if rowcount < batch_size:
+                break
+            time.sleep(pause)
+    return deleted
+
+def _sync_sequence(engine, table):
+    """
+    Move the id sequence of a PostgreSQL table past the ids copied into it.
+    :param sqlalchemy.engine.Engine engine: Shard copied to
+    :param sqlalchemy.Table table: Table copied to
+    """
+    if engine.dialect.name != 'postgresql':
+        return
+    engine.execute(sa.text(
+        f"SELECT setval(pg_get_serial_sequence(:table, 'id'), GREATEST(max(id), "
+        f"pg_sequence_last_value(pg_get_serial_sequence(:table, 'id')::regclass), 1)) "
+        f"FROM {table.name}"), table=table.name)
+
+def move_tenant(tenant_id, target, batch_size=1000, pause=0.1):
+    """
+    Copy a tenant to another shard. Copies the tenant's rows of every tenant scoped table with
+    their ids, batch_size rows per transaction, compares the row counts and switches the shard map
+    of this process. The tenant must not be written to during the move. A move that failed can be
+    run again, it starts the copy over. The rows stay on the old shard until purge_tenant deletes
+    them, once the new map is deployed to every process.
+    :param int tenant_id: Tenant to move
+    :param str target: Name of the shard to move to
+    :param int batch_size: Rows copied per transaction.
+    :param float pause: Seconds to sleep between batches to throttle the load on the DBs.
+    :return dict: rows copied, by table, seconds, rows_per_sec
+    :raises sqlalchemy.exc.IntegrityError: ids of the tenant's rows are already used on target.
+    :raises RuntimeError: The copied rows don't match the source's.
+    """
+    logger = logging.getLogger(__name__)
+    source = db.shard_for(tenant_id)
+    source_engine, target_engine = db.SHARDS[source], db.SHARDS[target]
+    stats = {'rows': {}}
+    start = time.perf_counter()
+    if source == target:
+        stats.update(seconds=0.0, rows_per_sec=0.0)
+        return stats
+
+    tables = tenant_tables()
+    # Leftovers of an earlier move that failed.
+    _delete_tenant(target_engine, tables, tenant_id, batch_size)
+    for table in tables:
+        copied = 0
+        # Pages on the whole primary key, e.g. (id, transaction_id) of version tables.
+        key = list(table.primary_key.columns)
+        query = sa.select([table]).where(table.c.tenant_id == tenant_id)\
+            .order_by(*key).limit(batch_size)
+        last = None
+        while True:
+            batch = query if last is None else query.where(sa.tuple_(*key) > sa.tuple_(*last))
+            rows = [dict(row) for row in source_engine.execute(batch)]
+            if not rows:
+                break
+            with target_engine.begin() as connection:
+                connection.execute(table.insert(), rows)
+            copied += len(rows)
+            last = [rows[-1][column.name] for column in key]
+            if len(rows) < batch_size:
+                break
+            time.sleep(pause)
+        _sync_sequence(target_engine, table)
+
+        count = sa.select([sa.func.count()]).select_from(table)\
+            .where(table.c.tenant_id == tenant_id)
+        if target_engine.scalar(count) != source_engine.scalar(count):
+            raise RuntimeError(f'Copy of {table.name} for tenant {tenant_id} is incomplete.')
+        stats['rows'][table.name] = copied
+
+    db.assign_tenant(tenant_id, target)
+
+    elapsed = time.perf_counter() - start
+    total = sum(stats['rows'].values())
+    stats.update(seconds=elapsed, rows_per_sec=total / elapsed if elapsed else 0.0)
+    logger.info('Copied tenant %d from %s to %s, %d rows in %.2fs (%.0f rows/sec).', tenant_id,
+                source, target, total, elapsed, stats['rows_per_sec'])
+    return stats
+
+def purge_tenant(tenant_id, shard, batch_size=1000, pause=0.1):
+    """
+    Delete the rows a tenant left on its old shard after move_tenant. Run it once the shard map
+    routing the tenant to its new shard is deployed, the shard map of this process must have it.
+    :param int tenant_id: Tenant moved
+    :param str shard: Name of the shard the tenant was moved from
+    :param int batch_size: Rows deleted per transaction.
+    :param float pause: Seconds to sleep between batches to throttle the load on the DB.
+    :return dict: rows deleted, by table
+    :raises ValueError: The tenant is still routed to shard.
+    """
+    logger = logging.getLogger(__name__)
+    if db.shard_for(tenant_id) == shard:
+        raise ValueError(f'Tenant {tenant_id} is still on shard {shard}.')
+    deleted = _delete_tenant(db.SHARDS[shard], tenant_tables(), tenant_id, batch_size, pause)
+    logger.info('Purged tenant %d from %s, %d rows.', tenant_id, shard, sum(deleted.values()))
+    return deleted
+
+def main(argv=None):
+    """
+    Command line entry point for maintenance jobs.
+    :param list(str) argv: Arguments, default sys.argv.
+    """
+    log.init_logging()
+
+    parser = argparse.ArgumentParser(prog='python -m models.maintenance', description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    sweep = subparsers.add_parser('sweep-tokens', help='Delete expired authentication and forgot '
+                                                       'password tokens.')
+    sweep.add_argument('--batch-size', type=int, default=500)
+    sweep.add_argument('--pause', type=float, default=0.1, help='Seconds between batches.')
+
+    subparsers.add_parser('token-indexes', help='Create the expiration indexes used by '
+                                                'sweep-tokens.')
+
+    subparsers.add_parser('membership-indexes', help='Delete duplicate memberships and create '
+                                                     'the memberships indexes.')
+
+    member_counts = subparsers.add_parser('member-counts',
+                                          help='Install the group member count triggers and '
+                                               'recompute the counts.')
+    member_counts.add_argument('--batch-size', type=int, default=1000)
+    member_counts.add_argument('--pause', type=float, default=0.1, help='Seconds between batches.')
+
+    bench_memberships = subparsers.add_parser('bench-memberships',
+                                              help='Time bulk membership changes and lookups.')
+    bench_memberships.add_argument('--rows', type=int, default=1000000)
+    bench_memberships.add_argument('--groups', type=int, default=1000)
+    bench_memberships.add_argument('--queries', type=int, default=200)
+
+    bench_tenants = subparsers.add_parser('bench-tenants',
+                                          help='Time per tenant queries as tenants are added.')
+    bench_tenants.add_argument('--tenants', type=int, nargs='+', default=[10, 100, 1000])
+    bench_tenants.add_argument('--rows-per-tenant', type=int, default=100)
+    bench_tenants.add_argument('--queries', type=int, default=200)
+
+    subparsers.add_parser('email-indexes', help='Create the case insensitive email indexes.')
+
+    explain = subparsers.add_parser('explain-email', help='Show the query plans of get_by_email.')
+    explain.add_argument('email')
+    explain.add_argument('--no-seqscan', action='store_true',
+                         help='Disable table scans, for small dev tables.')
+
+    subparsers.add_parser('search-indexes', help='Create the pg_trgm indexes for profile search.')
+
+    bench_search = subparsers.add_parser('bench-search',
+                                         help='Time profile search against generated profiles.')
+    bench_search.add_argument('--rows', type=int, default=100000)
+    bench_search.add_argument('--queries', type=int, default=200)
+    bench_search.add_argument('--target-ms', type=float, default=50.0,
+                              help='p95 latency target in milliseconds.')
+
+    subparsers.add_parser('drop-password-fingerprints',
+                          help='Drop the password fingerprints stored in logins.')
+
+    move = subparsers.add_parser('move-tenant', help='Copy a tenant to another shard.')
+    move.add_argument('tenant_id', type=int)
+    move.add_argument('shard')
+    move.add_argument('--batch-size', type=int, default=1000)
+    move.add_argument('--pause', type=float, default=0.1, help='Seconds between batches.')
+
+    purge = subparsers.add_parser('purge-tenant', help='Delete a moved tenant from its old shard, '
+                                                       'after the new shard map is deployed.')
+    purge.add_argument('tenant_id', type=int)
+    purge.add_argument('shard')
+    purge.add_argument('--batch-size', type=int, default=1000)
+    purge.add_argument('--pause', type=float, default=0.1, help='Seconds between batches.')
+
+    subparsers.add_parser('history-indexes', help='Create the version table indexes used by the '
+                                                  'history endpoints.')
+
+    subparsers.add_parser('sync-indexes', help='Create the (modified_at, id) indexes used by the '
+                                               'sync endpoints.')
+
+    subparsers.add_parser('version-counters', help='Add the version_id columns used for '
+                                                   'optimistic concurrency.')
+
+    args = parser.parse_args(argv)
+    if args.command == 'sweep-tokens':
+        sweep_expired_tokens(batch_size=args.batch_size, pause=args.pause)
+    elif args.command == 'token-indexes':
+        print(create_token_indexes())
+    elif args.command == 'membership-indexes':
+        print(create_membership_indexes())
+    elif args.command == 'member-counts':
+        install_member_counts()
+        print(reconcile_member_counts(batch_size=args.batch_size, pause=args.pause))
+    elif args.command == 'bench-memberships':
+        print(benchmark_memberships(args.rows, args.groups, args.queries))
+    elif args.command == 'bench-tenants':
+        for stats in benchmark_tenants(args.tenants, args.rows_per_tenant, args.queries):
+            print(stats)
+    elif args.command == 'email-indexes':
+        print(create_email_indexes())
+    elif args.command == 'explain-email':
+        for model in EMAIL_MODELS:
+            print('\n'.join(explain_email_lookup(model, args.email, not args.no_seqscan)))
+    elif args.command == 'search-indexes':
+        print(create_search_indexes())
+    elif args.command == 'bench-search':
+        stats = benchmark_profile_search(args.rows, args.queries, args.target_ms)
+        print(stats)
+        if not stats['ok']:
+            sys.exit(1)
+    elif args.command == 'drop-password-fingerprints':
+        print(drop_password_fingerprints())
+    elif args.command == 'move-tenant':
+        print(move_tenant(args.tenant_id, args.shard, args.batch_size, args.pause))
+        # Only this process's map changed, the new map has to be deployed to the API.
+        print('TENANT_SHARDS=' + json.dumps(db.TENANT_SHARDS))
+    elif args.command == 'purge-tenant':
+        print(purge_tenant(args.tenant_id, args.shard, args.batch_size, args.pause))
+    elif args.command == 'history-indexes':
+        print(create_history_indexes())
+    elif args.command == 'sync-indexes':
+        print(create_sync_indexes())
+    elif args.command == 'version-counters':
+        print(install_version_counters())
+
+if __name__ == '__main__':
+    main()
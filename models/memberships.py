@@ -10,13 +10,215 @@ except ImportError:
 
 import sqlalchemy as sa
 import sqlalchemy.orm as saorm
+from sqlalchemy_continuum import Operation
 
 from . import bases
+from . import db
+from . import groups
+
+
+# Memberships written or deleted per statement by the bulk operations.
+BULK_BATCH_SIZE = 5000
+# session.info key for the ids of Profiles whose Memberships changed in the session's transaction.
+CHANGED_PROFILES = 'membership_changed_profiles'
+
+
+def record_changes(session, profile_ids):
+    """
+    Note Profiles whose Memberships changed in the session's transaction, for caches of group sets.
+    :param sqlalchemy.orm.session.Session session: Session making the change
+    :param iterable(int) profile_ids: Profiles gaining or losing Memberships
+    """
+    session.info.setdefault(CHANGED_PROFILES, set()).update(profile_ids)
+
+def expire_member_counts(session, group_ids):
+    """
+    Expire member_count and modified_at of the session's loaded Groups, after the triggers changed
+    them in the database, so they are reloaded when next read.
+    :param sqlalchemy.orm.session.Session session: Session making the change
+    :param set(int) group_ids: Groups gaining or losing Memberships
+    """
+    for instance in list(session.identity_map.values()):
+        if isinstance(instance, groups.Groups) and instance.id in group_ids:
+            session.expire(instance, ['member_count', 'modified_at'])
+
+def changed_profiles(session, clear=False):
+    """
+    :param sqlalchemy.orm.session.Session session: Session to check
+    :param bool clear: Forget the changes, at the end of the transaction.
+    :return set(int): Profiles whose Memberships changed since the transaction began.
+    """
+    if clear:
+        return session.info.pop(CHANGED_PROFILES, set())
+    return session.info.get(CHANGED_PROFILES, set())
+
 
 class Memberships(bases.BaseModel):
     """ Record of Memberships for Profiles in Groups """
     group_id = sa.Column(sa.Integer, sa.ForeignKey('groups.id'), nullable=False)
     profile_id = sa.Column(sa.Integer, sa.ForeignKey('profiles.id'), nullable=False)
 
+    __table_args__ = (
+        # A Profile is in a Group once. Also the index for the members of a Group.
+        sa.Index('ix_memberships_group_id_profile_id', group_id, profile_id, unique=True),
+        # The Groups of a Profile, answered from the index alone.
+        sa.Index('ix_memberships_profile_id_group_id', profile_id, group_id),
+    )
+
     group = saorm.relationship('Groups', back_populates='memberships')
     profile = saorm.relationship('Profiles', back_populates='memberships')
+
+    @classmethod
+    def add_many(cls, pairs, batch_size=BULK_BATCH_SIZE):
+        """
+        Add Memberships in the current session's transaction, skipping ones that already exist
+        (INSERT ... ON CONFLICT DO NOTHING), so concurrent adds can't make duplicates. The ids are
+        sent as two arrays, a statement for any number of rows costs next to nothing to compile.
+        Memberships loaded in the session aren't refreshed.
+        :param iterable(tuple(int, int)) pairs: group_id and profile_id of each Membership.
+        :param int batch_size: Memberships per INSERT statement.
+        :return int: Number of Memberships added.
+        """
+        return cls._bulk(Operation.INSERT, pairs, batch_size)
+
+    @classmethod
+    def remove_many(cls, pairs, batch_size=BULK_BATCH_SIZE):
+        """
+        Delete Memberships in the current session's transaction with set based DELETE statements,
+        ignoring ones that don't exist. Memberships loaded in the session aren't refreshed.
+        :param iterable(tuple(int, int)) pairs: group_id and profile_id of each Membership.
+        :param int batch_size: Memberships per DELETE statement.
+        :return int: Number of Memberships deleted.
+        """
+        return cls._bulk(Operation.DELETE, pairs, batch_size)
+
+    @classmethod
+    def _bulk(cls, operation, pairs, batch_size):
+        """
+        Add or delete Memberships with SQL statements, and write their versions.
+        :param int operation: Operation.INSERT or Operation.DELETE
+        :param iterable(tuple(int, int)) pairs: group_id and profile_id of each Membership.
+        :param int batch_size: Memberships per statement.
+        :return int: Number of rows changed.
+        """
+        pairs = list(dict.fromkeys(pairs))
+        session = db.connect()
+        connection = session.connection()
+        transaction_id = None
+        changed = 0
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            params = {'group_ids': [group_id for group_id, _ in batch],
+                      'profile_ids': [profile_id for _, profile_id in batch]}
+            statement = _ADD_MANY if operation == Operation.INSERT else _LOCK_MANY
+            ids = [row.id for row in connection.execute(statement, params)]
+            transaction_id = bases.write_versions(connection, cls, ids, operation, transaction_id)
+            if operation == Operation.DELETE and ids:
+                connection.execute(_DELETE_IDS, ids=ids)
+            changed += len(ids)
+        record_changes(session, {profile_id for _, profile_id in pairs})
+        expire_member_counts(session, {group_id for group_id, _ in pairs})
+        return changed
+
+
+_ADD_MANY = sa.text(
+    'INSERT INTO memberships (group_id, profile_id, modified_at) '
+    'SELECT group_id, profile_id, now() '
+    'FROM unnest(CAST(:group_ids AS integer[]), CAST(:profile_ids AS integer[])) '
+    'AS pairs (group_id, profile_id) '
+    'ON CONFLICT (group_id, profile_id) DO NOTHING RETURNING id')
+# The Memberships are locked until deleted, so their versions are those of the rows deleted.
+_LOCK_MANY = sa.text(
+    'SELECT memberships.id FROM memberships JOIN '
+    'unnest(CAST(:group_ids AS integer[]), CAST(:profile_ids AS integer[])) '
+    'AS pairs (group_id, profile_id) '
+    'ON memberships.group_id = pairs.group_id AND memberships.profile_id = pairs.profile_id '
+    'ORDER BY memberships.id FOR UPDATE OF memberships')
+_DELETE_IDS = sa.text('DELETE FROM memberships WHERE id = ANY(CAST(:ids AS integer[]))')
+
+# groups.member_count is changed by statement level triggers in the transaction that changes
+# memberships, whether through the ORM, add_many and remove_many, or plain SQL. A bulk statement
+# updates each of its Groups once. The Groups are locked in id order, so transactions changing
+# the same Groups wait for each other instead of deadlocking. The triggers bump modified_at so
+# syncs pick up the new counts, but write no Groups versions, nor change version_id: member_count
+# is derived, the history of the Memberships is its history.
+MEMBER_COUNT_TRIGGERS = ('memberships_member_count_insert', 'memberships_member_count_delete',
+                         'memberships_member_count_update')
+_MEMBER_COUNT_DDL = (
+    """CREATE OR REPLACE FUNCTION memberships_count_members(added integer[], removed integer[])
+    RETURNS void LANGUAGE sql AS $$
+        WITH changes AS (
+            SELECT group_id, sum(delta) AS delta
+            FROM (SELECT unnest(added) AS group_id, 1 AS delta
+                  UNION ALL SELECT unnest(removed), -1) AS deltas
+            GROUP BY group_id HAVING sum(delta) <> 0),
+        locked AS (
+            SELECT id FROM groups WHERE id IN (SELECT group_id FROM changes)
+            ORDER BY id FOR NO KEY UPDATE)
+        UPDATE groups SET member_count = groups.member_count + changes.delta, modified_at = now()
+        FROM changes JOIN locked ON locked.id = changes.group_id
+        WHERE groups.id = changes.group_id
+    $$""",
+    """CREATE OR REPLACE FUNCTION memberships_member_count() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM memberships_count_members(ARRAY(SELECT group_id FROM new_rows), '{}');
+        ELSIF TG_OP = 'DELETE' THEN
+            PERFORM memberships_count_members('{}', ARRAY(SELECT group_id FROM old_rows));
+        ELSE
+            PERFORM memberships_count_members(ARRAY(SELECT group_id FROM new_rows),
+                                              ARRAY(SELECT group_id FROM old_rows));
+        END IF;
+        RETURN NULL;
+    END
+    $$""",
+)
+_MEMBER_COUNT_TRIGGER = ('CREATE TRIGGER {name} AFTER {event} ON memberships '
+                         'REFERENCING {tables} FOR EACH STATEMENT '
+                         'EXECUTE PROCEDURE memberships_member_count()')
+
+
+def create_member_count_triggers(connection):
+    """
+    Create, or replace, the triggers keeping groups.member_count up to date.
+    :param sqlalchemy.engine.Connection connection: Database connection
+    """
+    for statement in _MEMBER_COUNT_DDL:
+        connection.execute(statement)
+    # PostgreSQL only allows transition tables on single event triggers.
+    events = (('INSERT', 'NEW TABLE AS new_rows'), ('DELETE', 'OLD TABLE AS old_rows'),
+              ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'))
+    for name, (event, tables) in zip(MEMBER_COUNT_TRIGGERS, events):
+        connection.execute(f'DROP TRIGGER IF EXISTS {name} ON memberships')
+        connection.execute(_MEMBER_COUNT_TRIGGER.format(name=name, event=event, tables=tables))
+
+
+@sa.event.listens_for(Memberships.__table__, 'after_create')
+def _create_member_count_triggers(target, connection, **kwargs):  # pylint: disable=unused-argument
+    """ Add the member_count triggers when the memberships table is created. """
+    if connection.dialect.name == 'postgresql':
+        create_member_count_triggers(connection)
+
+
+@sa.event.listens_for(saorm.Session, 'after_flush')
+def _record_flushed(session, flush_context):  # pylint: disable=unused-argument
+    """
+    Record the Profiles of Memberships inserted, deleted or moved by the flush, and expire the
+    member counts of their Groups.
+    """
+    profile_ids = set()
+    group_ids = set()
+    for instance in list(session.new) + list(session.deleted) + list(session.dirty):
+        if not isinstance(instance, Memberships):
+            continue
+        # Old and new ids, for Memberships moved between Profiles or Groups.
+        attrs = sa.inspect(instance).attrs
+        profile_ids.update(attrs.profile_id.history.sum())
+        group_ids.update(attrs.group_id.history.sum())
+    profile_ids.discard(None)
+    if profile_ids:
+        record_changes(session, profile_ids)
+    group_ids.discard(None)
+    if group_ids:
+        expire_member_counts(session, group_ids)
@@ -0,0 +1,24 @@
+"""
+Password History resources. Previous password hashes of Logins for password reuse rules.
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+
+from . import bases
+
+
+class PasswordHistories(bases.BaseModel):
+    """ A password hash previously used by a Login. This is not a JSONAPI exposed Model. """
+    login_id = sa.Column(sa.Integer, sa.ForeignKey('logins.id', ondelete='CASCADE'), nullable=False,
+                         index=True)
+    # Same bcrypt hash that was in Logins._password
+    _password = sa.Column(sa.LargeBinary, nullable=False)
+
+    login = saorm.relationship('Logins', back_populates='password_history')
@@ -0,0 +1,257 @@
+"""
+Role based access control resolution. A Profile's permissions come from the Groups it has
+Memberships in, so checks need the Profile's set of group ids. Those are loaded with one index scan
+of memberships (profile_id, group_id), kept as a sorted array of ids, and cached twice:
+
+* per request, in the session's info until the transaction ends, so one request never loads a
+  Profile's groups twice.
+* per process, in a bounded LRU, for PERMISSION_CACHE_TTL seconds.
+
+Changes to Memberships, through the ORM or the Memberships bulk operations, invalidate both caches
+in this process when the transaction commits. Other processes see the change once their cached
+entry is older than PERMISSION_CACHE_TTL.
+
+Example Usage:
+>>> from models import permissions
+>>> permissions.is_member(profile_id, group_id)
+>>> permissions.check_many(profile_id, [document.group_id for document in documents])
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import array
+import bisect
+import collections
+import os
+import threading
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+
+from . import db
+from . import memberships
+
+
+# Profiles whose group sets are kept in each process.
+PERMISSION_CACHE_SIZE = int(os.environ.get('PERMISSION_CACHE_SIZE', 10000))
+# Seconds a process trusts a cached group set, the longest other processes can lag a change.
+PERMISSION_CACHE_TTL = float(os.environ.get('PERMISSION_CACHE_TTL', 10))
+# session.info key for the group sets loaded in the session's request.
+_REQUEST_CACHE = 'permission_group_sets'
+
+
+class GroupSet(object):
+    """ Immutable set of group ids, a sorted array of 8 byte ints. """
+    __slots__ = ('_ids',)
+
+    def __init__(self, group_ids=()):
+        """
+        :param iterable(int) group_ids: Groups the Profile has Memberships in.
+        """
+        self._ids = array.array('q', sorted(set(group_ids)))
+
+    def __contains__(self, group_id):
+        idx = bisect.bisect_left(self._ids, group_id)
+        return idx < len(self._ids) and self._ids[idx] == group_id
+
+    def __eq__(self, other):
+        return isinstance(other, GroupSet) and self._ids == other._ids
+
+    def __hash__(self):
+        return hash(self._ids.tobytes())
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __repr__(self):
+        return f'GroupSet({list(self._ids)!r})'
+
+    def check_many(self, group_ids):
+        """
+        :param list(int) group_ids: Groups to check, for example of the resources in a list.
+        :return list(bool): Membership of each of group_ids, in the same order.
+        """
+        return [group_id in self for group_id in group_ids]
+
+
+class PermissionCache(object):
+    """ Thread safe LRU of GroupSets by Profile id, with entries expiring after ttl seconds. """
+
+    def __init__(self, size=PERMISSION_CACHE_SIZE, ttl=PERMISSION_CACHE_TTL):
+        """
+        :param int size: Most Profiles to keep.
+        :param float ttl: Seconds an entry is used for.
+        """
+        self.size = size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a load that raced one isn't stored.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, profile_id, now=None):
+        """
+        :param int profile_id: Profile to look up.
+        :param float now: Current time.monotonic(), for testing.
+        :return GroupSet: Cached group set, or None if missing or expired.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(profile_id)
+            if entry is None or now - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(profile_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, group_sets, generation, now=None):
+        """
+        Cache loaded group sets, unless there was an invalidation since the load started.
+        :param dict(int, GroupSet) group_sets: Group sets by Profile id.
+        :param int generation: self.generation from before the load.
+        :param float now: Current time.monotonic(), for testing.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if generation != self.generation:
+                return
+            for profile_id, group_set in group_sets.items():
+                self._entries[profile_id] = (now, group_set)
+                self._entries.move_to_end(profile_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, profile_ids=None):
+        """
+        :param iterable(int) profile_ids: Profiles to forget, None forgets everything.
+        """
+        with self._lock:
+            self.generation += 1
+            if profile_ids is None:
+                self._entries.clear()
+                return
+            for profile_id in profile_ids:
+                self._entries.pop(profile_id, None)
+
+    def stats(self):
+        """
+        :return dict: size, entries, hits and misses
+        """
+        with self._lock:
+            return {'size': self.size, 'entries': len(self._entries), 'hits': self.hits,
+                    'misses': self.misses}
+
+
+CACHE = PermissionCache()
+
+
+def _load(session, profile_ids):
+    """
+    :param sqlalchemy.orm.session.Session session: Session of the request
+    :param list(int) profile_ids: Profiles to load
+    :return dict(int, GroupSet): Group sets of every one of profile_ids, empty for no Memberships.
+    """
+    table = memberships.Memberships.__table__
+    rows = session.execute(
+        sa.select([table.c.profile_id, table.c.group_id])
+        .where(table.c.profile_id.in_(sa.bindparam('profile_ids', expanding=True)))
+        .order_by(table.c.profile_id, table.c.group_id),
+        {'profile_ids': list(profile_ids)}).fetchall()
+    groups_by_profile = {profile_id: [] for profile_id in profile_ids}
+    for profile_id, group_id in rows:
+        groups_by_profile[profile_id].append(group_id)
+    return {profile_id: GroupSet(group_ids) for profile_id, group_ids in groups_by_profile.items()}
+
+def group_sets(profile_ids):
+    """
+    Group sets of several Profiles, loading any that aren't cached with a single query.
+    :param iterable(int) profile_ids: Profiles to resolve
+    :return dict(int, GroupSet): Group sets by Profile id.
+    """
+    session = db.connect()
+    request_cache = session.info.setdefault(_REQUEST_CACHE, {})
+    # Changes made in this transaction aren't committed, nor cached, yet.
+    changed = memberships.changed_profiles(session)
+    found = {}
+    missing = []
+    for profile_id in set(profile_ids):
+        group_set = None
+        if profile_id not in changed:
+            group_set = request_cache.get(profile_id)
+            if group_set is None:
+                group_set = CACHE.get(profile_id)
+        if group_set is None:
+            missing.append(profile_id)
+        else:
+            found[profile_id] = request_cache[profile_id] = group_set
+    if missing:
+        generation = CACHE.generation
+        loaded = _load(session, missing)
+        found.update(loaded)
+        loaded = {profile_id: group_set for profile_id, group_set in loaded.items()
+                  if profile_id not in changed}
+        request_cache.update(loaded)
+        CACHE.put(loaded, generation)
+    return found
+
+def group_set(profile_id):
+    """
+    :param int profile_id: Profile to resolve
+    :return GroupSet: Groups the Profile has Memberships in.
+    """
+    return group_sets([profile_id])[profile_id]
+
+def is_member(profile_id, group_id):
+    """
+    :param int profile_id: Profile to check
+    :param int group_id: Group to check
+    :return bool: The Profile has a Membership in the Group.
+    """
+    return group_id in group_set(profile_id)
+
+def check_many(profile_id, group_ids):
+    """
+    Check access to many resources at once, with the group each resource belongs to.
+    :param int profile_id: Profile to check
+    :param list(int) group_ids: Groups to check
+    :return list(bool): Membership in each of group_ids, in the same order.
+    """
+    return group_set(profile_id).check_many(group_ids)
+
+def invalidate(profile_ids=None):
+    """
+    Forget cached group sets in this process, for changes made outside of this process's sessions.
+    :param iterable(int) profile_ids: Profiles to forget, None forgets everything.
+    """
+    CACHE.invalidate(profile_ids)
+    if db.FACTORY.registry.has():
+        db.FACTORY.info.pop(_REQUEST_CACHE, None)  # pylint: disable=no-member
+
+
+@sa.event.listens_for(saorm.Session, 'after_commit')
+def _invalidate_committed(session):
+    """
+    Drop the cached group sets of Profiles whose Memberships changed in the transaction. The
+    request cache only lasts as long as the transaction, like the rows it was loaded from.
+    """
+    session.info.pop(_REQUEST_CACHE, None)
+    changed = memberships.changed_profiles(session, clear=True)
+    if changed:
+        CACHE.invalidate(changed)
+
+@sa.event.listens_for(saorm.Session, 'after_rollback')
+def _forget_rolled_back(session):
+    """ Changes that were rolled back were never cached, just forget them. """
+    session.info.pop(_REQUEST_CACHE, None)
+    memberships.changed_profiles(session, clear=True)
@@ -8,6 +8,8 @@ except ImportError:
     import sys
     print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
 
+import os
+
 import sqlalchemy as sa
 import sqlalchemy.orm as saorm
 
@@ -16,26 +18,111 @@ from . import bases
 from . import db
 
 
+# Default and largest number of Profiles returned by Profiles.search.
+SEARCH_LIMIT = int(os.environ.get('PROFILE_SEARCH_LIMIT', 20))
+SEARCH_MAX_LIMIT = 100
+# Shorter search terms only match prefixes, pg_trgm can't use its index for less than 3 characters.
+SEARCH_MIN_INFIX = 3
+# pg_trgm GIN indexes for substring search. Created with the table when pg_trgm is installed,
+# otherwise by `python -m models.maintenance search-indexes`, which installs it.
+TRIGRAM_INDEXES = (('ix_profiles_full_name_trgm', 'full_name'), ('ix_profiles_email_trgm', 'email'))
+
+
+def trigram_index_sql(name, column, concurrently=False):
+    """
+    :param str name: Name of the index
+    :param str column: Profiles column to index
+    :param bool concurrently: Build without blocking writes, for existing tables.
+    :return str: CREATE INDEX statement for a pg_trgm index on lower(column)
+    """
+    concurrently = 'CONCURRENTLY ' if concurrently else ''
+    return (f'CREATE INDEX {concurrently}IF NOT EXISTS {name} ON profiles '
+            f'USING gin (lower({column}) gin_trgm_ops)')
+
+def _escape_like(value):
+    """
+    :param str value: Text to match literally
+    :return str: value with LIKE wildcards escaped with backslash.
+    """
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
 class Profiles(bases.BaseModel):
     """ Contains the profile information for a user in the app. """
     email = sa.Column(sa.String(50), unique=True, nullable=False)
     full_name = sa.Column(sa.String(100), nullable=False)
 
+    __table_args__ = (
+        # Email addresses keep the case they were entered with, but are unique ignoring case.
+        sa.Index('ix_profiles_email_lower', sa.func.lower(email), unique=True),
+        # Prefix searches, LIKE 'abc%' needs text_pattern_ops unless the database uses C collation.
+        sa.Index('ix_profiles_full_name_prefix', sa.func.lower(full_name).label('full_name_lower'),
+                 postgresql_ops={'full_name_lower': 'text_pattern_ops'}),
+        sa.Index('ix_profiles_email_prefix', sa.func.lower(email).label('email_lower'),
+                 postgresql_ops={'email_lower': 'text_pattern_ops'}),
+    )
+
     login = saorm.relationship('Logins', uselist=False, back_populates='profile')
     memberships = saorm.relationship('Memberships', back_populates='profile')
 
     @classmethod
     def get_by_email(cls, email):
         """
-        Lookup Profile by email address.
+        Lookup Profile by email address, ignoring case. Uses the ix_profiles_email_lower index.
         :param str email: email address to lookup
         :return Profiles: Matching Profile or None
         """
-        return db.query(cls).filter(cls.email == email).one_or_none()
+        return db.query(cls).filter(sa.func.lower(cls.email) == email.lower()).one_or_none()
+
+    @classmethod
+    def search(cls, term, limit=SEARCH_LIMIT):
+        """
+        Type-ahead search on full_name and email, ignoring case. Terms shorter than
+        SEARCH_MIN_INFIX only match the start of the name or email using the prefix indexes, longer
+        terms match anywhere using the pg_trgm indexes when they exist. Results are ranked name
+        prefix, email prefix, start of a word in the name, then anywhere; shorter names first.
+        Works on any database, without pg_trgm (or on SQLite) substring search scans the table.
+        :param str term: Text to search for
+        :param int limit: Most Profiles to return, capped at SEARCH_MAX_LIMIT.
+        :return list(Profiles): Best matching Profiles or [] for a blank term.
+        """
+        term = term.strip().lower()
+        if not term:
+            return []
+
+        pattern = _escape_like(term)
+        name = sa.func.lower(cls.full_name)
+        email = sa.func.lower(cls.email)
+        name_prefix = name.like(pattern + '%', escape='\\')
+        email_prefix = email.like(pattern + '%', escape='\\')
+        if len(term) < SEARCH_MIN_INFIX:
+            criterion = sa.or_(name_prefix, email_prefix)
+        else:
+            criterion = sa.or_(name.like('%' + pattern + '%', escape='\\'),
+                               email.like('%' + pattern + '%', escape='\\'))
+        rank = sa.case([(name_prefix, 0),
+                        (email_prefix, 1),
+                        (name.like('% ' + pattern + '%', escape='\\'), 2)], else_=3)
+        return db.query(cls).filter(criterion)\
+            .order_by(rank, sa.func.length(cls.full_name), cls.id)\
+            .limit(min(limit, SEARCH_MAX_LIMIT)).all()
+
+    def change_email(self, address):
+        """
+        Change the email address of the Profile, and so of its Login. This is the email change
+        workflow, the one place the new address is checked against the Login's password.
+        :param str address: New email address
+        :raises ValueError: Invalid email, or the email is the Login's password.
+        :raises common.hashing.HasherBusyError: Too many passwords are being checked right now.
+        """
+        if self.login is not None and self.login.is_valid_password(address):
+            raise ValueError('Using email as password forbidden')
+        self.email = address
 
     @saorm.validates('email')
     def validate_email(self, key, address):  # pylint: disable=unused-argument,no-self-use
         """
+        Use change_email to change the address of a Profile that has a Login.
         :param str key: name of the field to validate.
         :param str address: email address
         :return str: the email address
@@ -44,3 +131,31 @@ class Profiles(bases.BaseModel):
         if not utilities.is_valid_email_address(address):
             raise ValueError('Invalid Email Address')
         return address
+
+
+def has_trigram(connection):
+    """
+    :param sqlalchemy.engine.Connection connection: Database connection
+    :return bool: Database is PostgreSQL and the pg_trgm extension can be installed.
+    """
+    return connection.dialect.name == 'postgresql' and connection.scalar(
+        "SELECT count(*) FROM pg_available_extensions WHERE name = 'pg_trgm'") > 0
+
+def trigram_installed(connection):
+    """
+    :param sqlalchemy.engine.Connection connection: Database connection
+    :return bool: Database is PostgreSQL and the pg_trgm extension is installed.
+    """
+    return connection.dialect.name == 'postgresql' and connection.scalar(
+        "SELECT count(*) FROM pg_extension WHERE extname = 'pg_trgm'") > 0
+
+@sa.event.listens_for(Profiles.__table__, 'after_create')
+def _create_trigram_indexes(target, connection, **kwargs):  # pylint: disable=unused-argument
+    """
+    Add the trigram indexes when the profiles table is created, if pg_trgm is already installed.
+    Installing it needs privileges the API's role may not have, so that is left to the
+    search-indexes maintenance command.
+    """
+    if trigram_installed(connection):
+        for name, column in TRIGRAM_INDEXES:
+            connection.execute(trigram_index_sql(name, column))
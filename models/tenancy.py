@@ -0,0 +1,141 @@
+"""
+Tenant scoping for models shared by many customers in one database. Models opt in by inheriting
+TenantScoped, which adds a tenant_id column. Once a session has a tenant set, every ORM query of
+TenantScoped models in that session only sees the tenant's rows, so get_all, get_by_pk, search and
+the ourapi endpoints built on them are scoped without any changes. New models are assigned the
+session's tenant on flush, moving a model to another tenant is refused.
+
+Every index and unique constraint of a TenantScoped table is rebuilt with tenant_id as its leading
+column, and a (tenant_id, id) index is added, so a tenant's queries read its own slice of the index
+however many tenants share the table. Unique values only have to be unique per tenant.
+
+Sessions without a tenant, e.g. maintenance jobs, see every tenant's rows.
+
+Example Usage:
+>>> from models import tenancy
+>>> tenancy.set_tenant(42)
+>>> Projects.get_all()  # Only tenant 42's Projects.
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+from sqlalchemy.ext.declarative import declared_attr
+
+from . import db
+
+
+# session.info key for the tenant the session is scoped to, also read by the shard routing.
+TENANT_ID = db.TENANT_ID
+
+
+class TenantScoped(object):  # pylint: disable=too-few-public-methods
+    """ Mixin for BaseModel subclasses holding the data of a single tenant. """
+    @declared_attr
+    def tenant_id(cls):  # pylint: disable=no-self-argument
+        """
+        :return sqlalchemy.Column: Tenant owning the row. Indexed by the tenant-leading indexes.
+        """
+        return sa.Column(sa.Integer, nullable=False)
+
+
+def set_tenant(tenant_id, session=None):
+    """
+    Scope the session's queries and new models to a tenant.
+    :param int or None tenant_id: Tenant of the request, None to see every tenant.
+    :param sqlalchemy.orm.session.Session session: Session to scope, default the current session.
+    """
+    session = session or db.connect()
+    if tenant_id is None:
+        session.info.pop(TENANT_ID, None)
+    else:
+        session.info[TENANT_ID] = tenant_id
+
+def current_tenant(session=None):
+    """
+    :param sqlalchemy.orm.session.Session session: Session to check, default the current session.
+    :return int or None: Tenant the session is scoped to.
+    """
+    session = session or db.connect()
+    return session.info.get(TENANT_ID)
+
+def _is_scoped(entity):
+    """
+    :param entity: Entity of a query column, a mapped class, an alias or None
+    :return bool: Entity is a TenantScoped model.
+    """
+    return entity is not None and issubclass(sa.inspect(entity).class_, TenantScoped)
+
+def _tenant_indexes(table):
+    """
+    Replace the indexes and unique constraints of a TenantScoped table with tenant-leading ones.
+    :param sqlalchemy.Table table: Table of a TenantScoped model
+    """
+    tenant_id = table.c.tenant_id
+    for index in list(table.indexes):
+        if index.expressions[0] is tenant_id:
+            continue
+        table.indexes.discard(index)
+        name = index.name or f'ix_{table.name}_{"_".join(col.name for col in index.columns)}'
+        sa.Index(name, tenant_id, *index.expressions, unique=index.unique)
+    for constraint in list(table.constraints):
+        if not isinstance(constraint, sa.UniqueConstraint) or \
+                list(constraint.columns)[0] is tenant_id:
+            continue
+        table.constraints.discard(constraint)
+        sa.UniqueConstraint(tenant_id, *constraint.columns, name=constraint.name)
+    name = f'ix_{table.name}_tenant_id_id'
+    if name not in {index.name for index in table.indexes}:
+        sa.Index(name, tenant_id, table.c.id)
+
+
+@sa.event.listens_for(TenantScoped, 'instrument_class', propagate=True)
+def _instrument_tenant_scoped(mapper, class_):  # pylint: disable=unused-argument
+    """ Give TenantScoped tables their tenant-leading indexes. """
+    _tenant_indexes(mapper.local_table)
+
+@sa.event.listens_for(saorm.Mapper, 'mapper_configured')
+def _unbaked_tenant_loads(mapper, class_):  # pylint: disable=unused-argument
+    """
+    Relationships loading TenantScoped models can't use baked queries, those would keep the tenant
+    of the first load.
+    """
+    for prop in mapper.relationships:
+        if issubclass(prop.mapper.class_, TenantScoped):
+            prop.bake_queries = False
+
+@sa.event.listens_for(saorm.Query, 'before_compile', retval=True)
+def _scope_query(query):
+    """ Filter the TenantScoped entities of a query to the session's tenant. """
+    tenant_id = query.session.info.get(TENANT_ID) if query.session is not None else None
+    if tenant_id is None:
+        return query
+    for description in query.column_descriptions:
+        entity = description['entity']
+        if _is_scoped(entity):
+            query = query.enable_assertions(False).filter(entity.tenant_id == tenant_id)
+    return query
+
+@sa.event.listens_for(saorm.Session, 'before_flush')
+def _assign_tenant(session, flush_context, instances):  # pylint: disable=unused-argument
+    """
+    Put new TenantScoped models in the session's tenant.
+    :raises ValueError: A model is written to another tenant than the session's.
+    """
+    tenant_id = session.info.get(TENANT_ID)
+    if tenant_id is None:
+        return
+    for instance in list(session.new) + list(session.dirty):
+        if not isinstance(instance, TenantScoped):
+            continue
+        if instance.tenant_id is None:
+            instance.tenant_id = tenant_id
+        elif instance.tenant_id != tenant_id or \
+                sa.inspect(instance).attrs.tenant_id.history.deleted:
+            raise ValueError(f'{instance} belongs to tenant {instance.tenant_id}, '
+                             f'not the session\'s tenant {tenant_id}.')
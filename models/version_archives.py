@@ -0,0 +1,30 @@
+"""
+Summaries of version history compacted by models.versioning_maintenance.prune_versions. Each row
+stands for consecutive versions of one row of a versioned table that were deleted in the same batch.
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import sqlalchemy as sa
+
+from . import bases
+
+
+class VersionArchives(bases.BaseModel):
+    """ Pruned versions of a row, summarized. This is not a JSONAPI exposed Model. """
+    table_name = sa.Column(sa.String(63), nullable=False)
+    row_id = sa.Column(sa.Integer, nullable=False)
+    versions = sa.Column(sa.Integer, nullable=False)
+    first_transaction_id = sa.Column(sa.BigInteger, nullable=False)
+    last_transaction_id = sa.Column(sa.BigInteger, nullable=False)
+    first_issued_at = sa.Column(sa.DateTime)
+    last_issued_at = sa.Column(sa.DateTime)
+    # Names of the columns whose value changed between the pruned versions.
+    changed_columns = sa.Column(sa.JSON, nullable=False)
+
+    __table_args__ = (sa.Index('ix_version_archives_table_name_row_id', 'table_name', 'row_id'),)
+    __versioned__ = {'versioning': False}
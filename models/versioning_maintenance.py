@@ -0,0 +1,343 @@
+"""
+Maintenance jobs for the version history sqlalchemy_continuum keeps of the models: the native
+versioning triggers, the pruning of old versions to each model's retention, and a benchmark of
+the cost of versioning. Like models.maintenance, the jobs work in small batches with short
+transactions so they can run alongside API traffic.
+
+Example Usage:
+$ ENV=stage python -m models.versioning_maintenance native-versioning
+$ ENV=dev python -m models.versioning_maintenance bench-tokens --rows 10000 --batch-size 100
+$ ENV=stage python -m models.versioning_maintenance prune-versions --batch-size 1000 --archive
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import argparse
+import datetime
+import logging
+import os
+import time
+import uuid
+
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+import sqlalchemy_continuum
+from sqlalchemy_continuum import transaction as continuum_transaction
+from sqlalchemy_continuum.dialects import postgresql as continuum_postgresql
+
+from common import log
+from . import authentication_tokens, forgot_password_tokens, logins, profiles
+from . import bases
+from . import db
+from . import version_archives
+
+
+# Version history kept by prune_versions for models without a retention of their own, unset keeps
+# all of it. Models set e.g. __versioned__ = {'retention': {'days': 90, 'versions': 10}}.
+VERSION_RETENTION = {key: int(os.environ[name]) for key, name in (
+    ('days', 'VERSION_RETENTION_DAYS'), ('versions', 'VERSION_RETENTION_VERSIONS'))
+                     if os.environ.get(name)}
+
+
+def has_hstore(connection):
+    """
+    :param sqlalchemy.engine.Connection connection: Database connection
+    :return bool: Database is PostgreSQL and the hstore extension, used by the native versioning
+                  triggers, can be installed.
+    """
+    return connection.dialect.name == 'postgresql' and connection.scalar(
+        "SELECT count(*) FROM pg_available_extensions WHERE name = 'hstore'") > 0
+
+def install_native_versioning():
+    """
+    Install hstore and the triggers writing the version rows to an existing database, for running
+    with NATIVE_VERSIONING=1. Deploy that setting first, otherwise the sessions and the triggers
+    both write version rows, changes made in between aren't versioned. Run as a role that may
+    create extensions. New databases get the triggers from create_all when NATIVE_VERSIONING is set.
+    :return list(str): Tables given a versioning trigger, [] when hstore isn't available.
+    """
+    logger = logging.getLogger(__name__)
+    manager = sqlalchemy_continuum.versioning_manager
+    saorm.configure_mappers()  # Builds the version classes.
+    tables = []
+    with db.ENGINE.begin() as connection:
+        if not has_hstore(connection):
+            logger.warning('hstore is not available, versions are written by the sessions.')
+            return tables
+        connection.execute('CREATE EXTENSION IF NOT EXISTS hstore')
+        connection.execute(continuum_transaction.procedure_sql.format(
+            temporary_transaction_sql=continuum_postgresql.CreateTemporaryTransactionTableSQL()))
+        connection.execute('DROP TRIGGER IF EXISTS transaction_trigger ON transaction')
+        connection.execute(str(continuum_postgresql.TransactionTriggerSQL(manager.transaction_cls)))
+        for model in sorted(manager.version_class_map, key=lambda model: model.__table__.name):
+            table = model.__table__.name
+            continuum_postgresql.drop_trigger(connection, table)
+            connection.execute(
+                str(continuum_postgresql.CreateTriggerFunctionSQL.for_manager(manager, model)))
+            connection.execute(
+                str(continuum_postgresql.CreateTriggerSQL.for_manager(manager, model)))
+            tables.append(table)
+    logger.info('Installed versioning triggers on %s.', ', '.join(tables))
+    return tables
+
+def benchmark_token_issuance(rows=10000, batch_size=100):
+    """
+    Time issuing rows tokens, committing batch_size at a time, as unversioned AuthenticationTokens
+    and as versioned ForgotPasswordTokens, which have the same columns. Each commit of versioned
+    tokens also writes a version row per token and a transaction row. The tokens belong to a
+    generated Login with a token-bench.invalid email, everything generated is deleted afterwards.
+    :param int rows: Number of tokens to issue of each kind.
+    :param int batch_size: Tokens per commit.
+    :return dict: rows, batch_size, native_versioning, unversioned_rows_per_sec,
+                  versioned_rows_per_sec and versioning_overhead, how many times slower the
+                  versioned tokens are.
+    """
+    manager = sqlalchemy_continuum.versioning_manager
+    saorm.configure_mappers()  # Builds the version classes.
+    profile_table = profiles.Profiles.__table__
+    login_table = logins.Logins.__table__
+    version_table = manager.version_class_map[forgot_password_tokens.ForgotPasswordTokens].__table__
+    transaction_table = manager.transaction_cls.__table__
+    email = f'{uuid.uuid4().hex[:12]}@token-bench.invalid'
+    now = datetime.datetime.utcnow()
+    stats = {'rows': rows, 'batch_size': batch_size, 'native_versioning': bases.NATIVE_VERSIONING}
+    try:
+        db.ENGINE.execute(profile_table.insert(),
+                          {'full_name': 'Token Bench', 'email': email, 'modified_at': now})
+        login_id = db.ENGINE.execute(login_table.insert(), {
+            'email': email, '_password': b'not a hash', 'modified_at': now}).inserted_primary_key[0]
+
+        for kind, model in (('unversioned', authentication_tokens.AuthenticationTokens),
+                            ('versioned', forgot_password_tokens.ForgotPasswordTokens)):
+            start = time.perf_counter()
+            for offset in range(0, rows, batch_size):
+                for _ in range(min(batch_size, rows - offset)):
+                    db.add(model(login_id=login_id))
+                db.commit()
+            stats[f'{kind}_rows_per_sec'] = rows / (time.perf_counter() - start)
+            db.close()
+    finally:
+        db.close()
+        transaction_ids = [row[0] for row in db.ENGINE.execute(
+            sa.select([version_table.c.transaction_id]).distinct()
+            .where(version_table.c.login_id.in_(
+                sa.select([login_table.c.id]).where(login_table.c.email == email))))]
+        db.ENGINE.execute(profile_table.delete().where(profile_table.c.email == email))
+        if transaction_ids:
+            db.ENGINE.execute(version_table.delete()
+                              .where(version_table.c.transaction_id.in_(transaction_ids)))
+            db.ENGINE.execute(transaction_table.delete()
+                              .where(transaction_table.c.id.in_(transaction_ids)))
+    stats['versioning_overhead'] = \
+        stats['unversioned_rows_per_sec'] / stats['versioned_rows_per_sec']
+    return stats
+
+def version_retention(model):
+    """
+    Version history of a model kept by prune_versions. Versions younger than days, or among the
+    newest versions of their row, are kept, when both are set a version is kept if either keeps it.
+    The current version of a row is always kept.
+    :param type model: Versioned model
+    :return dict: days and/or versions, {} keeps all history.
+    """
+    retention = dict(VERSION_RETENTION)
+    retention.update(model.__versioned__.get('retention', {}))
+    return {key: value for key, value in retention.items() if value is not None}
+
+def _archive_versions(connection, model, version_table, keys):
+    """
+    Summarize the versions about to be pruned into version_archives, one row per row id.
+    :param sqlalchemy.engine.Connection connection: Connection of the pruning transaction
+    :param type model: Versioned model
+    :param sqlalchemy.Table version_table: Version table of model
+    :param list(tuple) keys: (id, transaction_id) of the versions to summarize
+    """
+    transaction_table = sqlalchemy_continuum.versioning_manager.transaction_cls.__table__
+    skip = {'transaction_id', 'end_transaction_id', 'operation_type', 'modified_at',
+            'version_id'}
+    columns = [column.name for column in version_table.c if column.name not in skip]
+    rows = connection.execute(
+        sa.select([version_table, transaction_table.c.issued_at])
+        .select_from(version_table.outerjoin(
+            transaction_table, transaction_table.c.id == version_table.c.transaction_id))
+        .where(sa.tuple_(version_table.c.id, version_table.c.transaction_id).in_(keys))
+        .order_by(version_table.c.id, version_table.c.transaction_id))
+    summaries = []
+    for row in rows:
+        if not summaries or summaries[-1]['row_id'] != row.id:
+            summaries.append({'table_name': model.__table__.name, 'row_id': row.id, 'versions': 0,
+                              'first_transaction_id': row.transaction_id,
+                              'first_issued_at': row.issued_at, 'changed_columns': set()})
+            previous = row
+        summary = summaries[-1]
+        summary['changed_columns'].update(name for name in columns if row[name] != previous[name])
+        summary.update(versions=summary['versions'] + 1, last_transaction_id=row.transaction_id,
+                       last_issued_at=row.issued_at)
+        previous = row
+    for summary in summaries:
+        summary['changed_columns'] = sorted(summary['changed_columns'])
+    connection.execute(version_archives.VersionArchives.__table__.insert(), summaries)
+
+def prune_model_versions(model, batch_size=1000, pause=0.1, archive=False, now=None):
+    """
+    Delete the versions of a model outside its version_retention. Rows are visited in id order,
+    batch_size row ids per transaction, the versions of a row are ranked newest first.
+    :param type model: Versioned model
+    :param int batch_size: Number of row ids whose versions are pruned per transaction.
+    :param float pause: Seconds to sleep between batches.
+    :param bool archive: Summarize the pruned versions in version_archives first.
+    :param datetime.datetime now: Reference time for the days retention, default utcnow.
+    :return int: Number of versions deleted.
+    """
+    logger = logging.getLogger(__name__)
+    manager = sqlalchemy_continuum.versioning_manager
+    retention = version_retention(model)
+    if not retention:
+        return 0
+    version_table = manager.version_class_map[model].__table__
+    transaction_table = manager.transaction_cls.__table__
+    cutoff = 0
+    if 'days' in retention:
+        before = (now or datetime.datetime.utcnow()) - datetime.timedelta(days=retention['days'])
+        cutoff = db.ENGINE.scalar(sa.select([sa.func.max(transaction_table.c.id)])
+                                  .where(transaction_table.c.issued_at < before)) or 0
+
+    deleted = 0
+    last_id = 0
+    while True:
+        with db.ENGINE.begin() as connection:
+            ids = [row[0] for row in connection.execute(
+                sa.select([version_table.c.id]).distinct().where(version_table.c.id > last_id)
+                .order_by(version_table.c.id).limit(batch_size))]
+            if not ids:
+                break
+            ranked = sa.select([
+                version_table.c.id, version_table.c.transaction_id,
+                version_table.c.end_transaction_id,
+                sa.func.row_number().over(partition_by=version_table.c.id,
+                                          order_by=version_table.c.transaction_id.desc())
+                .label('rank')]).where(version_table.c.id.in_(ids)).alias('ranked')
+            # Superseded versions kept by neither retention.
+            prune = [ranked.c.end_transaction_id.isnot(None)]
+            if 'days' in retention:
+                prune.append(ranked.c.end_transaction_id <= cutoff)
+            if 'versions' in retention:
+                prune.append(ranked.c.rank > retention['versions'])
+            keys = [tuple(row) for row in connection.execute(
+                sa.select([ranked.c.id, ranked.c.transaction_id]).where(sa.and_(*prune)))]
+            if keys:
+                if archive:
+                    _archive_versions(connection, model, version_table, keys)
+                connection.execute(version_table.delete().where(
+                    sa.tuple_(version_table.c.id, version_table.c.transaction_id).in_(keys)))
+        deleted += len(keys)
+        last_id = ids[-1]
+        if len(ids) < batch_size:
+            break
+        time.sleep(pause)
+
+    logger.info('Pruned %d versions of %s.', deleted, model.__tablename__)
+    return deleted
+
+def prune_transactions(batch_size=1000, pause=0.1):
+    """
+    Delete the continuum transactions no version refers to any more, in id order. Transactions
+    started after this job are left alone.
+    :param int batch_size: Number of transactions checked per transaction.
+    :param float pause: Seconds to sleep between batches.
+    :return int: Number of transactions deleted.
+    """
+    logger = logging.getLogger(__name__)
+    manager = sqlalchemy_continuum.versioning_manager
+    transaction_table = manager.transaction_cls.__table__
+    version_tables = [version.__table__ for version in manager.version_class_map.values()]
+    newest = db.ENGINE.scalar(sa.select([sa.func.max(transaction_table.c.id)])) or 0
+
+    deleted = 0
+    last_id = 0
+    while True:
+        with db.ENGINE.begin() as connection:
+            ids = [row[0] for row in connection.execute(
+                sa.select([transaction_table.c.id])
+                .where(sa.and_(transaction_table.c.id > last_id, transaction_table.c.id <= newest))
+                .order_by(transaction_table.c.id).limit(batch_size))]
+            if not ids:
+                break
+            used = set()
+            for table in version_tables:
+                for column in (table.c.transaction_id, table.c.end_transaction_id):
+                    used.update(row[0] for row in connection.execute(
+                        sa.select([column]).distinct().where(column.in_(ids))))
+            unused = sorted(set(ids) - used)
+            if unused:
+                connection.execute(transaction_table.delete()
+                                   .where(transaction_table.c.id.in_(unused)))
+        deleted += len(unused)
+        last_id = ids[-1]
+        if len(ids) < batch_size:
+            break
+        time.sleep(pause)
+
+    logger.info('Pruned %d transactions.', deleted)
+    return deleted
+
+def prune_versions(batch_size=1000, pause=0.1, archive=False):
+    """
+    Prune the version history of every versioned model to its version_retention, then the
+    transactions left without versions.
+    :param int batch_size: Number of row ids, or transactions, per transaction.
+    :param float pause: Seconds to sleep between batches.
+    :param bool archive: Summarize the pruned versions in version_archives first.
+    :return dict: Number of rows deleted by table name, the transactions under 'transaction'.
+    """
+    saorm.configure_mappers()  # Builds the version classes.
+    manager = sqlalchemy_continuum.versioning_manager
+    stats = {}
+    for model in sorted(manager.version_class_map, key=lambda model: model.__table__.name):
+        stats[manager.version_class_map[model].__table__.name] = \
+            prune_model_versions(model, batch_size, pause, archive)
+    stats[manager.transaction_cls.__table__.name] = prune_transactions(batch_size, pause)
+    return stats
+
+def main(argv=None):
+    """
+    Command line entry point for the versioning jobs.
+    :param list(str) argv: Arguments, default sys.argv.
+    """
+    log.init_logging()
+
+    parser = argparse.ArgumentParser(prog='python -m models.versioning_maintenance',
+                                     description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    subparsers.add_parser('native-versioning',
+                          help='Install the triggers writing version rows in PostgreSQL.')
+
+    bench_tokens = subparsers.add_parser('bench-tokens',
+                                         help='Time token issuance with and without versioning.')
+    bench_tokens.add_argument('--rows', type=int, default=10000)
+    bench_tokens.add_argument('--batch-size', type=int, default=100, help='Tokens per commit.')
+
+    prune = subparsers.add_parser('prune-versions',
+                                  help='Delete the version history outside of the retention '
+                                       'of each model.')
+    prune.add_argument('--batch-size', type=int, default=1000)
+    prune.add_argument('--pause', type=float, default=0.1, help='Seconds between batches.')
+    prune.add_argument('--archive', action='store_true',
+                       help='Summarize the pruned versions in version_archives.')
+
+    args = parser.parse_args(argv)
+    if args.command == 'native-versioning':
+        print(install_native_versioning())
+    elif args.command == 'bench-tokens':
+        print(benchmark_token_issuance(args.rows, args.batch_size))
+    elif args.command == 'prune-versions':
+        print(prune_versions(args.batch_size, args.pause, args.archive))
+
+if __name__ == '__main__':
+    main()
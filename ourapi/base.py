@@ -8,9 +8,25 @@ except ImportError:
     import sys
     print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
 
+import flask
 import flask.views
 
+from models import db
+
+
+# Requests that don't change anything, their handlers run in a read only session.
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
 
 class BaseJsonApiResource(flask.views.MethodView):
     """ Root class for all JSONAPI Method View Classes. """
-    pass
+
+    def dispatch_request(self, *args, **kwargs):
+        """
+        Run the handler of safe methods in a read only session, see models.db.read_only.
+        :return: Result of the handler
+        """
+        if flask.request.method not in SAFE_METHODS:
+            return super().dispatch_request(*args, **kwargs)
+        with db.read_only():
+            return super().dispatch_request(*args, **kwargs)
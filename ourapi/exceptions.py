@@ -37,6 +37,7 @@ HTTP Response Code Exceptions for errors in JSONAPI Requests
         * 404 Not Found
         * 409 Conflict (violate other server-enforced constraints / object’s type and id do not
         match the server’s endpoint)
+        * 412 Precondition Failed (If-Match doesn't match the resource's current ETag, rfc7232)
     * Updating Relationships
         * Updating To-Many Relationships 403 Forbidden response if complete replacement is not
         allowed by the server
@@ -53,6 +54,7 @@ HTTP Response Code Exceptions for errors in JSONAPI Requests
         * 204 No Content
         * 200 OK (the server responds with only top-level meta data)
         * 404 Not Found
+        * 412 Precondition Failed (If-Match doesn't match the resource's current ETag, rfc7232)
 * Query Parameters
     * If a server encounters a query parameter that does not follow the naming conventions, and the
     server does not know how to process it as a query parameter from this specification, it MUST
@@ -106,3 +108,8 @@ class NotFound(JSONAPIError, werkzeug.exceptions.NotFound):
 class Conflict(JSONAPIError, werkzeug.exceptions.Conflict):
     """ 409 Conflict: fails server unique constraint or id issues. """
     pass
+
+
+class PreconditionFailed(JSONAPIError, werkzeug.exceptions.PreconditionFailed):
+    """ 412 Precondition Failed: the resource changed since the version in If-Match. """
+    pass
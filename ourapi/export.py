@@ -0,0 +1,333 @@
+"""
+Streaming export of the models behind any ourmarshmallow.Schema to NDJSON or CSV.
+
+Rows are read from a server-side cursor in chunks inside one REPEATABLE READ transaction, so an
+export is a consistent snapshot and memory use doesn't grow with the table. Only the schema's
+column attributes are exported, as flat records named like the JSONAPI attributes. Encoding is the
+expensive part, with workers > 0 chunks are encoded on a process pool, a few chunks ahead of the
+writer, and written in order.
+
+The endpoint is registered for listable resources at /<type>/export?format=ndjson|csv.
+
+Example Usage:
+$ ENV=stage python -m ourapi.export myapi.schemas:ProfilesSchema --format csv -o profiles.csv
+$ ENV=dev python -m ourapi.export --bench --rows 200000 --workers 2
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import argparse
+import base64
+import collections
+import concurrent.futures
+import csv
+import datetime
+import decimal
+import importlib
+import io
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+import flask
+import sqlalchemy as sa
+
+from sqlalchemy.ext.declarative import declarative_base
+
+from common import log
+from models import db
+import ourmarshmallow
+from ourmarshmallow.fields import MetaData
+from . import exceptions
+
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+# Rows fetched from the cursor and encoded at a time.
+CHUNK_SIZE = 5000
+
+
+def export_columns(schema_class):
+    """
+    The schema's attributes that are model columns, relationships aren't exported.
+    :param ourmarshmallow.Schema.__class__ schema_class: Schema to export
+    :return list(tuple(str, sqlalchemy.Column)): Output names and columns. id first, then the
+                                                 attributes, then meta data like modified_at.
+    """
+    mapper = sa.inspect(schema_class.opts.model)
+    inflect = schema_class.opts.inflect or (lambda name: name)
+    ids, attributes, meta = [], [], []
+    for name, field in schema_class._declared_fields.items():  # pylint: disable=protected-access
+        if field is None:  # Excluded in the schema's Meta.
+            continue
+        prop = mapper.attrs.get(field.attribute or name)
+        if field.load_only or not isinstance(prop, sa.orm.ColumnProperty):
+            continue
+        if name == 'id':
+            ids.append((name, prop.columns[0]))
+        elif isinstance(field, MetaData):
+            meta.append((inflect(name), prop.columns[0]))
+        else:
+            attributes.append((inflect(name), prop.columns[0]))
+    return ids + attributes + meta
+
+def _jsonable(value):
+    """
+    :param value: Column value that json can't encode
+    :return: ISO 8601 string for dates and times (naive datetimes are UTC), str for Decimal and
+             UUID, base64 for bytes.
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.isoformat()
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (bytes, memoryview)):
+        return base64.b64encode(bytes(value)).decode('ascii')
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    raise TypeError(f'{type(value).__name__} is not exportable.')
+
+def encode_chunk(fmt, names, convert, rows):
+    """
+    Encode rows, run in the pool processes when workers > 0 so it must stay a module function.
+    :param str fmt: ndjson or csv
+    :param list(str) names: Output names of the columns
+    :param list(int) convert: Indexes of the columns that need _jsonable, dates, bytes and such.
+    :param list(tuple) rows: Column values
+    :return str: Encoded rows, one per line
+    """
+    if convert:
+        rows = [list(row) for row in rows]
+        for row in rows:
+            for idx in convert:
+                if row[idx] is not None:
+                    row[idx] = _jsonable(row[idx])
+    if fmt == 'csv':
+        out = io.StringIO()
+        csv.writer(out, lineterminator='\n').writerows(rows)
+        return out.getvalue()
+    dumps = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+    return ''.join([dumps(dict(zip(names, row))) + '\n' for row in rows])
+
+def _converted(columns):
+    """
+    :param list(tuple(str, sqlalchemy.Column)) columns: Exported columns
+    :return list(int): Indexes of columns json and csv can't write as is.
+    """
+    plain = (int, float, str, bool)
+    convert = []
+    for idx, (_, column) in enumerate(columns):
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            python_type = object
+        if not issubclass(python_type, plain):
+            convert.append(idx)
+    return convert
+
+def _select(schema_class, columns):
+    """
+    :param ourmarshmallow.Schema.__class__ schema_class: Schema to export
+    :param list(tuple(str, sqlalchemy.Column)) columns: Exported columns, id first.
+    :return sqlalchemy.sql.Select: Rows ordered by id. The id is a string, as in the JSONAPI
+                                   documents, and converted by the database so encoding stays fast.
+                                   Built as a query of the schema's session, so the session's
+                                   criteria, like its tenant, apply to the export too.
+    """
+    mapper = sa.inspect(schema_class.opts.model)
+    attrs = [mapper.get_property_by_column(column).class_attribute for _, column in columns]
+    query = schema_class().session.query(sa.cast(attrs[0], sa.Text), *attrs[1:])
+    return query.order_by(attrs[0]).statement
+
+def _engine(schema_class):
+    """
+    :param ourmarshmallow.Schema.__class__ schema_class: Schema to export
+    :return sqlalchemy.engine.Engine: Engine of the session the schema loads its model with.
+    """
+    return schema_class().session.get_bind(mapper=sa.inspect(schema_class.opts.model))
+
+def iter_export(schema_class, fmt='ndjson', chunk_size=CHUNK_SIZE, workers=0, stats=None,
+                engine=None, statement=None):  # pylint: disable=too-many-arguments
+    """
+    Stream the encoded export of every model of schema_class, ordered by id.
+    :param ourmarshmallow.Schema.__class__ schema_class: Schema to export
+    :param str fmt: ndjson or csv
+    :param int chunk_size: Rows fetched and encoded at a time.
+    :param int workers: Processes encoding chunks, 0 encodes in this process.
+    :param dict stats: Updated with the number of rows exported so far.
+    :param sqlalchemy.engine.Engine engine: Database to read, default the schema's session's.
+    :param sqlalchemy.sql.Select statement: SELECT of the rows from _select, default built from the
+                                            session when the first chunk is read.
+    :yield str: Encoded chunks, the CSV header first.
+    :raises ValueError: Unsupported format.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Unsupported export format {fmt}.')
+    stats = stats if stats is not None else {}
+    stats['rows'] = 0
+    columns = export_columns(schema_class)
+    names = [name for name, _ in columns]
+    # The id is already text, _select casts it.
+    convert = [idx for idx in _converted(columns) if idx]
+    if fmt == 'csv':
+        yield encode_chunk(fmt, names, [], [names])
+
+    executor = concurrent.futures.ProcessPoolExecutor(workers) if workers else None
+    pending = collections.deque()
+    try:
+        with (engine or _engine(schema_class)).connect() as connection:
+            options = {'stream_results': True}
+            if connection.dialect.name == 'postgresql':
+                options['isolation_level'] = 'REPEATABLE READ'
+            connection = connection.execution_options(**options)
+            with connection.begin():
+                result = connection.execute(statement if statement is not None else
+                                            _select(schema_class, columns))
+                while True:
+                    rows = [tuple(row) for row in result.fetchmany(chunk_size)]
+                    if not rows:
+                        break
+                    stats['rows'] += len(rows)
+                    if executor is None:
+                        yield encode_chunk(fmt, names, convert, rows)
+                        continue
+                    pending.append(executor.submit(encode_chunk, fmt, names, convert, rows))
+                    # Only a few chunks in flight, so memory stays flat however big the table.
+                    if len(pending) > workers * 2:
+                        yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown()
+
+def export(schema_class, out, fmt='ndjson', chunk_size=CHUNK_SIZE, workers=0):
+    """
+    Write the export of every model of schema_class to a file.
+    :param ourmarshmallow.Schema.__class__ schema_class: Schema to export
+    :param file out: Text file to write to
+    :param str fmt: ndjson or csv
+    :param int chunk_size: Rows fetched and encoded at a time.
+    :param int workers: Processes encoding chunks, 0 encodes in this process.
+    :return dict: rows exported, seconds and rows_per_sec
+    """
+    logger = logging.getLogger(__name__)
+    stats = {}
+    start = time.perf_counter()
+    for chunk in iter_export(schema_class, fmt, chunk_size, workers, stats):
+        out.write(chunk)
+    elapsed = time.perf_counter() - start
+    stats.update(seconds=elapsed, rows_per_sec=stats['rows'] / elapsed if elapsed else 0.0)
+    logger.info('Exported %d %s in %.2fs (%.0f rows/sec).', stats['rows'],
+                schema_class.opts.type_, elapsed, stats['rows_per_sec'])
+    return stats
+
+def export_view(schema_class):
+    """
+    Build the Flask view streaming the export of schema_class.
+    :param ourmarshmallow.Schema.__class__ schema_class: Schema to export
+    :return callable: View function for GET /<type>/export?format=ndjson|csv
+    """
+    def _export():
+        """ Stream the export in the format query parameter, ndjson by default. """
+        fmt = flask.request.args.get('format', 'ndjson')
+        if fmt not in FORMATS:
+            raise exceptions.BadRequest({'detail': f'format must be one of {sorted(FORMATS)}.',
+                                         'source': {'parameter': 'format'}})
+        filename = f'{schema_class.opts.type_}.{fmt}'
+        # The rows are streamed after the request's session is removed, build the query from it
+        # now so its tenant applies, and pick the replica while still read only.
+        with db.read_only():
+            engine = _engine(schema_class)
+            statement = _select(schema_class, export_columns(schema_class))
+        return flask.Response(iter_export(schema_class, fmt, engine=engine, statement=statement),
+                              mimetype=FORMATS[fmt],
+                              headers={'Content-Disposition': f'attachment; filename={filename}'})
+    return _export
+
+
+_BENCH_BASE = declarative_base()
+
+class _ExportBench(_BENCH_BASE):  # pylint: disable=too-few-public-methods
+    """ Throwaway table for the benchmark, shaped like Profiles. """
+    __tablename__ = 'export_bench'
+    id = sa.Column(sa.Integer, primary_key=True)  # pylint: disable=invalid-name
+    full_name = sa.Column(sa.String(100), nullable=False)
+    email = sa.Column(sa.String(50), nullable=False)
+    modified_at = sa.Column(sa.DateTime, nullable=False)
+
+
+def benchmark(rows=200000, fmt='ndjson', workers=0, chunk_size=CHUNK_SIZE):
+    """
+    Export rows from a generated export_bench table to /dev/null, then drop the table.
+    :param int rows: Number of rows to generate.
+    :param str fmt: ndjson or csv
+    :param int workers: Processes encoding chunks.
+    :param int chunk_size: Rows fetched and encoded at a time.
+    :return dict: Stats from export
+    """
+    class ExportBenchSchema(ourmarshmallow.Schema):
+        """ Schema for the benchmark table. """
+        class Meta:  # pylint: disable=missing-docstring,too-few-public-methods
+            model = _ExportBench
+
+    engine = _engine(ExportBenchSchema)
+    table = _ExportBench.__table__
+    table.create(engine)
+    try:
+        now = datetime.datetime.utcnow()
+        for offset in range(0, rows, 10000):
+            names = [uuid.uuid4().hex for _ in range(min(10000, rows - offset))]
+            engine.execute(table.insert(), [
+                {'full_name': f'{name[:8]} {name[8:20]}', 'email': f'{name[20:]}@example.com',
+                 'modified_at': now} for name in names])
+        with open(os.devnull, 'w') as out:
+            return export(ExportBenchSchema, out, fmt, chunk_size, workers)
+    finally:
+        table.drop(engine)
+
+def main(argv=None):
+    """
+    Command line entry point for exports.
+    :param list(str) argv: Arguments, default sys.argv.
+    """
+    log.init_logging()
+
+    parser = argparse.ArgumentParser(prog='python -m ourapi.export', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('schema', nargs='?', help='Schema class to export, as module:Class.')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson')
+    parser.add_argument('-o', '--output', help='File to write, default stdout.')
+    parser.add_argument('--workers', type=int, default=0, help='Encoding processes.')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--bench', action='store_true', help='Export a generated table instead.')
+    parser.add_argument('--rows', type=int, default=200000, help='Rows to generate.')
+
+    args = parser.parse_args(argv)
+    if args.bench:
+        print(benchmark(args.rows, args.format, args.workers, args.chunk_size))
+        return
+    if not args.schema:
+        parser.error('schema is required')
+
+    module_name, _, class_name = args.schema.partition(':')
+    schema_class = getattr(importlib.import_module(module_name), class_name)
+    if args.output:
+        with open(args.output, 'w', newline='', encoding='utf8') as out:
+            print(export(schema_class, out, args.format, args.chunk_size, args.workers),
+                  file=sys.stderr)
+    else:
+        export(schema_class, sys.stdout, args.format, args.chunk_size, args.workers)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Keyset paginated version history of the models behind an ourmarshmallow.Schema.
+
+Every version is a JSONAPI resource object of the model as it was after a change, with the change
+in its meta. Pages are ordered by (transaction_id, id) and the next page is read after the cursor
+of the last version, so paging stays fast however long the history is. The endpoints are
+registered for versioned resources:
+    /<type>/<id>/history    Changes of one model.
+    /<type>/history         Changes of all the models, of the session's tenant when tenant scoped.
+
+Query parameters:
+    filter[since]   Only changes since an ISO 8601 time, e.g. 2018-03-04T05:06:07Z
+    page[after]     Cursor of the last version of the previous page, from links.next
+    page[size]      Versions per page, at most MAX_PAGE_SIZE.
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import datetime
+import json
+
+import flask
+import sqlalchemy as sa
+from sqlalchemy_continuum import Operation
+
+from models import bases, db
+from . import exceptions
+from . import export
+
+
+MAX_PAGE_SIZE = 1000
+_jsonable = export._jsonable  # pylint: disable=protected-access
+OPERATIONS = {Operation.INSERT: 'insert', Operation.UPDATE: 'update', Operation.DELETE: 'delete'}
+
+
+def is_versioned(schema_class):
+    """
+    :param ourmarshmallow.Schema.__class__ schema_class: Schema of a resource
+    :return bool: The schema's model keeps a version history.
+    """
+    versioned = getattr(schema_class.opts.model, '__versioned__', None)
+    return versioned is not None and versioned.get('versioning', True)
+
+def cursor(version):
+    """
+    :param version: Version of a model
+    :return str: Opaque position of the version in the history, for page[after].
+    """
+    return f'{version.transaction_id}.{version.id}'
+
+def _parse_cursor(value):
+    """
+    :param str value: page[after] parameter
+    :return tuple(int, int): (transaction_id, id) of the version
+    :raises exceptions.BadRequest: Not a cursor.
+    """
+    try:
+        transaction_id, model_id = (int(part) for part in value.split('.'))
+    except ValueError:
+        raise exceptions.BadRequest({'detail': 'page[after] must be a cursor from links.next.',
+                                     'source': {'parameter': 'page[after]'}})
+    return transaction_id, model_id
+
+def _parse_since(value):
+    """
+    :param str value: filter[since] parameter
+    :return datetime.datetime: Naive UTC time
+    :raises exceptions.BadRequest: Not an ISO 8601 time.
+    """
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        since = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise exceptions.BadRequest({'detail': 'filter[since] must be an ISO 8601 time.',
+                                     'source': {'parameter': 'filter[since]'}})
+    if since.tzinfo is not None:
+        since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return since
+
+def _parse_size(value):
+    """
+    :param str value: page[size] parameter
+    :return int: Page size
+    :raises exceptions.BadRequest: Not a number from 1 to MAX_PAGE_SIZE.
+    """
+    if not value.isdigit() or not 0 < int(value) <= MAX_PAGE_SIZE:
+        raise exceptions.BadRequest({'detail': f'page[size] must be from 1 to {MAX_PAGE_SIZE}.',
+                                     'source': {'parameter': 'page[size]'}})
+    return int(value)
+
+def dump_version(schema_class, columns, version):
+    """
+    :param ourmarshmallow.Schema.__class__ schema_class: Schema of the versioned model
+    :param list(tuple(str, sqlalchemy.Column)) columns: export.export_columns of the schema
+    :param version: Version of a model
+    :return dict: JSONAPI resource object of the model as of the version, the change in meta.
+    """
+    mapper = sa.inspect(schema_class.opts.model)
+    attributes = {}
+    for name, column in columns[1:]:
+        value = getattr(version, mapper.get_property_by_column(column).key)
+        if value is not None and not isinstance(value, (int, float, str, bool)):
+            value = _jsonable(value)
+        attributes[name] = value
+    return {'type': schema_class.opts.type_, 'id': str(version.id), 'attributes': attributes,
+            'meta': {'operation': OPERATIONS[version.operation_type],
+                     'transaction-id': version.transaction_id,
+                     'issued-at': _jsonable(version.transaction.issued_at),
+                     'cursor': cursor(version)}}
+
+def history_view(schema_class):
+    """
+    Build the Flask view reading the version history of schema_class's model.
+    :param ourmarshmallow.Schema.__class__ schema_class: Schema of a versioned model
+    :return callable: View function for GET /<type>/history and /<type>/<id>/history
+    """
+    model = schema_class.opts.model
+    columns = export.export_columns(schema_class)
+
+    @db.read_only()
+    def _history(model_id=None):
+        """
+        A page of versions, oldest first, links.next reads the page after it.
+        :param int or None model_id: Id of the model, None for the changes of all of them.
+        :raises exceptions.NotFound: The model has no history.
+        """
+        args = flask.request.args
+        after = _parse_cursor(args['page[after]']) if 'page[after]' in args else None
+        since = _parse_since(args['filter[since]']) if 'filter[since]' in args else None
+        size = _parse_size(args['page[size]']) if 'page[size]' in args else \
+            bases.HISTORY_PAGE_SIZE
+        versions = model.history_page(model_id, after, since, size)
+        if model_id is not None and after is None and not versions and \
+                model.get_by_pk(model_id) is None:
+            raise exceptions.NotFound({'detail': '{id} not found.'.format(id=model_id),
+                                       'source': {'parameter': '/id'}})
+        db.release()
+
+        document = {'data': [dump_version(schema_class, columns, version) for version in versions],
+                    'links': {'self': flask.request.url, 'next': None}}
+        if len(versions) == size:
+            params = args.to_dict()
+            params['page[after]'] = cursor(versions[-1])
+            document['links']['next'] = flask.url_for(flask.request.endpoint, _external=True,
+                                                      **flask.request.view_args, **params)
+        return flask.Response(json.dumps(document), mimetype='application/vnd.api+json')
+    return _history
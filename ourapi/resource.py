@@ -9,10 +9,24 @@ except ImportError:
     print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
 
 import flask
+from sqlalchemy.orm.exc import StaleDataError
 
+from models import db
 from ourmarshmallow.exceptions import ForbiddenIdError, IncorrectTypeError, MismatchIdError
 from . import base
 from . import exceptions
+from . import export
+from . import history
+from . import sync
+
+
+def _changed(model_id):
+    """
+    :param int model_id: Id of the model changed by someone else
+    :return exceptions.PreconditionFailed: JSONAPI Error Object for a stale If-Match or read.
+    """
+    return exceptions.PreconditionFailed({'detail': f'{model_id} was changed since it was read.',
+                                          'source': {'header': 'If-Match'}})
 
 
 class JsonApiResource(base.BaseJsonApiResource):
@@ -33,9 +47,39 @@ class JsonApiResource(base.BaseJsonApiResource):
         :return dict: JSONAPI Envelop containing the dumped model as dict.
         """
         the_model, schema = self._get_model(model_id)
+        self._set_etag(the_model)
+        self._release()
         result, _ = schema.dump(the_model)
         return result
 
+    @staticmethod
+    def _check_if_match(the_model):
+        """
+        Only change a model still at the version the client read, when the request has If-Match.
+        :param BaseModel the_model: Model about to be changed
+        :raises exceptions.PreconditionFailed: If-Match isn't the model's current ETag.
+        """
+        if not flask.has_request_context():
+            return
+        if_match = flask.request.if_match
+        if if_match and not if_match.contains(str(the_model.version_id)):
+            raise _changed(the_model.id)
+
+    @staticmethod
+    def _set_etag(the_model):
+        """
+        Send the model's version_id as the ETag of the response, for If-Match on later changes.
+        :param BaseModel the_model: Model of the response
+        """
+        if not flask.has_request_context():
+            return
+        etag = str(the_model.version_id)
+
+        @flask.after_this_request
+        def _etag(response):  # pylint: disable=unused-variable
+            response.set_etag(etag)
+            return response
+
     def _get_model(self, model_id):
         """
         Fetch a model by ID, handling common execptions.
@@ -53,22 +97,45 @@ class JsonApiResource(base.BaseJsonApiResource):
 
     def _list(self):
         """
-        Read a list of models
+        Read a list of models. With a filter[search] query parameter the list is the ranked results
+        of the model's search classmethod instead.
         :return list(dict): Collection of JSONAPI Envelops containing the dumped models as dict.
+        :raises exceptions.BadRequest: filter[search] used on a model without search.
         """
         schema = self.schema(many=True)  # pylint: disable=not-callable
-        models_list = schema.opts.model.get_all()
+        model = schema.opts.model
+        term = flask.request.args.get('filter[search]') if flask.has_request_context() else None
+        if term is None:
+            models_list = model.get_all()
+        elif hasattr(model, 'search'):
+            models_list = model.search(term)
+        else:
+            raise exceptions.BadRequest({'detail': 'Search is not supported for this resource.',
+                                         'source': {'parameter': 'filter[search]'}})
+        self._release()
         result, _ = schema.dump(models_list)
         return result
 
+    @staticmethod
+    def _release():
+        """ The rows of a read are loaded, in a request don't hold the connection while dumping. """
+        if flask.has_request_context():
+            db.release()
+
     def delete(self, model_id):
         """
-        Delete model by id.
+        Delete model by id. With If-Match, only while the model is at that ETag.
         :param int model_id: Id of model
         :return tuple(None, int): No body, 204 No Content response code.
+        :raises exceptions.PreconditionFailed: The model changed since the If-Match ETag.
         """
         the_model, _ = self._get_model(model_id)
-        the_model.delete()
+        self._check_if_match(the_model)
+        try:
+            the_model.delete(flush=True)
+        except StaleDataError:
+            # Changed by a concurrent request since it was read, the DELETE matched no row.
+            raise _changed(model_id)
         return None, 204
 
     def get(self, model_id=None):
@@ -83,13 +150,17 @@ class JsonApiResource(base.BaseJsonApiResource):
 
     def patch(self, model_id, data):
         """
-        Update a model by id.
+        Update a model by id. With If-Match, only while the model is at that ETag. Either way the
+        UPDATE only matches the version read, so a concurrent change is never overwritten.
         :param int model_id: Id of model
         :param dict data: payload of data to use to update model
         :return dict: JSONAPI Envelop containing the dumped models as dict.
         :raises exceptions.Conflict: id is missing or doesn't match URL.
+        :raises exceptions.PreconditionFailed: The model changed since the If-Match ETag, or since
+                                               it was read for this update.
         """
         the_model, schema = self._get_model(model_id)
+        self._check_if_match(the_model)
 
         try:
             # Passing existing model instance into load results in extra checks for id in data.
@@ -98,7 +169,11 @@ class JsonApiResource(base.BaseJsonApiResource):
             # http://jsonapi.org/format/#crud-updating-responses-409
             raise exceptions.Conflict(exc.messages['errors'][0])
 
-        the_model.save(flush=True)
+        try:
+            the_model.save(flush=True)
+        except StaleDataError:
+            raise _changed(model_id)
+        self._set_etag(the_model)
         result, _ = schema.dump(the_model)
         return result
 
@@ -123,6 +198,7 @@ class JsonApiResource(base.BaseJsonApiResource):
             raise exceptions.Conflict(exc.messages['errors'][0])
 
         the_model.save(flush=True)
+        self._set_etag(the_model)
 
         result, _ = schema.dump(the_model)
         return result, 201, {'Location': flask.url_for(self.__class__.__name__,
@@ -142,8 +218,24 @@ class JsonApiResource(base.BaseJsonApiResource):
         details_endpoint = cls.schema.opts.self_url.format(id='<int:model_id>')
         api.add_url_rule(details_endpoint, view_func=view_func, methods=('DELETE', 'GET', 'PATCH'))
 
+        # Keyset paginated version history of a model, and of all of them.
+        if history.is_versioned(cls.schema):
+            history_view = history.history_view(cls.schema)
+            api.add_url_rule(details_endpoint + '/history', cls.__name__ + '_history',
+                             view_func=history_view, methods=('GET',))
+            api.add_url_rule(cls.schema.opts.self_url_many + '/history',
+                             cls.__name__ + '_history_all', view_func=history_view,
+                             methods=('GET',))
+
         # Route for Model Resource without identifier (Create, and possibly Read list)
         methods = ['POST']
         if cls.schema.opts.listable:
             methods.append('GET')
+            # Streaming export of the whole collection as NDJSON or CSV.
+            api.add_url_rule(cls.schema.opts.self_url_many + '/export', cls.__name__ + '_export',
+                             view_func=export.export_view(cls.schema), methods=('GET',))
+            # Changes since the cursor of a previous sync, deletions come from the version table.
+            if history.is_versioned(cls.schema):
+                api.add_url_rule(cls.schema.opts.self_url_many + '/sync', cls.__name__ + '_sync',
+                                 view_func=sync.sync_view(cls.schema), methods=('GET',))
         api.add_url_rule(cls.schema.opts.self_url_many, view_func=view_func, methods=methods)
@@ -0,0 +1,107 @@
+"""
+Incremental sync of the models behind an ourmarshmallow.Schema, so clients keep a copy of a list
+up to date by fetching what changed instead of the whole list.
+
+The first sync returns every model, later syncs pass the cursor from the previous response and only
+get the models created or modified since, ordered by (modified_at, id), plus the ids deleted since,
+read from the continuum version table. Keep requesting links.next while meta.more is true, then
+keep meta.cursor for the next sync. The cursor is opaque to clients.
+
+The endpoint is registered for listable versioned resources at /<type>/sync?filter[cursor]=...
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import base64
+import binascii
+import datetime
+import json
+
+import flask
+
+from models import bases, db
+from . import exceptions
+
+
+def encode_cursor(position):
+    """
+    :param dict position: m modified_at and i id of the last model synced, t transaction_id and d id
+                          of the last deletion synced, d is None once all of t's are synced.
+    :return str: Opaque cursor
+    """
+    position = dict(position, m=position['m'].isoformat() if position['m'] else None)
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode('ascii')
+
+def decode_cursor(cursor):
+    """
+    :param str cursor: Cursor from encode_cursor
+    :return dict: Position, see encode_cursor.
+    :raises exceptions.BadRequest: Not a cursor.
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode())
+        if position['m'] is not None:
+            position['m'] = datetime.datetime.fromisoformat(position['m'])
+        position = {key: position[key] for key in ('m', 'i', 't', 'd')}
+    except (binascii.Error, KeyError, TypeError, ValueError):
+        raise exceptions.BadRequest({'detail': 'filter[cursor] must be a cursor from a sync.',
+                                     'source': {'parameter': 'filter[cursor]'}})
+    return position
+
+def sync_page(schema_class, position=None, limit=bases.SYNC_PAGE_SIZE):
+    """
+    Models changed and deleted since a position, one page of each.
+    :param ourmarshmallow.Schema.__class__ schema_class: Schema of a versioned model
+    :param dict or None position: decode_cursor of the previous sync, None for the first sync.
+    :param int limit: Number of changed models, and of deletions, in the page.
+    :return dict: JSONAPI document of the changed models, meta has the deleted resource identifiers,
+                  the cursor after this page and more when the next page has changes too.
+    """
+    model = schema_class.opts.model
+    until, last_transaction = bases.sync_until()
+    if position is None:
+        # Deletions before the first sync don't matter to the client.
+        position = {'m': None, 'i': None, 't': last_transaction, 'd': None}
+
+    after = (position['m'], position['i']) if position['m'] is not None else None
+    changed = model.changed_since(after, until, limit)
+    deleted = model.deleted_since((position['t'], position['d']), last_transaction, limit)
+    if changed:
+        position.update(m=changed[-1].modified_at, i=changed[-1].id)
+    if deleted:
+        position.update(t=deleted[-1].transaction_id, d=deleted[-1].id)
+    if len(deleted) < limit:
+        # Every deletion up to the watermark is synced.
+        position.update(t=max(position['t'], last_transaction), d=None)
+    if flask.has_request_context():
+        db.release()
+
+    document, _ = schema_class(many=True).dump(changed)
+    document['meta'] = {'deleted': [{'type': schema_class.opts.type_, 'id': str(version.id)}
+                                    for version in deleted],
+                        'cursor': encode_cursor(position),
+                        'more': len(changed) == limit or len(deleted) == limit}
+    return document
+
+def sync_view(schema_class):
+    """
+    Build the Flask view syncing the models of schema_class.
+    :param ourmarshmallow.Schema.__class__ schema_class: Schema of a versioned model
+    :return callable: View function for GET /<type>/sync?filter[cursor]=...
+    """
+    @db.read_only()
+    def _sync():
+        """ A page of the changes since filter[cursor], links.next reads the page after it. """
+        cursor = flask.request.args.get('filter[cursor]')
+        document = sync_page(schema_class, decode_cursor(cursor) if cursor else None)
+        params = flask.request.args.to_dict()
+        params['filter[cursor]'] = document['meta']['cursor']
+        document['links'] = {'self': flask.request.url,
+                             'next': flask.url_for(flask.request.endpoint, _external=True,
+                                                   **params)}
+        return flask.Response(json.dumps(document), mimetype='application/vnd.api+json')
+    return _sync
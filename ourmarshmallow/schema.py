@@ -51,6 +51,16 @@ class SchemaOpts(marshmallow_jsonapi.SchemaOpts, marshmallow_sqlalchemy.ModelSch
             # Always include the many url for resource creation at least
             meta.self_url_many = f'/{type_}'
 
+            # Tenant scoped models get their tenant from the session, never from the client.
+            if hasattr(model, 'tenant_id'):
+                meta.exclude = tuple(getattr(meta, 'exclude', ())) + ('tenant_id',)
+            # The version counter is the resource's ETag, not one of its attributes.
+            if hasattr(model, 'version_id'):
+                meta.exclude = tuple(getattr(meta, 'exclude', ())) + ('version_id',)
+            # sqlalchemy_continuum's versions relationship isn't part of the resource.
+            if getattr(model, '__versioned__', {'versioning': False}).get('versioning', True):
+                meta.exclude = tuple(getattr(meta, 'exclude', ())) + ('versions',)
+
         # Use our custom ModelConverter to turn SQLAlchemy relations into JSONAPI Relationships.
         meta.model_converter = ModelConverter
 
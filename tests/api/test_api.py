@@ -10,6 +10,11 @@ except ImportError:
 
 import warnings
 
+import flask
+import pytest
+
+from models import db, groups
+
 
 warnings.simplefilter("error")  # Make All warnings errors while testing.
 
@@ -18,3 +23,77 @@ def test_health_check(appclient):
     response = appclient.get('/health')
     appclient.validate_response(response, content_type='text/plain')
     assert response.data == b'True'
+
+def test_flushers_started(appclient):
+    """ The background flushers are running once the API has handled a request. """
+    appclient.get('/health')
+    threads = appclient.application.extensions['flushers']
+    assert [thread.name for thread in threads] == ['token-renewals', 'login-rehashes']
+    assert all(thread.is_alive() for thread in threads)
+
+def test_request_session(appclient, dbsession):
+    """
+    The session of a request is committed for successful responses, rolled back for errors and
+    safe requests, and removed at the end of the request.
+    :param flask.testing.FlaskClient appclient: pytest fixture for API client
+    :param models.db dbsession: pytest fixture for database module
+    """
+    def _create(status):
+        groups.Groups(name=f'9b0c1d2e-3f4a-4b5c-9d6e-{status:012}').save(flush=True)
+        return flask.make_response('', status)
+    appclient.application.add_url_rule('/create/<int:status>', 'create', _create,
+                                       methods=('GET', 'POST'))
+
+    assert appclient.post('/create/201').status_code == 201
+    assert appclient.post('/create/409').status_code == 409
+    assert appclient.get('/create/200').status_code == 200
+    assert not db.FACTORY.registry.has() and db.checked_out() == 0
+    names = {group.name for group in dbsession.query(groups.Groups)
+             .filter(groups.Groups.name.like('9b0c1d2e-%'))}
+    assert names == {'9b0c1d2e-3f4a-4b5c-9d6e-000000000201'}
+
+def test_connection_leak(appclient):
+    """
+    A request ending with a connection still checked out fails loudly.
+    :param flask.testing.FlaskClient appclient: pytest fixture for API client
+    """
+    leaked = []
+    def _leak():
+        leaked.append(db.ENGINE.connect())
+        return 'leaked'
+    appclient.application.add_url_rule('/leak', 'leak', _leak)
+
+    with pytest.raises(db.ConnectionLeakError) as excinfo:
+        appclient.get('/leak')
+    leaked[0].close()
+    assert str(excinfo.value) == '1 connections still checked out at the end of GET /leak.'
+
+def test_query_counts(appclient, dbsession, monkeypatch, caplog):
+    """
+    The statements of a request are sent as headers outside of prod, recorded as metrics in prod,
+    and repeated statements are logged as an N+1.
+    :param flask.testing.FlaskClient appclient: pytest fixture for API client
+    :param models.db dbsession: pytest fixture for database module
+    :param monkeypatch: pytest fixture for patching
+    :param caplog: pytest fixture for captured logs
+    """
+    def _lookups(count):
+        for _ in range(count):
+            groups.Groups.get_by_pk(0)
+        return 'done'
+    appclient.application.add_url_rule('/lookups/<int:count>', 'lookups', _lookups)
+    dbsession.close()
+
+    response = appclient.get('/lookups/2')
+    assert response.headers['X-DB-Statements'] == '2'
+    assert float(response.headers['X-DB-Time']) > 0
+    assert 'N+1' not in caplog.text
+
+    monkeypatch.setattr(db, 'ENV', 'prod')
+    monkeypatch.setattr(db, 'N_PLUS_ONE_THRESHOLD', 2)
+    db.QUERY_METRICS.stats()
+    response = appclient.get('/lookups/3')
+    assert 'X-DB-Statements' not in response.headers
+    metrics = db.QUERY_METRICS.stats()['lookups']
+    assert (metrics['requests'], metrics['statements'], metrics['n_plus_one']) == (1, 3, 1)
+    assert 'Likely N+1 in GET /lookups/3' in caplog.text
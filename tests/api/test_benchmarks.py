@@ -0,0 +1,43 @@
+"""
+Tests for the API benchmarks
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import warnings
+
+from api import benchmarks
+from models import groups
+
+
+warnings.simplefilter("error")  # Make All warnings errors while testing.
+
+def test_benchmark_pool(dbsession):
+    """
+    Pool benchmark reports both modes, and deletes its Groups.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    stats = benchmarks.benchmark_pool(concurrency=2, requests=4, rows=3)
+    assert (stats['concurrency'], stats['requests'], stats['rows']) == (2, 4, 3)
+    for mode in ('hold', 'release'):
+        assert stats[mode]['requests_per_sec'] > 0 and 1 <= stats[mode]['peak'] <= 3
+        assert stats[mode]['utilization'] == stats[mode]['mean'] / stats['pool_size']
+    assert dbsession.query(groups.Groups)\
+        .filter(groups.Groups.name.like('%@pool-bench.invalid')).count() == 0
+
+def test_benchmark_read_only(dbsession):
+    """
+    Read only benchmark reports both modes, and deletes its Groups.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    stats = benchmarks.benchmark_read_only(requests=3, rows=2)
+    assert (stats['requests'], stats['rows']) == (3, 2)
+    for mode in ('read_write', 'read_only'):
+        assert stats[mode]['cpu_ms'] > 0 and stats[mode]['db_ms'] > 0
+        assert stats[mode]['statements'] == 1
+    assert dbsession.query(groups.Groups)\
+        .filter(groups.Groups.name.like('%@pool-bench.invalid')).count() == 0
@@ -0,0 +1,37 @@
+"""
+Tests for the Groups JSONAPI Schema.
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import warnings
+
+from api.groups import GroupsSchema
+from models import groups, memberships, profiles
+
+
+warnings.simplefilter("error")  # Make All warnings errors while testing.
+
+def test_member_count_meta(dbsession):
+    """
+    member_count is dumped as metadata and can't be loaded.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    group = groups.Groups(name='5f6a7b8c-9d0e-4f1a-8b2c-3d4e5f6a7b8c')
+    profile = profiles.Profiles(full_name='5f6a7b8c 9d0e1f2a3b4c', email='5f6a@7b8c.9d0e')
+    memberships.Memberships(group=group, profile=profile).save()
+    dbsession.commit()
+
+    data, _ = GroupsSchema().dump(group)
+    assert data['data']['meta']['member_count'] == 1
+    assert 'member_count' not in data['data']['attributes']
+
+    schema = GroupsSchema()
+    schema.load_existing = False
+    the_model, _ = schema.load({'data': {'type': 'groups', 'attributes': {'name': 'x'},
+                                         'meta': {'member_count': 99}}})
+    assert the_model.member_count is None
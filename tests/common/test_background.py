@@ -0,0 +1,61 @@
+"""
+Tests for common background helpers
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import threading
+import warnings
+
+from common import background
+
+
+warnings.simplefilter("error")  # Make All warnings errors while testing.
+
+
+def test_periodic_thread():
+    """ Function is called each interval until the thread is stopped, even after errors. """
+    calls = []
+    called_twice = threading.Event()
+
+    def work():
+        """ Fail on first call to make sure the loop keeps running. """
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError('first run fails')
+        called_twice.set()
+
+    thread = background.PeriodicThread(work, 0.01)
+    thread.start()
+    assert called_twice.wait(5)
+    thread.stop(5)
+    assert not thread.is_alive()
+    assert thread.daemon
+
+def test_periodic_thread_run_on_stop():
+    """ Stopping the thread can run the function one last time to flush any remaining work. """
+    calls = []
+    thread = background.PeriodicThread(calls.append, 60, args=(1,), run_on_stop=True)
+    thread.start()
+    thread.stop(5)
+    assert calls == [1]
+
+def test_coalescing_buffer():
+    """ Pending values for the same key replace each other, restore doesn't clobber new values. """
+    buffer = background.CoalescingBuffer()
+    buffer.put(1, 'a')
+    buffer.put(1, 'b')
+    buffer.put(2, 'c')
+    assert len(buffer) == 2
+
+    pending = buffer.drain()
+    assert pending == {1: 'b', 2: 'c'}
+    assert not buffer
+
+    buffer.put(2, 'd')
+    buffer.restore(pending)
+    assert buffer.drain() == {1: 'b', 2: 'd'}
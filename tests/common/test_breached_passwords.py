@@ -0,0 +1,76 @@
+"""
+Tests for the breached passwords index
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import hashlib
+import warnings
+
+import pytest
+
+from common import breached_passwords, utilities
+
+
+warnings.simplefilter("error")  # Make All warnings errors while testing.
+
+CORPUS = ['hunter2', 'correct horse battery staple', 'Tr0ub4dor&3', 'hunter2', '', 'ünïcödé']
+
+
+def test_build_lookup(tmpdir):
+    """ Passwords in the corpus are found, exactly as written, duplicates are removed. """
+    path = str(tmpdir.join('breached.idx'))
+    assert breached_passwords.build(CORPUS, path) == 4
+
+    index = breached_passwords.BreachedPasswordIndex(path)
+    assert len(index) == 4
+    for password in ('hunter2', 'correct horse battery staple', 'Tr0ub4dor&3', 'ünïcödé'):
+        assert password in index
+    assert 'Hunter2' not in index
+    assert '3f2e1d0c-b9a8-4765-8432-10fedcba9876' not in index
+    index.close()
+
+def test_build_sha1(tmpdir):
+    """ Corpus can be SHA-1 hex digests with counts. """
+    lines = [hashlib.sha1(password.encode('utf8')).hexdigest().upper() + ':42\n'
+             for password in CORPUS if password]
+    path = str(tmpdir.join('breached.idx'))
+    assert breached_passwords.build(lines, path, sha1=True) == 4
+
+    index = breached_passwords.BreachedPasswordIndex(path)
+    assert 'Tr0ub4dor&3' in index
+    assert 'tr0ub4dor&3' not in index
+    index.close()
+
+def test_not_an_index(tmpdir):
+    """ Other files are rejected. """
+    path = tmpdir.join('passwords.txt')
+    path.write('hunter2\n' * 100)
+    with pytest.raises(ValueError):
+        breached_passwords.BreachedPasswordIndex(str(path))
+
+def test_is_common_password(tmpdir, monkeypatch):
+    """ is_common_password also checks the configured index. """
+    path = str(tmpdir.join('breached.idx'))
+    breached_passwords.build(CORPUS, path)
+    assert not utilities.is_common_password('Tr0ub4dor&3')
+
+    monkeypatch.setattr(breached_passwords, 'INDEX_PATH', path)
+    monkeypatch.setattr(breached_passwords, '_INDEX', None)
+    assert utilities.is_common_password('Tr0ub4dor&3')
+    assert utilities.is_common_password('password')
+    assert not utilities.is_common_password('6a5b4c3d-2e1f-4a0b-9c8d-7e6f5a4b3c2d')
+    breached_passwords.get_index().close()
+
+def test_benchmark(tmpdir):
+    """ Benchmark reports lookup latency and RSS. """
+    path = str(tmpdir.join('breached.idx'))
+    breached_passwords.build(CORPUS, path)
+    stats = breached_passwords.benchmark(path, lookups=100)
+    assert stats['entries'] == 4
+    assert stats['usec_per_lookup'] > 0
+    assert stats['rss_kb_after'] > 0
@@ -0,0 +1,124 @@
+"""
+Tests for the password hashing service
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import concurrent.futures
+import os
+import signal
+import warnings
+
+import pytest
+
+from common import hashing
+
+
+warnings.simplefilter("error")  # Make All warnings errors while testing.
+
+
+def test_hash_verify_pool():
+    """ Hash and verify on the process pool and record metrics. """
+    hasher = hashing.PasswordHasher(workers=1, max_pending=2, max_wait=5)
+    try:
+        hashed = hasher.hash('e4d9c6a2-7f1b-4a8e-b3c5-9d0f2e6a1b7c').result()
+        assert hashed.startswith(b'$2b$')
+        assert hasher.verify('e4d9c6a2-7f1b-4a8e-b3c5-9d0f2e6a1b7c', hashed).result() is True
+        assert hasher.verify('wrong password', hashed).result() is False
+
+        stats = hasher.stats()
+        assert stats['queue_depth'] == 0
+        assert stats['hashes'] == 3
+        assert stats['mean_hash_seconds'] > 0
+        assert stats['rejected'] == 0
+    finally:
+        hasher.shutdown()
+
+def test_hash_inline():
+    """ With no workers the hashing happens in the calling thread, errors come from the future. """
+    hasher = hashing.PasswordHasher(workers=0)
+    hashed = hasher.hash('7b3e1f0c-2d4a-4c6b-8e9f-a1b2c3d4e5f6').result()
+    assert hasher.verify('7b3e1f0c-2d4a-4c6b-8e9f-a1b2c3d4e5f6', hashed).result() is True
+
+    with pytest.raises(ValueError):
+        hasher.verify('7b3e1f0c-2d4a-4c6b-8e9f-a1b2c3d4e5f6', b'not a hash').result()
+    assert hasher.stats()['queue_depth'] == 0
+
+def test_hash_busy():
+    """ Requests that can't be admitted within max_wait are rejected. """
+    hasher = hashing.PasswordHasher(workers=0, max_pending=1, max_wait=0.01)
+    hasher._slots.acquire()  # pylint: disable=protected-access
+    with pytest.raises(hashing.HasherBusyError):
+        hasher.hash('0a9b8c7d-6e5f-4a3b-2c1d-0e9f8a7b6c5d')
+    assert hasher.stats()['rejected'] == 1
+
+def test_broken_pool():
+    """ A killed hashing process doesn't leak slots, the next request gets a new pool. """
+    hasher = hashing.PasswordHasher(workers=1, max_pending=1, max_wait=0.1, rounds=4)
+    try:
+        hasher.hash('warm up').result()
+        for pid in list(hasher._executor._processes):  # pylint: disable=protected-access
+            os.kill(pid, signal.SIGKILL)
+        for _ in range(3):
+            try:
+                hasher.hash('after the crash').result()
+            except concurrent.futures.process.BrokenProcessPool:
+                pass
+        assert hasher.stats()['queue_depth'] == 0
+        assert hasher.hash('recovered').result().startswith(b'$2b$04$')
+    finally:
+        hasher.shutdown()
+
+def test_is_bcrypt_hash():
+    """ Only complete bcrypt hashes are accepted. """
+    hashed = hashing.PasswordHasher(workers=0, rounds=4).hash('a1b2c3d4e5').result()
+    assert hashing.is_bcrypt_hash(hashed)
+    assert not hashing.is_bcrypt_hash(hashed[:-1])
+    assert not hashing.is_bcrypt_hash(hashed + b'.')
+    assert not hashing.is_bcrypt_hash(hashed[:-1] + b'!')
+    assert not hashing.is_bcrypt_hash(b'$2b$99$' + hashed[7:])
+    assert not hashing.is_bcrypt_hash(b'$1$' + hashed[3:])
+
+def test_rounds():
+    """ Hashes use the configured cost, other costs need a rehash. """
+    hasher = hashing.PasswordHasher(workers=0, rounds=4)
+    hashed = hasher.hash('1f2e3d4c-5b6a-4978-8a6b-5c4d3e2f1a0b').result()
+    assert hashing.hash_rounds(hashed) == 4
+    assert not hasher.needs_rehash(hashed)
+
+    hasher.rounds = 5
+    assert hasher.needs_rehash(hashed)
+
+def test_calibrate():
+    """ Calibration stops at the first cost over the target time. """
+    best, timings = hashing.calibrate(target_seconds=0, min_rounds=4, max_rounds=6)
+    assert best == 4
+    assert list(timings) == [4]
+
+    best, timings = hashing.calibrate(target_seconds=60, min_rounds=4, max_rounds=6)
+    assert best == 6
+    assert list(timings) == [4, 5, 6]
+
+def test_verify_any():
+    """ Any matching hash is found, no match is False. """
+    hasher = hashing.PasswordHasher(workers=2, rounds=4)
+    try:
+        hashes = [hasher.hash(password).result() for password in ('a1', 'b2', 'c3')]
+        assert hasher.verify_any('b2', hashes) is True
+        assert hasher.verify_any('d4', hashes) is False
+        assert hasher.verify_any('d4', []) is False
+    finally:
+        hasher.shutdown()
+    # Checks left running after a match finish in the background, they're done after shutdown.
+    assert hasher.stats()['queue_depth'] == 0
+
+def test_benchmark_verify_any():
+    """ Benchmark reports both timings. """
+    stats = hashing.benchmark_verify_any(depth=2, workers=1, rounds=4)
+    assert stats['depth'] == 2
+    assert stats['sequential_seconds'] > 0
+    assert stats['parallel_seconds'] > 0
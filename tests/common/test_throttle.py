@@ -0,0 +1,91 @@
+"""
+Tests for the login throttle
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import multiprocessing
+import warnings
+
+import pytest
+
+from common import throttle
+
+
+warnings.simplefilter("error")  # Make All warnings errors while testing.
+
+
+@pytest.fixture
+def counters(tmpdir, monkeypatch):
+    """
+    Counters table in a temporary file, used by check_login.
+    :param py.path.local tmpdir: pytest fixture for a temporary directory
+    :param monkeypatch: pytest fixture for patching the module
+    :return throttle.SlidingWindowCounters: Empty counters table
+    """
+    table = throttle.SlidingWindowCounters(str(tmpdir.join('throttle')), slots=64)
+    monkeypatch.setattr(throttle, '_COUNTERS', table)
+    yield table
+    table.close()
+
+def _hit(path, key):
+    """ Count an attempt from another process. """
+    table = throttle.SlidingWindowCounters(path, slots=64)
+    table.hit(key, 10, 60, now=1000)
+    table.close()
+
+def test_sliding_window(counters):  # pylint: disable=redefined-outer-name
+    """ Attempts over the limit are rejected, the previous window's count decays. """
+    assert [counters.hit('a', 3, 60, now=600) for _ in range(4)] == [True, True, True, False]
+    assert counters.hit('b', 3, 60, now=600)
+
+    # Half way through the next window half of the previous count remains: 1.5 + 1 < 3
+    assert [counters.hit('a', 3, 60, now=690) for _ in range(3)] == [True, True, False]
+
+    # Two windows later everything is forgotten.
+    assert counters.hit('a', 3, 60, now=800)
+
+    counters.reset('a')
+    assert [counters.hit('a', 1, 60, now=800) for _ in range(2)] == [True, False]
+
+def test_shared(counters):  # pylint: disable=redefined-outer-name
+    """ Processes using the same file share the counts. """
+    process = multiprocessing.Process(target=_hit, args=(counters.path, 'c'))
+    process.start()
+    process.join()
+    assert counters.hit('c', 2, 60, now=1000)
+    assert not counters.hit('c', 2, 60, now=1000)
+
+def test_eviction(counters):  # pylint: disable=redefined-outer-name
+    """ A full table reuses slots instead of failing. """
+    for idx in range(200):
+        assert counters.hit(f'key {idx}', 1, 60, now=1000)
+
+def test_check_login(counters):  # pylint: disable=redefined-outer-name,unused-argument
+    """ Email addresses and client IPs are throttled separately. """
+    for _ in range(throttle.LOGIN_EMAIL_LIMIT):
+        throttle.check_login('1a2b@3c4d.5e6f', '10.0.0.1', now=1000)
+    with pytest.raises(throttle.ThrottledError):
+        throttle.check_login('1A2B@3c4d.5e6f', '10.0.0.2', now=1000)
+
+    throttle.reset_login('1a2b@3c4d.5e6f')
+    throttle.check_login('1a2b@3c4d.5e6f', '10.0.0.2', now=1000)
+
+    for idx in range(throttle.LOGIN_IP_LIMIT - throttle.LOGIN_EMAIL_LIMIT):
+        throttle.check_login(f'{idx}@3c4d.5e6f', '10.0.0.1', now=1000)
+    with pytest.raises(throttle.ThrottledError):
+        throttle.check_login('7a8b@3c4d.5e6f', '10.0.0.1', now=1000)
+
+def test_throttled_ip_spares_email(counters):  # pylint: disable=redefined-outer-name,unused-argument
+    """ Attempts from a throttled client IP don't use up the email address's attempts. """
+    for idx in range(throttle.LOGIN_IP_LIMIT):
+        throttle.check_login(f'{idx}@9f8e.7d6c', '10.0.0.3', now=1000)
+    for _ in range(throttle.LOGIN_EMAIL_LIMIT * 2):
+        with pytest.raises(throttle.ThrottledError):
+            throttle.check_login('5b4a@9f8e.7d6c', '10.0.0.3', now=1000)
+    for _ in range(throttle.LOGIN_EMAIL_LIMIT):
+        throttle.check_login('5b4a@9f8e.7d6c', '10.0.0.4', now=1000)
@@ -2,6 +2,7 @@
 Configuration for py.tests. Does things like setup the database and flask app for individual tests.
 https://gist.github.com/alexmic/7857543
 """
+import contextlib
 import warnings
 
 import pytest
@@ -83,3 +84,27 @@ def dbsession(createdb):  # pylint: disable=redefined-outer-name
 
     # Will automatically rollback if not commited in test
     createdb.close()
+
+
+@pytest.fixture(scope='function')
+def assert_queries():
+    """
+    Assert the number of statements run in a block, and that none was repeated like an N+1:
+        with assert_queries(2):
+            ...
+    :return callable: Context manager taking count, the exact number of statements, or at_most, and
+                      yielding the models.db.QueryCounter.
+    """
+    @contextlib.contextmanager
+    def _assert_queries(count=None, at_most=None):
+        with models.db.count_queries() as counter:
+            yield counter
+        statements = '\n'.join(f'{number} x {statement}'
+                                for statement, number in counter.by_statement.most_common())
+        assert count is None or counter.statements == count, \
+            f'{counter.statements} statements instead of {count}:\n{statements}'
+        assert at_most is None or counter.statements <= at_most, \
+            f'{counter.statements} statements, more than {at_most}:\n{statements}'
+        assert not counter.repeated(), f'Likely N+1:\n{statements}'
+
+    return _assert_queries
@@ -13,9 +13,11 @@ import re
 import warnings
 
 import pytest
+import sqlalchemy as sa
 from sqlalchemy.exc import IntegrityError
 
 from models import authentication_tokens as autht
+from models import forgot_password_tokens as fpt
 from models import logins, profiles
 
 
@@ -140,3 +142,57 @@ def test_get_by_token(dbsession):  # pylint: disable=unused-argument
 
     # Now it can be found.
     assert autht.AuthenticationTokens.get_by_token(token.token) is token
+
+def test_renew(dbsession):
+    """
+    Using a token queues a renewal instead of writing it, at most once per RENEWAL_INTERVAL.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    profile = profiles.Profiles(full_name='6f0f2b1e 5d7c4a8e9b3c', email='1c9d@4e6a.b2f7')
+    login = logins.Logins(password='0f6c8a9e-3b2d-4c5e-9a7f-1e8d2b4c6a0f', profile=profile)
+    now = datetime.datetime.utcnow()
+    token = autht.AuthenticationTokens(login=login,
+                                       expiration_dt=now + datetime.timedelta(minutes=5))
+    token.save()
+    dbsession.commit()
+    autht.RENEWALS.drain()  # Ignore renewals queued by other tests.
+
+    found = autht.AuthenticationTokens.get_by_token(token.token)
+    assert found is token
+    assert token not in dbsession.connect().dirty
+    assert len(autht.RENEWALS) == 1
+
+    # Using the token again before the flush coalesces into the same renewal.
+    assert token.renew()
+    assert len(autht.RENEWALS) == 1
+
+    assert autht.AuthenticationTokens.flush_renewals() == 1
+    assert not autht.RENEWALS
+
+    dbsession.connect().expire(token)
+    assert token.expiration_dt >= now + autht.SESSION_LENGTH
+    # Recently renewed so there is nothing to write.
+    assert not token.renew()
+    assert autht.AuthenticationTokens.flush_renewals() == 0
+
+def test_renew_unsaved():
+    """ Tokens without an id can't be renewed. """
+    token = autht.AuthenticationTokens(expiration_dt=datetime.datetime.utcnow())
+    assert not token.renew()
+
+def test_unversioned(dbsession):
+    """
+    AuthenticationTokens opt out of versioning, models that don't get a version per write.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    assert not dbsession.ENGINE.has_table('authentication_tokens_version')
+    profile = profiles.Profiles(full_name='3c9e1a7d 5f2b8e4c6a0d', email='3c9e@1a7d.5f2b')
+    login = logins.Logins(password='3c9e1a7d-5f2b-4e4c-8a0d-9b6f7e1c2d3a', profile=profile)
+    token = autht.AuthenticationTokens(login=login)
+    forgot = fpt.ForgotPasswordTokens(login=login)
+    for model in (profile, login, token, forgot):
+        model.save()
+    dbsession.commit()
+    assert not hasattr(token, 'versions')
+    assert [version.token for version in forgot.versions] == [forgot.token]
+    assert sa.inspect(forgot.versions[0]).mapper.local_table.name == 'forgot_password_tokens_version'
@@ -69,7 +69,7 @@ def test_base_repr():
                            'pkey=<not loaded>)')
     dmodel = DummyModel()
     assert repr(dmodel) == ('tests.models.test_base.DummyModel(modified_at=<not loaded>, '
-                            'id=<not loaded>, email=<not loaded>)')
+                            'id=<not loaded>, version_id=<not loaded>, email=<not loaded>)')
 
 def test_base_default_fields():
     """
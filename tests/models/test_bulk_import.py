@@ -0,0 +1,123 @@
+"""
+Tests for the bulk import pipeline
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import json
+import warnings
+
+import pytest
+
+from models import bulk_import, groups, logins, memberships, profiles
+
+
+warnings.simplefilter("error")  # Make All warnings errors while testing.
+
+def test_import_csv(dbsession, tmpdir):
+    """
+    Valid new people are created with Logins and Memberships, everything else is counted.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    group = groups.Groups(name='b1c2d3e4 import')
+    group.save()
+    profiles.Profiles(full_name='c2d3e4f5 a6b7c8d9e0f1', email='C2D3@e4f5.a6b7').save()
+    dbsession.commit()
+    group_id = group.id
+
+    path = tmpdir.join('people.csv')
+    path.write_text('\n'.join((
+        'email,full_name,password,group_ids',
+        f'd3e4@f5a6.b7c8,Dee Import,d3e4f5a6-b7c8-4d9e-8f0a-1b2c3d4e5f6a,{group_id}',
+        'e4f5@a6b7.c8d9,Eve Import,,',
+        'E4F5@a6b7.c8d9,Eve Again,,',
+        'c2d3@e4f5.a6b7,Existing Person,,',
+        'not an email,Bad Email,,',
+        'f5a6@b7c8.d9e0,Bad Password,password,',
+        f'a6b7@c8d9.e0f1,Bad Group,,{group_id};999999',
+    )), encoding='utf8')
+    stats = bulk_import.import_file(str(path), batch_size=3, hash_workers=1)
+
+    assert {key: stats[key] for key in ('read', 'created', 'logins', 'memberships', 'existing',
+                                        'duplicates', 'invalid')} == \
+        {'read': 7, 'created': 2, 'logins': 1, 'memberships': 1, 'existing': 1, 'duplicates': 1,
+         'invalid': 3}
+    assert [number for number, _ in stats['errors']] == [5, 6, 7]
+
+    login = logins.Logins.get_by_email('d3e4@f5a6.b7c8')
+    assert login.is_valid_password('d3e4f5a6-b7c8-4d9e-8f0a-1b2c3d4e5f6a')
+    assert login.profile.full_name == 'Dee Import'
+    assert [membership.group_id for membership in login.profile.memberships] == [group_id]
+    assert profiles.Profiles.get_by_email('e4f5@a6b7.c8d9').login is None
+    assert memberships.Memberships.get_all({'group_id': group_id})[0].profile is login.profile
+    # Versioned in one transaction, like the sessions' writes.
+    versions = [login.profile.versions.one(), login.versions.one(),
+                login.profile.memberships[0].versions.one()]
+    assert {version.operation_type for version in versions} == {0}
+    assert len({version.transaction_id for version in versions}) == 1
+
+def test_import_ndjson_resume(dbsession, tmpdir, monkeypatch):
+    """
+    A crashed NDJSON import resumes from its checkpoint after the last committed batch.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    path = tmpdir.join('people.ndjson')
+    records = [{'email': f'{idx}@f6a7.b8c9', 'full_name': f'Person {idx}'} for idx in range(5)]
+    records[4]['password_hash'] = logins.Logins(password='f6a7b8c9-d0e1-4f2a-8b3c-4d5e6f7a8b9c')\
+        .password.decode('ascii')
+    path.write_text('\n'.join([json.dumps(record) for record in records] + ['', '{bad json']),
+                    encoding='utf8')
+    checkpoint = tmpdir.join('people.ckpt')
+
+    original = bulk_import.Importer.import_batch
+    def _crash(self, batch):
+        if batch[0][0] == 5:
+            raise RuntimeError('crash')
+        original(self, batch)
+    monkeypatch.setattr(bulk_import.Importer, 'import_batch', _crash)
+    with pytest.raises(RuntimeError):
+        bulk_import.import_file(str(path), str(checkpoint), batch_size=2, hash_workers=1)
+    assert json.loads(checkpoint.read_text('utf8'))['records_done'] == 4
+
+    monkeypatch.setattr(bulk_import.Importer, 'import_batch', original)
+    stats = bulk_import.import_file(str(path), str(checkpoint), batch_size=2, hash_workers=1)
+    assert (stats['read'], stats['created'], stats['logins'], stats['invalid']) == (6, 5, 1, 1)
+    assert not checkpoint.exists()
+    assert logins.Logins.get_by_email('4@f6a7.b8c9')\
+        .is_valid_password('f6a7b8c9-d0e1-4f2a-8b3c-4d5e6f7a8b9c')
+    dbsession.close()
+
+def test_validate_password_hash():
+    """ Truncated or garbled password hashes are rejected before they're stored. """
+    hashed = logins.Logins(password='a7b8c9d0-e1f2-4a3b-8c4d-5e6f7a8b9c0d').password.decode('ascii')
+    record = {'email': 'a7b8@c9d0.e1f2', 'full_name': 'Hash Import', 'password_hash': hashed}
+    assert bulk_import.validate_record(record)['password_hash'] == hashed.encode('ascii')
+
+    for bad_hash in (hashed[:40], hashed[:-1] + '*', hashed[:-1] + 'ü', '$2b$xx$' + hashed[7:]):
+        with pytest.raises(ValueError):
+            bulk_import.validate_record(dict(record, password_hash=bad_hash))
+
+def test_checkpoint_other_file(tmpdir):
+    """ A checkpoint for another file isn't used. """
+    path = tmpdir.join('people.csv')
+    path.write_text('email,full_name\n', encoding='utf8')
+    checkpoint = tmpdir.join('people.ckpt')
+    checkpoint.write_text(json.dumps({'source': '/elsewhere.csv', 'source_size': 16,
+                                      'records_done': 1, 'stats': {}}), encoding='utf8')
+    with pytest.raises(ValueError):
+        bulk_import.import_file(str(path), str(checkpoint))
+
+def test_benchmark(dbsession):
+    """
+    Benchmark imports and removes generated people.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    stats = bulk_import.benchmark(rows=30, batch_size=10, passwords=2)
+    assert (stats['created'], stats['logins']) == (30, 2)
+    assert stats['rows_per_sec'] > 0
+    assert dbsession.query(profiles.Profiles)\
+        .filter(profiles.Profiles.email.like('%@import-bench.invalid')).count() == 0
@@ -11,14 +11,32 @@ except ImportError:
 import os
 import warnings
 
+import pytest
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
 from sqlalchemy.engine.base import Engine
 from sqlalchemy.orm.scoping import scoped_session
 
-from models import db
+from models import bases, db, groups, maintenance, tenancy
 
 
 warnings.simplefilter("error")  # Make All warnings errors while testing.
 
+class Ledgers(bases.BaseModel, tenancy.TenantScoped):
+    """ Tenant scoped model for testing shards. """
+    name = sa.Column(sa.String(50), nullable=False)
+
+    entries = saorm.relationship('Entries', back_populates='ledger')
+
+
+class Entries(bases.BaseModel, tenancy.TenantScoped):
+    """ Tenant scoped model related to Ledgers for testing shards. """
+    ledger_id = sa.Column(sa.Integer, sa.ForeignKey('ledgers.id'), nullable=False)
+    amount = sa.Column(sa.Integer, nullable=False)
+
+    ledger = saorm.relationship('Ledgers', back_populates='entries')
+
+
 def test_env():
     """ Default environment should be dev. """
     assert not os.environ.get('ENV')  # First confirm that there isn't an ENV set.
@@ -40,3 +58,155 @@ def test_engine():
 def test_factory():
     """ create and drop tables commands need ENGINE exposed """
     assert isinstance(db.FACTORY, scoped_session)
+
+def _sqlite_shard(tmpdir, monkeypatch):
+    """
+    Add a SQLite file shard with the tenant scoped tables, and an empty shard map.
+    :param tmpdir: pytest fixture for a temporary directory
+    :param monkeypatch: pytest fixture to restore the shard configuration
+    :return sqlalchemy.engine.Engine: Engine of the shard
+    """
+    engine = sa.create_engine(f'sqlite:///{tmpdir}/shard.db',
+                              connect_args={'check_same_thread': False})
+    bases.Base.metadata.create_all(engine, tables=maintenance.tenant_tables())
+    monkeypatch.setitem(db.SHARDS, 'sqlite', engine)
+    monkeypatch.setattr(db, 'TENANT_SHARDS', {})
+    return engine
+
+def test_shard_map(monkeypatch):
+    """ Tenants are on the default shard until assigned to another. """
+    monkeypatch.setattr(db, 'TENANT_SHARDS', {})
+    monkeypatch.setitem(db.SHARDS, 'other', db.ENGINE)
+    assert db.shard_for(7) == db.DEFAULT_SHARD
+    db.assign_tenant(7, 'other')
+    assert db.shard_for(7) == 'other'
+    db.assign_tenant(7, db.DEFAULT_SHARD)
+    assert db.TENANT_SHARDS == {}
+    with pytest.raises(KeyError):
+        db.assign_tenant(7, 'missing')
+
+def test_routing(dbsession, tmpdir, monkeypatch):
+    """
+    A tenant's models are written to and read from its shard, global models stay on the default.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    engine = _sqlite_shard(tmpdir, monkeypatch)
+    db.assign_tenant(51, 'sqlite')
+    tenancy.set_tenant(51)
+    ledger = Ledgers(name='5a1b2c3d')
+    ledger.entries.append(Entries(amount=3))
+    ledger.save()
+    group = groups.Groups(name='5a1b2c3d-4e5f-4a6b-8c7d-8e9f0a1b2c3d')
+    group.save()
+    dbsession.commit()
+
+    assert engine.scalar('SELECT count(*) FROM entries WHERE tenant_id = 51') == 1
+    assert db.ENGINE.scalar('SELECT count(*) FROM ledgers WHERE tenant_id = 51') == 0
+    assert db.ENGINE.scalar(f'SELECT count(*) FROM groups WHERE id = {group.id}') == 1
+    ledger_id = ledger.id
+    dbsession.close()
+
+    tenancy.set_tenant(51)
+    ledger = Ledgers.get_by_pk(ledger_id)
+    assert [entry.amount for entry in ledger.entries] == [3]
+
+def test_scatter_gather(dbsession, tmpdir, monkeypatch):
+    """
+    Without a tenant, queries read every shard and merge the rows in order.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    _sqlite_shard(tmpdir, monkeypatch)
+    db.assign_tenant(62, 'sqlite')
+    for tenant_id, names in ((61, ('b', 'd')), (62, ('a', 'c', 'e'))):
+        tenancy.set_tenant(tenant_id)
+        for name in names:
+            Ledgers(name=name).save()
+        dbsession.commit()
+        dbsession.close()
+
+    found = Ledgers.get_all({'tenant_id': [61, 62]})
+    assert sorted((ledger.tenant_id, ledger.name) for ledger in found) == \
+        [(61, 'b'), (61, 'd'), (62, 'a'), (62, 'c'), (62, 'e')]
+    assert [ledger.id for ledger in found] == sorted(ledger.id for ledger in found)
+
+    query = dbsession.query(Ledgers).filter(Ledgers.tenant_id.in_([61, 62]))
+    assert [ledger.name for ledger in query.order_by(Ledgers.name.desc()).limit(4)] == \
+        ['e', 'd', 'c', 'b']
+    assert [ledger.name for ledger in query.order_by(Ledgers.name).offset(1).limit(2)] == \
+        ['b', 'c']
+    assert [ledger.name for ledger in query.order_by(Ledgers.name).offset(3)] == ['d', 'e']
+    assert query.count() == 5
+    assert dbsession.connect().query(sa.func.count(Ledgers.id), sa.func.min(Ledgers.name),
+                                     sa.func.max(Ledgers.name)).one() == (5, 'a', 'e')
+    with pytest.raises(NotImplementedError):
+        dbsession.connect().query(Ledgers.tenant_id, sa.func.count(Ledgers.id)) \
+            .group_by(Ledgers.tenant_id).all()
+    with pytest.raises(NotImplementedError):
+        query.order_by(sa.func.lower(Ledgers.name)).all()
+
+def test_release(dbsession):
+    """
+    Releasing returns the session's connection to the pool, the loaded models stay usable.
+    :param models.db dbsession: pytest fixture for database module
+    """
+    group = groups.Groups(name='8a9b0c1d-2e3f-4a5b-8c6d-7e8f9a0b1c2d')
+    group.save()
+    dbsession.commit()
+    group_id = group.id
+    dbsession.close()
+
+    group = groups.Groups.get_by_pk(group_id)
+    assert db.checked_out() == 1
+    db.release()
+    assert db.checked_out() == 0
+    assert group.name == '8a9b0c1d-2e3f-4a5b-8c6d-7e8f9a0b1c2d' and db.checked_out() == 0
+    groups.Groups.get_by_pk(group_id)
+    assert db.checked_out() == 1
+
+def test_read_only(dbsession, monkeypatch):
+    """
+    Read only sessions don't autoflush, can't write and read from the replica when there is one.
+    :param models.db dbsession: pytest fixture for database module
+    :param monkeypatch: pytest fixture for patching
+    """
+    replica = sa.create_engine(str(db.ENGINE.url))
+    monkeypatch.setitem(db.REPLICAS, db.DEFAULT_SHARD, replica)
+    dbsession.commit()
+
+    with pytest.raises(sa.exc.InternalError):
+        with db.read_only() as session:
+            assert session.autoflush is False
+            assert session.get_bind(mapper=saorm.class_mapper(groups.Groups)) is replica
+            assert session.execute('SHOW transaction_read_only').scalar() == 'on'
+            groups.Groups(name='0c1d2e3f-4a5b-4c6d-8e7f-8a9b0c1d2e3f').save(flush=True)
+    session = dbsession.connect()
+    assert session.autoflush is True and db.READ_ONLY not in session.info
+    assert session.get_bind(mapper=saorm.class_mapper(groups.Groups)) is db.ENGINE
+    assert session.execute('SHOW transaction_read_only').scalar() == 'off'
+    replica.dispose()
+
+def test_count_queries(dbsession):
+    """
+    Statements are counted per thread, nested counts see them too, repeats are reported as N+1.
+    :param models.db dbsession: pytest fixture for database module
+    """
+    assert db.normalize_sql("SELECT a FROM t WHERE id IN (%(id_1)s, %(id_2)s) AND b = 'x''y'\n"
+                            "AND c > 12.5") == 'SELECT a FROM t WHERE id IN (?) AND b = ? AND c > ?'
+    created = [groups.Groups(name=f'1d2e3f4a-5b6c-4d7e-9f8a-{idx:012}') for idx in range(3)]
+    for group in created:
+        group.save()
+    dbsession.commit()
+    group_ids = [group.id for group in created]
+    dbsession.close()
+
+    with db.count_queries() as outer:
+        groups.Groups.get_all()
+        with db.count_queries() as inner:
+            for group_id in group_ids:
+                groups.Groups.get_by_pk(group_id)
+    groups.Groups.get_by_pk(group_ids[0])
+    assert (outer.statements, inner.statements) == (4, 3)
+    assert outer.seconds >= inner.seconds > 0
+    [(statement, count)] = inner.repeated(threshold=2)
+    assert count == 3 and statement.endswith('WHERE groups.id = ?')
+    assert inner.repeated() == []
@@ -53,3 +53,41 @@ def test_memberships_relation(dbsession):
     assert len(group.memberships) == 2
     assert membership1 in group.memberships
     assert membership2 in group.memberships
+
+def test_member_count(dbsession):
+    """
+    member_count follows Memberships added and removed with the ORM, in bulk, and in plain SQL.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    group = groups.Groups(name='3c4d5e6f-7a8b-4c9d-8e0f-1a2b3c4d5e6f')
+    other = groups.Groups(name='9e8d7c6b-5a4f-4e3d-8c2b-1a0f9e8d7c6b')
+    people = [profiles.Profiles(full_name=f'3c4d5e6f {idx:012}', email=f'{idx}@3c4d.5e6f')
+              for idx in range(4)]
+    membership = memberships.Memberships(group=group, profile=people[0])
+    membership.save()
+    other.save()
+    for profile in people:
+        profile.save()
+    dbsession.commit()
+    assert (group.member_count, other.member_count) == (1, 0)
+
+    # Counted in the transaction, before the commit, and synced as a change of the Group.
+    modified_at = group.modified_at
+    assert memberships.Memberships.add_many([(group.id, profile.id) for profile in people]) == 3
+    assert group.member_count == 4 and group.modified_at > modified_at
+
+    membership.group = other
+    dbsession.commit()
+    assert (group.member_count, other.member_count) == (3, 1)
+
+    assert memberships.Memberships.remove_many([(group.id, people[1].id)]) == 1
+    membership.delete()
+    dbsession.commit()
+    assert (group.member_count, other.member_count) == (2, 0)
+
+    session = dbsession.connect()
+    session.execute(f'DELETE FROM memberships WHERE group_id = {group.id}')
+    session.expire(group, ['member_count'])
+    assert group.member_count == 0
+    dbsession.rollback()
+    assert group.member_count == 2
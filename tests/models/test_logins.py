@@ -13,6 +13,7 @@ import warnings
 import pytest
 from sqlalchemy.exc import IntegrityError
 
+from common import hashing, throttle
 from models import logins, profiles
 
 
@@ -227,3 +228,116 @@ def test_required_profile(dbsession):
 
     dbsession.commit()
     assert login.email == profile.email
+
+def test_email_change_skips_bcrypt(dbsession, monkeypatch):
+    """
+    The email of a saved Login follows its Profile without any bcrypt work, the check is done once
+    by Profiles.change_email. Setting the email of a saved Login is still checked.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    hasher = hashing.PasswordHasher(workers=0, rounds=4)
+    monkeypatch.setattr(hashing, 'HASHER', hasher)
+    login = logins.Logins(password='5f4e@4d3c.2b1a')
+    login.profile = profiles.Profiles(full_name='7b6a5f4e 3d2c1b0a9f8e', email='1a2b@4c3d.5e6f')
+    login.save()
+    dbsession.commit()
+    hashes = hasher.stats()['hashes']
+
+    with pytest.raises(ValueError):
+        login.email = '5f4e@4d3c.2b1a'
+    assert login.email == '1a2b@4c3d.5e6f'
+    assert hasher.stats()['hashes'] == hashes + 1
+
+    with pytest.raises(ValueError):
+        login.profile.change_email('5f4e@4d3c.2b1a')
+    assert hasher.stats()['hashes'] == hashes + 2
+    assert login.profile.email == '1a2b@4c3d.5e6f'
+
+    login.profile.change_email('9c8d@4e7f.6a5b')
+    dbsession.commit()
+    assert login.email == '9c8d@4e7f.6a5b'
+    assert hasher.stats()['hashes'] == hashes + 3
+
+def test_rehash_stale_cost(dbsession, monkeypatch):
+    """
+    A successful password check against a hash with a stale cost queues an upgraded hash, which is
+    written later by flush_rehashes.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    monkeypatch.setattr(hashing, 'HASHER', hashing.PasswordHasher(workers=0, rounds=4))
+    passwd = 'a8b7c6d5-e4f3-4a2b-9c1d-0e9f8a7b6c5d'
+    login = logins.Logins(password=passwd)
+    login.profile = profiles.Profiles(full_name='2d3e4f5a 6b7c8d9e0f1a', email='e0f1@4a2b.3c4d')
+    login.save()
+    dbsession.commit()
+    logins.REHASHES.drain()  # Ignore rehashes queued by other tests.
+
+    # Nothing to do when the cost is current.
+    assert login.is_valid_password(passwd)
+    assert not logins.REHASHES
+
+    hashing.HASHER.rounds = 5
+    assert not login.is_valid_password(passwd[:10])
+    assert not logins.REHASHES
+    assert login.is_valid_password(passwd)
+    assert len(logins.REHASHES) == 1
+    # The login request itself doesn't change the hash.
+    assert hashing.hash_rounds(login.password) == 4
+
+    assert logins.Logins.flush_rehashes() == 1
+    dbsession.connect().expire(login)
+    assert hashing.hash_rounds(login.password) == 5
+    assert login.is_valid_password(passwd)
+    assert not logins.REHASHES
+
+def test_password_history(dbsession, monkeypatch):
+    """
+    Recent passwords can't be reused, history is kept to PASSWORD_HISTORY_DEPTH.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    monkeypatch.setattr(logins, 'PASSWORD_HISTORY_DEPTH', 3)
+    passwords = ['0d1c2b3a-4f5e-4d6c-8b7a-9f8e7d6c5b4a', '1e2d3c4b-5a6f-4e7d-9c8b-0a9f8e7d6c5b',
+                 '2f3e4d5c-6b7a-4f8e-8d9c-1b0a9f8e7d6c', '3a4f5e6d-7c8b-4a9f-9e0d-2c1b0a9f8e7d']
+    login = logins.Logins(password=passwords[0])
+    login.profile = profiles.Profiles(full_name='4b5a6f7e 8d9c0b1a2f3e', email='4b5a@46f7.e8d9')
+    assert login.password_history == []
+
+    login.password = passwords[1]
+    with pytest.raises(ValueError):
+        login.password = passwords[1]
+    with pytest.raises(ValueError):
+        login.password = passwords[0]
+
+    login.password = passwords[2]
+    login.save()
+    dbsession.commit()
+    assert len(login.password_history) == 2
+
+    # passwords[0] drops out of the history.
+    login.password = passwords[3]
+    dbsession.commit()
+    assert len(login.password_history) == 2
+    login.password = passwords[0]
+    assert login.is_valid_password(passwords[0])
+
+def test_authenticate(testdata, tmpdir, monkeypatch):  # pylint: disable=redefined-outer-name
+    """
+    Throttled logins are rejected before the password is checked.
+    :param list(str) testdata: pytest fixture listing Logins emails
+    """
+    counters = throttle.SlidingWindowCounters(str(tmpdir.join('throttle')), slots=64)
+    monkeypatch.setattr(throttle, '_COUNTERS', counters)
+    monkeypatch.setattr(throttle, 'LOGIN_EMAIL_LIMIT', 2)
+    email = testdata[0]
+
+    assert logins.Logins.authenticate(email, '0c37f17b-4f89-4dce-a453-887b5acb9848').email == email
+    assert logins.Logins.authenticate(email, 'wrong password', '10.1.2.3') is None
+    assert logins.Logins.authenticate('f0e1@d2c3.b4a5', 'wrong password', '10.1.2.3') is None
+    assert logins.Logins.authenticate(email, 'wrong password', '10.1.2.3') is None
+
+    def _no_bcrypt(*args):
+        raise AssertionError('bcrypt should not run')
+    monkeypatch.setattr(hashing.HASHER, 'verify', _no_bcrypt)
+    with pytest.raises(throttle.ThrottledError):
+        logins.Logins.authenticate(email, '0c37f17b-4f89-4dce-a453-887b5acb9848')
+    counters.close()
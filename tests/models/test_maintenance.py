@@ -0,0 +1,313 @@
+"""
+Tests for the database maintenance jobs
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import datetime
+import re
+import warnings
+
+import pytest
+import sqlalchemy as sa
+
+from models import authentication_tokens as autht
+from models import forgot_password_tokens as fpt
+from models import bases, db, groups, logins, maintenance, memberships, profiles, tenancy
+
+
+warnings.simplefilter("error")  # Make All warnings errors while testing.
+
+class Invoices(bases.BaseModel, tenancy.TenantScoped):
+    """ Versioned tenant scoped model for testing tenant moves. """
+    number = sa.Column(sa.Integer, nullable=False)
+
+    __versioned__ = {}
+
+
+def test_sweep_expired(dbsession):
+    """
+    Expired tokens are deleted in batches, unexpired tokens are kept.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    profile = profiles.Profiles(full_name='0b8ad52e 97d1a4d43b41', email='5b1e@4d05.9a3e')
+    login = logins.Logins(password='2e1c5cb0-2a53-4d0a-9f35-07c5fd0d7ac0', profile=profile)
+    expired_dt = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+    expired = [autht.AuthenticationTokens(login=login, expiration_dt=expired_dt)
+               for _ in range(5)]
+    valid = autht.AuthenticationTokens(login=login)
+    for token in expired + [valid]:
+        token.save()
+    dbsession.commit()
+    valid_token = valid.token
+
+    stats = maintenance.sweep_expired(autht.AuthenticationTokens, batch_size=2, pause=0)
+    assert stats['rows'] == 5
+    assert stats['rows_per_sec'] > 0
+
+    remaining = autht.AuthenticationTokens.get_all({'login_id': login.id})
+    assert [token.token for token in remaining] == [valid_token]
+
+    # Nothing left to sweep.
+    assert maintenance.sweep_expired(autht.AuthenticationTokens, pause=0)['rows'] == 0
+
+def test_sweep_expired_tokens(dbsession):
+    """
+    Both token tables are swept and the session is closed afterwards.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    profile = profiles.Profiles(full_name='8e0c5d32 0f3c3e0a7d8b', email='c3d1@4b8e.8f0d')
+    login = logins.Logins(password='c2b7d6e4-9c1f-4b5e-8f0a-5d3e2c1b0a9f', profile=profile)
+    expired_dt = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    fpt.ForgotPasswordTokens(login=login, expiration_dt=expired_dt).save()
+    dbsession.commit()
+
+    stats = maintenance.sweep_expired_tokens(pause=0)
+    assert stats['forgot_password_tokens']['rows'] == 1
+    assert 'authentication_tokens' in stats
+
+def test_token_indexes(createdb):
+    """
+    The expiration indexes are created when missing, and only once.
+    :param models.db createdb: pytest fixture for database module
+    """
+    with createdb.ENGINE.begin() as connection:
+        connection.execute('DROP INDEX ix_forgot_password_tokens_expiration_dt')
+    assert maintenance.create_token_indexes() == ['ix_forgot_password_tokens_expiration_dt']
+    assert maintenance.create_token_indexes() == []
+
+def test_history_indexes(createdb):
+    """
+    The history indexes are created when missing, and replace continuum's transaction_id index.
+    :param models.db createdb: pytest fixture for database module
+    """
+    with createdb.ENGINE.begin() as connection:
+        connection.execute('DROP INDEX ix_profiles_version_transaction_id_id')
+        connection.execute('DROP INDEX ix_transaction_issued_at')
+        connection.execute('CREATE INDEX ix_profiles_version_transaction_id '
+                           'ON profiles_version (transaction_id)')
+    assert maintenance.create_history_indexes() == ['ix_profiles_version_transaction_id_id',
+                                                    'ix_transaction_issued_at']
+    assert maintenance.create_history_indexes() == []
+    with createdb.ENGINE.connect() as connection:
+        assert connection.scalar("SELECT to_regclass('ix_profiles_version_transaction_id')") is None
+
+def test_sync_indexes(createdb):
+    """
+    The (modified_at, id) indexes are created when missing, and only once.
+    :param models.db createdb: pytest fixture for database module
+    """
+    with createdb.ENGINE.begin() as connection:
+        connection.execute('DROP INDEX ix_groups_modified_at_id')
+    assert maintenance.create_sync_indexes() == ['ix_groups_modified_at_id']
+    assert maintenance.create_sync_indexes() == []
+
+def test_version_counters(createdb):
+    """
+    The version_id columns are added when missing, and only once, existing rows start at 1.
+    :param models.db createdb: pytest fixture for database module
+    """
+    group = groups.Groups(name='0f1e2d3c-4b5a-4968-8776-a5b4c3d2e1f0')
+    group.save()
+    createdb.commit()
+    group_id = group.id
+    createdb.close()
+    with createdb.ENGINE.begin() as connection:
+        connection.execute('ALTER TABLE groups DROP COLUMN version_id')
+        connection.execute('ALTER TABLE groups_version DROP COLUMN version_id')
+    assert maintenance.install_version_counters() == ['groups', 'groups_version']
+    assert maintenance.install_version_counters() == []
+    assert groups.Groups.get_by_pk(group_id).version_id == 1
+    createdb.close()
+
+def test_membership_indexes(createdb):
+    """
+    Duplicate Memberships are removed before the memberships indexes are created.
+    :param models.db createdb: pytest fixture for database module
+    """
+    group = groups.Groups(name='7c8d9e0f-1a2b-4c3d-8e4f-5a6b7c8d9e0f')
+    profile = profiles.Profiles(full_name='7c8d9e0f 1a2b3c4d5e6f', email='7c8d@9e0f.1a2b')
+    memberships.Memberships(group=group, profile=profile).save()
+    createdb.commit()
+    with createdb.ENGINE.begin() as connection:
+        connection.execute('DROP INDEX ix_memberships_group_id_profile_id')
+        connection.execute('DROP INDEX ix_memberships_profile_id_group_id')
+        connection.execute(f'INSERT INTO memberships (group_id, profile_id, modified_at) '
+                           f'VALUES ({group.id}, {profile.id}, now())')
+    assert maintenance.create_membership_indexes() == ['ix_memberships_group_id_profile_id',
+                                                       'ix_memberships_profile_id_group_id']
+    assert maintenance.create_membership_indexes() == []
+    assert len(memberships.Memberships.get_all({'group_id': group.id})) == 1
+    createdb.close()
+
+def test_member_counts(createdb):
+    """
+    Installing the member counts is repeatable, and reconciling fixes counts that drifted.
+    :param models.db createdb: pytest fixture for database module
+    """
+    group = groups.Groups(name='4e5f6a7b-8c9d-4e0f-9a1b-2c3d4e5f6a7b')
+    empty = groups.Groups(name='b7a6f5e4-d3c2-4b1a-8f9e-8d7c6b5a4f3e')
+    for idx in range(3):
+        profile = profiles.Profiles(full_name=f'4e5f6a7b {idx:012}', email=f'{idx}@4e5f.6a7b')
+        memberships.Memberships(group=group, profile=profile).save()
+    empty.save()
+    createdb.commit()
+    group_id, empty_id = group.id, empty.id
+    createdb.close()
+
+    assert maintenance.install_member_counts() is False
+    with createdb.ENGINE.begin() as connection:
+        connection.execute('ALTER TABLE memberships DISABLE TRIGGER USER')
+        connection.execute(f'DELETE FROM memberships WHERE group_id = {group_id} '
+                           f'AND id = (SELECT min(id) FROM memberships WHERE group_id = {group_id})')
+        connection.execute(f'UPDATE groups SET member_count = 7 WHERE id = {empty_id}')
+        connection.execute('ALTER TABLE memberships ENABLE TRIGGER USER')
+
+    stats = maintenance.reconcile_member_counts(batch_size=1, pause=0)
+    assert stats['groups'] >= 2 and stats['fixed'] == 2
+    assert groups.Groups.get_by_pk(group_id).member_count == 2
+    assert groups.Groups.get_by_pk(empty_id).member_count == 0
+    assert maintenance.reconcile_member_counts(pause=0)['fixed'] == 0
+    createdb.close()
+
+def test_benchmark_memberships(dbsession):
+    """
+    Membership benchmark reports throughput and latency, and cleans up.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    stats = maintenance.benchmark_memberships(rows=50, group_count=5, queries=5, batch_size=7)
+    assert stats['rows'] == 50
+    assert stats['add_rows_per_sec'] > 0 and stats['remove_rows_per_sec'] > 0
+    assert stats['group_members_p95_ms'] >= stats['group_members_p50_ms'] > 0
+    assert stats['profile_groups_p95_ms'] >= stats['profile_groups_p50_ms'] > 0
+    assert dbsession.query(profiles.Profiles)\
+        .filter(profiles.Profiles.email.like('%@membership-bench.invalid')).count() == 0
+
+def test_benchmark_tenants(createdb):
+    """
+    Tenant benchmark reports the latency for each tenant count, and drops its table.
+    :param models.db createdb: pytest fixture for database module
+    """
+    results = maintenance.benchmark_tenants(tenant_counts=(2, 4), rows_per_tenant=3, queries=5)
+    assert [(stats['tenants'], stats['rows']) for stats in results] == [(2, 6), (4, 12)]
+    for stats in results:
+        assert stats['list_p95_ms'] >= stats['list_p50_ms'] > 0
+        assert stats['lookup_p95_ms'] >= stats['lookup_p50_ms'] > 0
+    assert not createdb.ENGINE.has_table('tenant_bench')
+
+def test_email_indexes(dbsession):
+    """
+    The lower(email) indexes are created when missing and used by get_by_email.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    profile = profiles.Profiles(full_name='6d7e8f9a 0b1c2d3e4f5a', email='6D7e@8F9a.0b1c')
+    logins.Logins(password='6d7e8f9a-0b1c-4d3e-8f5a-6b7c8d9e0f1a', profile=profile).save()
+    dbsession.commit()
+    assert maintenance.email_case_conflicts() == []
+    assert profiles.Profiles.get_by_email('6d7e@8f9a.0b1c') is profile
+    assert logins.Logins.get_by_email('6D7E@8F9A.0B1C') is profile.login
+    dbsession.close()
+
+    with dbsession.ENGINE.begin() as connection:
+        connection.execute('DROP INDEX ix_logins_email_lower')
+    assert maintenance.create_email_indexes() == ['ix_logins_email_lower']
+    assert maintenance.create_email_indexes() == []
+
+    for model in maintenance.EMAIL_MODELS:
+        plan = '\n'.join(maintenance.explain_email_lookup(model, '6d7e@8f9a.0b1c', seqscan=False))
+        assert re.search(f'Index Scan (using|on) ix_{model.__tablename__}_email_', plan)
+        assert 'Index Cond: (lower((email)::text)' in plan
+
+def test_search_indexes(dbsession):
+    """
+    Trigram indexes are created once, and used for substring searches.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    with dbsession.ENGINE.connect() as connection:
+        available = profiles.has_trigram(connection)
+    if not available:
+        assert maintenance.create_search_indexes() == []
+        pytest.skip('pg_trgm is not available in this PostgreSQL.')
+
+    with dbsession.ENGINE.begin() as connection:
+        for name, _ in profiles.TRIGRAM_INDEXES:
+            connection.execute(f'DROP INDEX IF EXISTS {name}')
+    names = [name for name, _ in profiles.TRIGRAM_INDEXES]
+    assert maintenance.create_search_indexes() == names
+    assert maintenance.create_search_indexes() == []
+
+    with dbsession.ENGINE.begin() as connection:
+        connection.execute('SET LOCAL enable_seqscan = off')
+        plan = '\n'.join(row[0] for row in connection.execute(
+            "EXPLAIN SELECT id FROM profiles WHERE lower(full_name) LIKE '%abc%'"))
+    assert 'ix_profiles_full_name_trgm' in plan
+
+def test_benchmark_profile_search(dbsession):
+    """
+    Search benchmark reports latency and cleans up the generated Profiles.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    stats = maintenance.benchmark_profile_search(rows=50, queries=10, target_ms=10000, batch_size=20)
+    assert stats['ok'] is True
+    assert stats['trigram'] in (True, False)
+    assert stats['prefix_p95_ms'] >= stats['prefix_p50_ms'] > 0
+    assert stats['substring_p95_ms'] >= stats['substring_p50_ms'] > 0
+    assert dbsession.query(profiles.Profiles)\
+        .filter(profiles.Profiles.email.like('%@bench.invalid')).count() == 0
+
+def test_drop_password_fingerprints(createdb):
+    """
+    The old password fingerprint column is dropped when it exists.
+    :param models.db createdb: pytest fixture for database module
+    """
+    assert maintenance.drop_password_fingerprints() is False
+    createdb.ENGINE.execute('ALTER TABLE logins ADD COLUMN _password_fingerprint bytea')
+    assert maintenance.drop_password_fingerprints() is True
+    assert maintenance.drop_password_fingerprints() is False
+
+def test_move_tenant(dbsession, tmpdir, monkeypatch):
+    """
+    A tenant's rows and versions are copied to the new shard in batches, then purged from the old.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    engine = sa.create_engine(f'sqlite:///{tmpdir}/shard.db')
+    bases.Base.metadata.create_all(engine, tables=maintenance.tenant_tables())
+    monkeypatch.setitem(db.SHARDS, 'sqlite', engine)
+    monkeypatch.setattr(db, 'TENANT_SHARDS', {})
+    for tenant_id in (71, 72):
+        tenancy.set_tenant(tenant_id)
+        invoices = [Invoices(number=-1) for _ in range(5)]
+        for invoice in invoices:
+            invoice.save()
+        dbsession.commit()
+        for number, invoice in enumerate(invoices):
+            invoice.number = number
+        dbsession.commit()
+    dbsession.close()
+
+    stats = maintenance.move_tenant(71, 'sqlite', batch_size=1, pause=0)
+    assert stats['rows']['invoices'] == 5 and stats['rows']['invoices_version'] == 10
+    assert db.shard_for(71) == 'sqlite'
+    assert engine.scalar('SELECT count(*) FROM invoices') == 5
+    assert engine.scalar('SELECT count(*) FROM invoices_version') == 10
+    assert db.ENGINE.scalar('SELECT count(*) FROM invoices WHERE tenant_id = 71') == 5
+
+    with pytest.raises(ValueError):
+        maintenance.purge_tenant(71, 'sqlite')
+    deleted = maintenance.purge_tenant(71, db.DEFAULT_SHARD, batch_size=2, pause=0)
+    assert deleted['invoices'] == 5 and deleted['invoices_version'] == 10
+    assert db.ENGINE.scalar('SELECT count(*) FROM invoices WHERE tenant_id = 71') == 0
+    assert db.ENGINE.scalar('SELECT count(*) FROM invoices WHERE tenant_id = 72') == 5
+
+    tenancy.set_tenant(71)
+    assert [invoice.number for invoice in Invoices.get_all()] == list(range(5))
+    assert maintenance.move_tenant(71, 'sqlite')['rows'] == {}
+
+    stats = maintenance.move_tenant(71, db.DEFAULT_SHARD, batch_size=2, pause=0)
+    assert stats['rows']['invoices'] == 5 and db.TENANT_SHARDS == {}
+    Invoices(number=5).save()
+    dbsession.commit()
@@ -63,3 +63,51 @@ def test_required_fields(dbsession):
     membership = memberships.Memberships(group=group, profile=profile)
     membership.save()
     dbsession.commit()
+
+def test_unique(dbsession):
+    """
+    A Profile can't have two Memberships in the same Group.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    group = groups.Groups(name='5a6b7c8d-9e0f-4a1b-8c2d-3e4f5a6b7c8d')
+    profile = profiles.Profiles(full_name='5a6b7c8d 9e0f1a2b3c4d', email='5a6b@7c8d.9e0f')
+    memberships.Memberships(group=group, profile=profile).save()
+    memberships.Memberships(group=group, profile=profile).save()
+
+    with pytest.raises(IntegrityError):
+        dbsession.commit()
+
+def test_bulk(dbsession):
+    """
+    Bulk adds skip existing Memberships, bulk removes ignore missing ones.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    group1 = groups.Groups(name='6b7c8d9e one')
+    group2 = groups.Groups(name='6b7c8d9e two')
+    people = [profiles.Profiles(full_name=f'6b7c8d9e {idx}', email=f'{idx}@6b7c.8d9e')
+              for idx in range(3)]
+    for model in [group1, group2] + people:
+        model.save()
+    dbsession.flush()
+    pairs = [(group.id, person.id) for group in (group1, group2) for person in people]
+
+    assert memberships.Memberships.add_many(pairs[:4], batch_size=3) == 4
+    assert memberships.Memberships.add_many(pairs + pairs[:1], batch_size=3) == 2
+    dbsession.commit()
+    assert len(memberships.Memberships.get_all({'group_id': group2.id})) == 3
+    assert memberships.changed_profiles(dbsession.connect()) == set()
+    added = [membership.id for membership in memberships.Memberships.get_all()
+             if (membership.group_id, membership.profile_id) in pairs]
+    assert sorted(version.id for version in memberships.Memberships.history()
+                  if version.id in added) == sorted(added)
+
+    assert memberships.Memberships.remove_many([pairs[0], pairs[5], (group1.id, 0)],
+                                               batch_size=2) == 2
+    assert memberships.changed_profiles(dbsession.connect()) == {people[0].id, people[2].id, 0}
+    dbsession.commit()
+    deleted = memberships.Memberships.deleted_since((0, None))
+    assert sorted((version.group_id, version.profile_id) for version in deleted
+                  if version.id in added) == sorted([pairs[0], pairs[5]])
+    assert sorted(membership.profile_id for membership in memberships.Memberships.get_all()
+                  if membership.group_id in (group1.id, group2.id)) == \
+        sorted([people[1].id, people[2].id, people[0].id, people[1].id])
@@ -0,0 +1,89 @@
+"""
+Tests for the role based access control resolution
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import warnings
+
+import pytest
+
+from models import groups, memberships, permissions, profiles
+
+
+warnings.simplefilter("error")  # Make All warnings errors while testing.
+
+@pytest.fixture
+def cache(monkeypatch):
+    """
+    Empty process cache for a test.
+    :param monkeypatch: pytest fixture for patching the module
+    :return permissions.PermissionCache: Cache used by the permissions module
+    """
+    new_cache = permissions.PermissionCache(size=2, ttl=60)
+    monkeypatch.setattr(permissions, 'CACHE', new_cache)
+    return new_cache
+
+def test_group_set():
+    """ Group sets are sorted, unique and check many ids at once. """
+    group_set = permissions.GroupSet([9, 3, 3, 27])
+    assert list(group_set) == [3, 9, 27]
+    assert len(group_set) == 3
+    assert 9 in group_set and 4 not in group_set and 30 not in group_set
+    assert group_set.check_many([27, 1, 3]) == [True, False, True]
+    assert group_set == permissions.GroupSet([27, 9, 3])
+    assert not permissions.GroupSet()
+
+def test_permission_cache():
+    """ Entries expire, the least recently used are evicted, stale loads aren't stored. """
+    cache = permissions.PermissionCache(size=2, ttl=10)
+    cache.put({1: permissions.GroupSet([1]), 2: permissions.GroupSet([2])}, 0, now=100)
+    assert cache.get(1, now=105) == permissions.GroupSet([1])
+    cache.put({3: permissions.GroupSet([3])}, 0, now=105)
+    assert cache.get(2, now=105) is None
+    assert cache.get(1, now=111) is None
+
+    generation = cache.generation
+    cache.invalidate([3])
+    cache.put({4: permissions.GroupSet([4])}, generation, now=105)
+    assert cache.get(4, now=105) is None
+    assert cache.stats() == {'size': 2, 'entries': 1, 'hits': 1, 'misses': 3}
+
+def test_resolution(dbsession, cache):  # pylint: disable=redefined-outer-name
+    """
+    Group sets are loaded once, cached, and invalidated when Memberships change.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    :param permissions.PermissionCache cache: pytest fixture for an empty process cache
+    """
+    profile = profiles.Profiles(full_name='3e4f5a6b 7c8d9e0f1a2b', email='3e4f@5a6b.7c8d')
+    loner = profiles.Profiles(full_name='4f5a6b7c 8d9e0f1a2b3c', email='4f5a@6b7c.8d9e')
+    group1, group2 = groups.Groups(name='3e4f5a6b one'), groups.Groups(name='3e4f5a6b two')
+    membership = memberships.Memberships(profile=profile, group=group1)
+    for model in (profile, loner, group1, group2, membership):
+        model.save()
+    dbsession.commit()
+
+    assert permissions.group_sets([profile.id, loner.id]) == {
+        profile.id: permissions.GroupSet([group1.id]), loner.id: permissions.GroupSet()}
+    assert permissions.is_member(profile.id, group1.id)
+    assert permissions.check_many(profile.id, [group2.id, group1.id]) == [False, True]
+    assert cache.stats()['misses'] == 2
+    dbsession.commit()
+    assert permissions.is_member(profile.id, group1.id)
+    assert cache.stats()['hits'] == 1
+
+    # Uncommitted changes are seen by the session making them.
+    memberships.Memberships(profile=profile, group=group2).save(flush=True)
+    assert permissions.check_many(profile.id, [group1.id, group2.id]) == [True, True]
+    dbsession.rollback()
+    assert permissions.check_many(profile.id, [group1.id, group2.id]) == [True, False]
+
+    memberships.Memberships(profile=profile, group=group2).save()
+    membership.delete()
+    dbsession.commit()
+    assert cache.get(profile.id) is None
+    assert permissions.check_many(profile.id, [group1.id, group2.id]) == [False, True]
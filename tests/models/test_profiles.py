@@ -174,3 +174,30 @@ def test_memberships_relation(dbsession):
     assert len(profile.memberships) == 2
     assert membership1 in profile.memberships
     assert membership2 in profile.memberships
+
+def test_search(dbsession):  # pylint: disable=unused-argument
+    """
+    Search matches names and emails ignoring case, ranked and limited.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    data = (('Zq7x Marlowe', 'a1b2@zq7x.test'), ('Ann Zq7xander', 'c3d4@e5f6.test'),
+            ('Zq7x', 'g7h8@i9j0.test'), ('Bob Smith', 'zq7x@k1l2.test'),
+            ('Carol 100%_Zq7x', 'm3n4@o5p6.test'))
+    found = {}
+    for full_name, email in data:
+        found[full_name] = profiles.Profiles(full_name=full_name, email=email)
+        found[full_name].save()
+    dbsession.flush()
+
+    results = profiles.Profiles.search(' ZQ7X ')
+    assert [profile.full_name for profile in results] == \
+        ['Zq7x', 'Zq7x Marlowe', 'Bob Smith', 'Ann Zq7xander', 'Carol 100%_Zq7x']
+    assert len(profiles.Profiles.search('zq7x', limit=2)) == 2
+
+    # Short terms only match prefixes, wildcards are literal.
+    assert [profile.full_name for profile in profiles.Profiles.search('zq')] == \
+        ['Zq7x', 'Zq7x Marlowe', 'Bob Smith']
+    assert [profile.full_name for profile in profiles.Profiles.search('0%_z')] == \
+        ['Carol 100%_Zq7x']
+    assert profiles.Profiles.search('%_%') == []
+    assert profiles.Profiles.search('  ') == []
@@ -0,0 +1,183 @@
+"""
+Tests for tenant scoped models.
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import io
+import json
+import uuid
+import warnings
+
+import pytest
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+from werkzeug.exceptions import NotFound
+
+import api
+import ourapi
+from ourapi import export
+import ourmarshmallow
+from models import bases, tenancy
+
+
+warnings.simplefilter("error")  # Make All warnings errors while testing.
+
+class Projects(bases.BaseModel, tenancy.TenantScoped):
+    """ Tenant scoped model for testing. """
+    name = sa.Column(sa.String(50), nullable=False, index=True)
+    code = sa.Column(sa.String(10), nullable=False, unique=True)
+
+    tasks = saorm.relationship('Tasks', back_populates='project')
+
+
+class Tasks(bases.BaseModel, tenancy.TenantScoped):
+    """ Tenant scoped model related to Projects for testing. """
+    project_id = sa.Column(sa.Integer, sa.ForeignKey('projects.id'), nullable=False)
+
+    project = saorm.relationship('Projects', back_populates='tasks')
+
+
+class ProjectsSchema(ourmarshmallow.Schema):
+    """ JSONAPI Schema for Projects. """
+    class Meta:  # pylint: disable=missing-docstring,too-few-public-methods
+        model = Projects
+        exclude = ('tasks',)
+        listable = True
+
+
+class ProjectsResource(ourapi.JsonApiResource):
+    """ JSONAPI CRUD endpoints for Projects. """
+    schema = ProjectsSchema
+
+
+def _projects(dbsession, tenant_id, other_id):
+    """
+    Two Projects in a tenant, one with the same name and code in another.
+    :param models.db dbsession: database module
+    :param int tenant_id: Tenant of the first two Projects
+    :param int other_id: Tenant of the last Project
+    :return list(Projects): Projects created
+    """
+    code = uuid.uuid4().hex[:10]
+    created = [Projects(name='alpha', code=code, tenant_id=tenant_id),
+               Projects(name='beta', code=code[::-1], tenant_id=tenant_id),
+               Projects(name='alpha', code=code, tenant_id=other_id)]
+    for project in created:
+        project.save()
+    dbsession.commit()
+    return created
+
+def test_tenant_indexes():
+    """ Every index starts with tenant_id, unique columns are unique per tenant. """
+    table = Projects.__table__
+    indexes = {index.name: [column.name for column in index.columns] for index in table.indexes}
+    assert indexes == {'ix_projects_name': ['tenant_id', 'name'],
+                       'ix_projects_modified_at_id': ['tenant_id', 'modified_at', 'id'],
+                       'ix_projects_tenant_id_id': ['tenant_id', 'id']}
+    assert [[column.name for column in constraint.columns] for constraint in table.constraints
+            if isinstance(constraint, sa.UniqueConstraint)] == [['tenant_id', 'code']]
+
+def test_scoped_queries(dbsession):
+    """
+    A session with a tenant only sees that tenant's models, one without sees them all.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    alpha, beta, other = _projects(dbsession, 11, 12)
+    assert len(Projects.get_all({'tenant_id': [11, 12]})) == 3
+
+    tenancy.set_tenant(11)
+    assert tenancy.current_tenant() == 11
+    assert Projects.get_all() == [alpha, beta]
+    assert Projects.get_all({'name': 'alpha'}) == [alpha]
+    assert Projects.get_by_pk(other.id) is None
+    assert dbsession.query(Projects).count() == 2
+
+    tenancy.set_tenant(None)
+    assert Projects.get_by_pk(other.id) is other
+
+def test_relationship_loads(dbsession):
+    """
+    Lazy loads of TenantScoped models aren't cached with the first tenant.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    code = uuid.uuid4().hex[:10]
+    for tenant_id in (21, 22):
+        tenancy.set_tenant(tenant_id)
+        project = Projects(name='gamma', code=code)
+        Tasks(project=project).save()
+        dbsession.commit()
+        project_id = project.id
+        dbsession.close()
+
+        tenancy.set_tenant(tenant_id)
+        task = Tasks.get_all()[0]
+        assert task.project.id == project_id
+        assert [each.tenant_id for each in task.project.tasks] == [tenant_id]
+        dbsession.close()
+
+def test_assign_tenant(dbsession):
+    """
+    New models join the session's tenant, and can't be written to another tenant.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    _, _, other = _projects(dbsession, 31, 32)
+    tenancy.set_tenant(32)
+    project = Projects(name='delta', code=uuid.uuid4().hex[:10])
+    project.save(flush=True)
+    assert project.tenant_id == 32
+
+    project.tenant_id = 31
+    with pytest.raises(ValueError):
+        dbsession.flush()
+    dbsession.rollback()
+
+    tenancy.set_tenant(None)
+    other = Projects.get_by_pk(other.id)
+    tenancy.set_tenant(31)
+    other.name = 'moved'
+    with pytest.raises(ValueError):
+        dbsession.flush()
+    dbsession.rollback()
+
+def test_scoped_resource(dbsession):
+    """
+    The ourapi endpoints only read the session tenant's models, tenant_id isn't an attribute.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    alpha, beta, other = _projects(dbsession, 41, 42)
+    other_id = other.id
+    tenancy.set_tenant(41)
+    resource = ProjectsResource()
+    response = resource.get()
+    assert [data['attributes'] for data in response['data']] == \
+        [{'name': 'alpha', 'code': alpha.code}, {'name': 'beta', 'code': beta.code}]
+    assert resource.get(alpha.id)['data']['id'] == str(alpha.id)
+    with pytest.raises(NotFound):
+        resource.get(other_id)
+
+    out = io.StringIO()
+    assert export.export(ProjectsSchema, out)['rows'] == 2
+    assert [json.loads(line)['id'] for line in out.getvalue().splitlines()] == \
+        [str(project.id) for project in Projects.get_all()]
+
+def test_scoped_export_endpoint(dbsession):
+    """
+    The export endpoint streams after the request's session is gone, still only the tenant's rows.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    alpha, beta, _ = _projects(dbsession, 43, 44)
+    expected = [str(alpha.id), str(beta.id)]
+    dbsession.close()
+    app = api.create_api()
+    app.before_request(lambda: tenancy.set_tenant(43))
+    app.add_url_rule('/projects/export', 'projects_export',
+                     view_func=export.export_view(ProjectsSchema))
+
+    response = app.test_client().get('/projects/export')
+    assert [json.loads(line)['id'] for line in response.get_data(as_text=True).splitlines()] == \
+        expected
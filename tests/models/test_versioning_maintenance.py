@@ -0,0 +1,127 @@
+"""
+Tests for the version history maintenance jobs
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import datetime
+import warnings
+
+import pytest
+import sqlalchemy as sa
+
+from models import bases, profiles, version_archives, versioning_maintenance
+
+
+warnings.simplefilter("error")  # Make All warnings errors while testing.
+
+class Drafts(bases.BaseModel):
+    """ Versioned model keeping its 2 newest versions, for testing version pruning. """
+    text = sa.Column(sa.String(20), nullable=False)
+
+    __versioned__ = {'retention': {'versions': 2}}
+
+
+def test_native_versioning(dbsession):
+    """
+    The versioning triggers are installed on every versioned table, when hstore is available.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    with dbsession.ENGINE.connect() as connection:
+        available = versioning_maintenance.has_hstore(connection)
+    if not available:
+        assert versioning_maintenance.install_native_versioning() == []
+        pytest.skip('hstore is not available in this PostgreSQL.')
+
+    tables = versioning_maintenance.install_native_versioning()
+    try:
+        assert 'profiles' in tables and 'authentication_tokens' not in tables
+        with dbsession.ENGINE.connect() as connection:
+            assert connection.scalar("SELECT count(*) FROM pg_trigger "
+                                     "WHERE tgname = 'profiles_trigger'") == 1
+    finally:
+        # The sessions in these tests still write the versions themselves.
+        with dbsession.ENGINE.begin() as connection:
+            for table in tables:
+                connection.execute(f'DROP TRIGGER IF EXISTS {table}_trigger ON {table}')
+
+def test_benchmark_token_issuance(dbsession):
+    """
+    Token benchmark reports both issuance rates, and deletes its tokens and their versions.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    with dbsession.ENGINE.connect() as connection:
+        transactions = connection.scalar('SELECT count(*) FROM transaction')
+    stats = versioning_maintenance.benchmark_token_issuance(rows=30, batch_size=10)
+    assert stats['rows'] == 30 and stats['native_versioning'] is False
+    assert stats['unversioned_rows_per_sec'] > 0 and stats['versioned_rows_per_sec'] > 0
+    assert stats['versioning_overhead'] > 0
+    assert dbsession.query(profiles.Profiles)\
+        .filter(profiles.Profiles.email.like('%@token-bench.invalid')).count() == 0
+    with dbsession.ENGINE.connect() as connection:
+        assert connection.scalar('SELECT count(*) FROM transaction') == transactions
+
+def test_version_retention(monkeypatch):
+    """
+    Models without a retention of their own use the default, unset keeps all history.
+    :param monkeypatch: pytest fixture for patching
+    """
+    assert versioning_maintenance.version_retention(profiles.Profiles) == {}
+    assert versioning_maintenance.version_retention(Drafts) == {'versions': 2}
+    monkeypatch.setattr(versioning_maintenance, 'VERSION_RETENTION', {'days': 90})
+    assert versioning_maintenance.version_retention(profiles.Profiles) == {'days': 90}
+    assert versioning_maintenance.version_retention(Drafts) == {'days': 90, 'versions': 2}
+
+def _draft_versions(draft):
+    """
+    :param Drafts draft: Draft to check
+    :return list(tuple): text and transaction_id of the draft's versions, oldest first.
+    """
+    return [(version.text, version.transaction_id) for version in draft.versions]
+
+def test_prune_versions(dbsession, monkeypatch):
+    """
+    Versions outside the retention are deleted in batches and archived, the current one is kept.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    :param monkeypatch: pytest fixture for patching
+    """
+    drafts = [Drafts(text='first'), Drafts(text='only')]
+    for draft in drafts:
+        draft.save()
+    dbsession.commit()
+    for idx in range(4):
+        drafts[0].text = f'edit {idx}'
+        dbsession.commit()
+    draft, only = drafts
+    versions = _draft_versions(draft)
+    assert len(versions) == 5
+
+    assert versioning_maintenance.prune_model_versions(Drafts, batch_size=1, pause=0, archive=True) == 3
+    dbsession.connect().expire_all()
+    assert _draft_versions(draft) == versions[3:]
+    assert _draft_versions(only) == [('only', versions[0][1])]
+    archived = dbsession.query(version_archives.VersionArchives)\
+        .filter_by(table_name='drafts', row_id=draft.id).one()
+    assert (archived.versions, archived.first_transaction_id, archived.last_transaction_id) == \
+        (3, versions[0][1], versions[2][1])
+    assert archived.changed_columns == ['text'] and archived.first_issued_at is not None
+
+    pruned = [transaction_id for _, transaction_id in versions[1:3]]
+    assert versioning_maintenance.prune_transactions(batch_size=2, pause=0) >= 2
+    transaction = sa.table('transaction', sa.column('id'))
+    with dbsession.ENGINE.connect() as connection:
+        assert connection.scalar(sa.select([sa.func.count()]).select_from(transaction)
+                                 .where(transaction.c.id.in_(pruned))) == 0
+    assert versions[0][1] in [row[0] for row in dbsession.ENGINE.execute(
+        sa.select([transaction.c.id]).where(transaction.c.id == versions[0][1]))]
+
+    monkeypatch.setitem(Drafts.__versioned__, 'retention', {'days': 1})
+    later = datetime.datetime.utcnow() + datetime.timedelta(days=2)
+    assert versioning_maintenance.prune_model_versions(Drafts, pause=0, now=later) == 1
+    dbsession.connect().expire_all()
+    assert _draft_versions(draft) == versions[4:]
+    assert _draft_versions(only) == [('only', versions[0][1])]
@@ -0,0 +1,128 @@
+"""
+Tests for the streaming export of resources
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import datetime
+import io
+import json
+import warnings
+
+import flask
+import pytest
+import sqlalchemy as sa
+
+from models import bases
+import ourapi
+from ourapi import export
+from ourapi.exceptions import BadRequest
+import ourmarshmallow
+
+
+warnings.simplefilter("error")  # Make All warnings errors while testing.
+
+class Parcels(bases.BaseModel):
+    """ Model for testing exports. """
+    label = sa.Column(sa.String(50), nullable=False)
+    shipped_on = sa.Column(sa.Date)
+
+
+class ParcelsSchema(ourmarshmallow.Schema):
+    """ JSONAPI Schema from SQLAlchemy Parcels Model. """
+    class Meta:  # pylint: disable=missing-docstring,too-few-public-methods
+        model = Parcels
+        listable = True
+
+
+class ParcelsResource(ourapi.JsonApiResource):
+    """ JSONAPI endpoints for ParcelsSchema/Parcels Model. """
+    schema = ParcelsSchema
+
+
+@pytest.fixture(scope='module')
+def testdata(createdb):
+    """
+    Create the necessary test data for this module.
+    :param models.db createdb: pytest fixture for database module
+    """
+    createdb.connect()
+    now = datetime.datetime(2018, 3, 4, 5, 6, 7)
+    for idx, label in enumerate(('a, "quoted" label', 'ünïcödé', 'plain'), 1):
+        shipped_on = datetime.date(2018, 3, idx) if idx != 3 else None
+        createdb.add(Parcels(id=idx, label=label, shipped_on=shipped_on, modified_at=now))
+    createdb.commit()
+    createdb.close()
+
+EXPECTED = [{'id': '1', 'label': 'a, "quoted" label', 'shipped-on': '2018-03-01',
+             'modified-at': '2018-03-04T05:06:07+00:00'},
+            {'id': '2', 'label': 'ünïcödé', 'shipped-on': '2018-03-02',
+             'modified-at': '2018-03-04T05:06:07+00:00'},
+            {'id': '3', 'label': 'plain', 'shipped-on': None,
+             'modified-at': '2018-03-04T05:06:07+00:00'}]
+
+@pytest.mark.parametrize('workers', [0, 1])
+def test_export_ndjson(testdata, workers):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    Every row is exported, in id order, with or without the encoding pool.
+    :param testdata: pytest fixture creating Parcels
+    """
+    out = io.StringIO()
+    stats = export.export(ParcelsSchema, out, chunk_size=2, workers=workers)
+    assert stats['rows'] == 3
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert records == EXPECTED
+    assert list(records[0]) == ['id', 'label', 'shipped-on', 'modified-at']
+
+def test_export_csv(testdata):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    CSV has a header row and quotes as needed.
+    :param testdata: pytest fixture creating Parcels
+    """
+    out = io.StringIO()
+    export.export(ParcelsSchema, out, fmt='csv')
+    assert out.getvalue().splitlines() == [
+        'id,label,shipped-on,modified-at',
+        '1,"a, ""quoted"" label",2018-03-01,2018-03-04T05:06:07+00:00',
+        '2,ünïcödé,2018-03-02,2018-03-04T05:06:07+00:00',
+        '3,plain,,2018-03-04T05:06:07+00:00']
+
+    with pytest.raises(ValueError):
+        export.export(ParcelsSchema, out, fmt='xml')
+
+def test_export_endpoint(testdata):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    Listable resources get an export endpoint.
+    :param testdata: pytest fixture creating Parcels
+    """
+    app = flask.Flask(__name__)
+    ParcelsResource.register(app)
+    client = app.test_client()
+
+    response = client.get('/parcels/export')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.headers['Content-Disposition'] == 'attachment; filename=parcels.ndjson'
+    assert [json.loads(line) for line in response.get_data(as_text=True).splitlines()] == EXPECTED
+
+    response = client.get('/parcels/export?format=csv')
+    assert response.mimetype == 'text/csv'
+    assert len(response.get_data(as_text=True).splitlines()) == 4
+
+    with app.test_request_context('/parcels/export?format=xml'):
+        with pytest.raises(BadRequest):
+            export.export_view(ParcelsSchema)()
+
+def test_benchmark(createdb):
+    """
+    Benchmark exports a generated table and drops it.
+    :param models.db createdb: pytest fixture for database module
+    """
+    stats = export.benchmark(rows=50, fmt='csv', chunk_size=20)
+    assert stats['rows'] == 50
+    assert stats['rows_per_sec'] > 0
+    assert not createdb.ENGINE.has_table('export_bench')
@@ -0,0 +1,159 @@
+"""
+Tests for the version history of resources
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import datetime
+import json
+import warnings
+
+import flask
+import pytest
+import sqlalchemy as sa
+
+from models import authentication_tokens, bases, tenancy
+import ourapi
+from ourapi import history
+from ourapi.exceptions import BadRequest, NotFound
+import ourmarshmallow
+
+
+warnings.simplefilter("error")  # Make All warnings errors while testing.
+
+class Notebooks(bases.BaseModel):
+    """ Versioned model for testing history. """
+    title = sa.Column(sa.String(50), nullable=False)
+
+
+class Pages(bases.BaseModel, tenancy.TenantScoped):
+    """ Versioned tenant scoped model for testing history. """
+    text = sa.Column(sa.String(50), nullable=False)
+
+
+class NotebooksSchema(ourmarshmallow.Schema):
+    """ JSONAPI Schema from SQLAlchemy Notebooks Model. """
+    class Meta:  # pylint: disable=missing-docstring,too-few-public-methods
+        model = Notebooks
+        listable = True
+
+
+class NotebooksResource(ourapi.JsonApiResource):
+    """ JSONAPI endpoints for NotebooksSchema/Notebooks Model. """
+    schema = NotebooksSchema
+
+
+def _notebook(dbsession, edits):
+    """
+    :param models.db dbsession: database module
+    :param int edits: Number of times the title is changed after creating the Notebook.
+    :return Notebooks: Notebook with edits + 1 versions.
+    """
+    notebook = Notebooks(title='draft')
+    notebook.save()
+    dbsession.commit()
+    for idx in range(edits):
+        notebook.title = f'edit {idx}'
+        dbsession.commit()
+    return notebook
+
+def test_history_indexes():
+    """ Version tables are indexed by (transaction_id, id), by tenant first when scoped. """
+    def _indexes(table):
+        return {index.name: [column.name for column in index.columns] for index in table.indexes}
+    sa.orm.configure_mappers()
+    notebooks = _indexes(bases.Base.metadata.tables['notebooks_version'])
+    assert notebooks['ix_notebooks_version_transaction_id_id'] == ['transaction_id', 'id']
+    assert 'ix_notebooks_version_transaction_id' not in notebooks
+    assert _indexes(bases.Base.metadata.tables['pages_version'])[
+        'ix_pages_version_tenant_id_transaction_id'] == ['tenant_id', 'transaction_id', 'id']
+    assert _indexes(bases.Base.metadata.tables['transaction'])['ix_transaction_issued_at'] == \
+        ['issued_at']
+
+def test_history(dbsession):
+    """
+    The versions of a model are read a page at a time, in transaction order, optionally since a
+    time.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    notebook = _notebook(dbsession, 2)
+    since = datetime.datetime.utcnow()
+    notebook.title = 'final'
+    dbsession.commit()
+    notebook.delete()
+    dbsession.commit()
+
+    versions = list(Notebooks.history(notebook.id, page_size=2))
+    assert [(version.title, version.operation_type) for version in versions] == \
+        [('draft', 0), ('edit 0', 1), ('edit 1', 1), ('final', 1), ('final', 2)]
+    assert [version.transaction_id for version in versions] == \
+        sorted(version.transaction_id for version in versions)
+    assert [version.title for version in Notebooks.history(notebook.id, since=since)] == \
+        ['final', 'final']
+    assert Notebooks.history_page(notebook.id, after=(versions[2].transaction_id, notebook.id),
+                                  limit=1) == versions[3:4]
+    assert versions[-1] in list(Notebooks.history(since=since))
+
+def test_tenant_history(dbsession):
+    """
+    A session with a tenant only reads the history of the tenant's models.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    for tenant_id in (51, 52):
+        Pages(text=f'tenant {tenant_id}', tenant_id=tenant_id).save()
+    dbsession.commit()
+    tenancy.set_tenant(51)
+    assert {version.text for version in Pages.history()} == {'tenant 51'}
+    tenancy.set_tenant(None)
+    assert {version.text for version in Pages.history()} >= {'tenant 51', 'tenant 52'}
+
+def test_history_endpoint(dbsession):
+    """
+    Versioned resources get history endpoints, paged by links.next.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    notebook = _notebook(dbsession, 3)
+    app = flask.Flask(__name__)
+    NotebooksResource.register(app)
+    client = app.test_client()
+
+    response = client.get(f'/notebooks/{notebook.id}/history?page[size]=3')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/vnd.api+json'
+    document = json.loads(response.get_data(as_text=True))
+    assert [(data['id'], data['attributes']['title'], data['meta']['operation'])
+            for data in document['data']] == [(str(notebook.id), 'draft', 'insert'),
+                                              (str(notebook.id), 'edit 0', 'update'),
+                                              (str(notebook.id), 'edit 1', 'update')]
+    assert document['data'][0]['type'] == 'notebooks'
+    assert document['data'][0]['meta']['issued-at'].endswith('+00:00')
+
+    document = json.loads(client.get(document['links']['next']).get_data(as_text=True))
+    assert [data['attributes']['title'] for data in document['data']] == ['edit 2']
+    assert document['links']['next'] is None
+
+    response = client.get('/notebooks/history?page[size]=1000&filter[since]=2000-01-01T00:00:00Z')
+    document = json.loads(response.get_data(as_text=True))
+    assert {data['id'] for data in document['data']} >= {str(notebook.id)}
+
+    view = history.history_view(NotebooksSchema)
+    for query in ('page[after]=abc', 'page[size]=0', 'filter[since]=yesterday'):
+        with app.test_request_context(f'/notebooks/{notebook.id}/history?{query}'):
+            with pytest.raises(BadRequest):
+                view(notebook.id)
+    with app.test_request_context('/notebooks/987654321/history'):
+        with pytest.raises(NotFound):
+            view(987654321)
+
+def test_unversioned_schema():
+    """ Only resources of versioned models have a history. """
+    class TokensSchema(ourmarshmallow.Schema):
+        """ Schema of an unversioned model. """
+        class Meta:  # pylint: disable=missing-docstring,too-few-public-methods
+            model = authentication_tokens.AuthenticationTokens
+    assert history.is_versioned(NotebooksSchema)
+    assert not history.is_versioned(TokensSchema)
@@ -101,6 +101,17 @@ def test_read_to_one_relation(dbsession, testdata):  # pylint: disable=unused-ar
                                  'type': 'persons'},
                         'links': {'self': '/persons/20/parent'}}
 
+def test_relation_queries(dbsession, testdata, assert_queries):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    Reading a to one relation loads the model, the related model and the related model's children.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    :param list(str) testdata: pytest fixture listing test data tokens.
+    :param callable assert_queries: pytest fixture asserting the statements run
+    """
+    dbsession.close()
+    with assert_queries(3):
+        ParentRelation().get(20)
+
 def test_read_empty_list_relation(dbsession, testdata):  # pylint: disable=unused-argument,redefined-outer-name
     """
     To Many Relations without a value should return empty list as primary data.
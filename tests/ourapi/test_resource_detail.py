@@ -12,13 +12,14 @@ except ImportError:
 import datetime
 import warnings
 
+import flask
 import marshmallow
 import pytest
 import sqlalchemy as sa
 
-from models import bases
+from models import bases, db
 import ourapi
-from ourapi.exceptions import Conflict, NotFound
+from ourapi.exceptions import Conflict, NotFound, PreconditionFailed
 import ourmarshmallow
 
 
@@ -149,3 +150,76 @@ def test_detail_update_type_mismatch(dbsession):  # pylint: disable=unused-argum
 
     assert excinfo.value.description == {'detail': 'Invalid type. Expected "horses".',
                                          'source': {'pointer': '/data/type'}}
+
+def test_detail_etag(dbsession):
+    """
+    Reads and updates send the version_id as ETag, changes with a stale If-Match fail with 412.
+    :param models.db dbsession: pytest fixture for database module
+    """
+    Horses(id=60, name="Lantern Orbit Velvet").save(flush=True)
+    app = flask.Flask(__name__)
+    HorsesResource.register(app)
+    resource = HorsesResource()
+
+    with app.test_request_context('/horses/60'):
+        resource.get(60)
+        # The connection went back to the pool before the model was dumped.
+        assert db.checked_out() == 0
+        assert app.process_response(flask.make_response('')).headers['ETag'] == '"1"'
+
+    patch_data = {'data': {'attributes': {'name': 'Lantern'}, 'id': '60', 'type': 'horses'}}
+    with app.test_request_context('/horses/60', method='PATCH', headers={'If-Match': '"1"'}):
+        assert resource.patch(60, patch_data)['data']['attributes'] == {'name': 'Lantern'}
+        assert app.process_response(flask.make_response('')).headers['ETag'] == '"2"'
+
+    for method in ('PATCH', 'DELETE'):
+        with app.test_request_context('/horses/60', method=method, headers={'If-Match': '"1"'}):
+            with pytest.raises(PreconditionFailed) as excinfo:
+                resource.patch(60, patch_data) if method == 'PATCH' else resource.delete(60)
+            assert excinfo.value.description == {'detail': '60 was changed since it was read.',
+                                                 'source': {'header': 'If-Match'}}
+
+    with app.test_request_context('/horses/60', method='DELETE', headers={'If-Match': '"2"'}):
+        assert resource.delete(60) == (None, 204)
+
+def test_detail_update_concurrent(dbsession):
+    """
+    An update never overwrites a change committed since the model was read, even without If-Match.
+    :param models.db dbsession: pytest fixture for database module
+    """
+    the_model = Horses(id=70, name="Quiet Harbor")
+    the_model.save()
+    dbsession.commit()
+    assert the_model.version_id == 1
+    with dbsession.ENGINE.begin() as connection:
+        connection.execute("UPDATE horses SET name = 'Concurrent', version_id = 2 WHERE id = 70")
+
+    patch_data = {'data': {'attributes': {'name': 'Lost update'}, 'id': '70', 'type': 'horses'}}
+    with pytest.raises(PreconditionFailed):
+        HorsesResource().patch(70, patch_data)
+    dbsession.rollback()
+    assert Horses.get_by_pk(70).name == 'Concurrent'
+
+def test_detail_read_only(dbsession):
+    """
+    Reads are dispatched in a read only transaction, updates aren't.
+    :param models.db dbsession: pytest fixture for database module
+    """
+    Horses(id=80, name="Amber Meadow").save()
+    dbsession.commit()
+    read_only = []
+
+    class RecordingResource(HorsesResource):
+        """ Records whether the transaction of each request is read only. """
+        def _get_model(self, model_id):
+            read_only.append(db.connect().execute('SHOW transaction_read_only').scalar())
+            return super()._get_model(model_id)
+
+    app = flask.Flask(__name__)
+    with app.test_request_context('/horses/80'):
+        assert RecordingResource().dispatch_request(model_id=80)['data']['id'] == '80'
+    assert dbsession.connect().autoflush
+    patch_data = {'data': {'attributes': {'name': 'Amber'}, 'id': '80', 'type': 'horses'}}
+    with app.test_request_context('/horses/80', method='PATCH'):
+        RecordingResource().dispatch_request(model_id=80, data=patch_data)
+    assert read_only == ['on', 'off']
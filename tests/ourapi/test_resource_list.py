@@ -17,7 +17,7 @@ import sqlalchemy as sa
 
 from models import bases
 import ourapi
-from ourapi.exceptions import Forbidden
+from ourapi.exceptions import BadRequest, Forbidden
 import ourmarshmallow
 
 
@@ -137,3 +137,24 @@ def test_create_id_conflict(dbsession):  # pylint: disable=unused-argument
 
     assert excinfo.value.description == {'detail': '`data` object must not include `id` key.',
                                          'source': {'pointer': '/data/id'}}
+
+def test_list_search(dbsession, testdata, monkeypatch):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    filter[search] lists the results of the model's search.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    :param list(str) testdata: pytest fixture listing test data tokens.
+    """
+    resource = BatteriesResource()
+    test_app = flask.Flask(__name__)
+    with test_app.test_request_context('/batteries?filter[search]=72'):
+        with pytest.raises(BadRequest) as excinfo:
+            resource.get()
+    assert excinfo.value.description == {'detail': 'Search is not supported for this resource.',
+                                         'source': {'parameter': 'filter[search]'}}
+
+    def _search(cls, term):
+        return [battery for battery in cls.get_all() if str(battery.charge).startswith(term)]
+    monkeypatch.setattr(Batteries, 'search', classmethod(_search), raising=False)
+    with test_app.test_request_context('/batteries?filter[search]=72'):
+        response = resource.get()
+    assert [item['id'] for item in response['data']] == ['20']
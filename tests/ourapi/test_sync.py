@@ -0,0 +1,143 @@
+"""
+Tests for the incremental sync of resources
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from builtins import *  # pylint: disable=unused-wildcard-import,redefined-builtin,wildcard-import
+except ImportError:
+    import sys
+    print("WARNING: Cannot Load builtins for py3 compatibility.", file=sys.stderr)
+
+import datetime
+import json
+import warnings
+
+import flask
+import pytest
+import sqlalchemy as sa
+
+from models import bases
+import ourapi
+from ourapi import sync
+from ourapi.exceptions import BadRequest
+import ourmarshmallow
+
+
+warnings.simplefilter("error")  # Make All warnings errors while testing.
+
+class Cards(bases.BaseModel):
+    """ Versioned model for testing syncs. """
+    title = sa.Column(sa.String(50), nullable=False)
+
+
+class CardsSchema(ourmarshmallow.Schema):
+    """ JSONAPI Schema from SQLAlchemy Cards Model. """
+    class Meta:  # pylint: disable=missing-docstring,too-few-public-methods
+        model = Cards
+        listable = True
+
+
+class CardsResource(ourapi.JsonApiResource):
+    """ JSONAPI endpoints for CardsSchema/Cards Model. """
+    schema = CardsSchema
+
+
+@pytest.fixture(autouse=True)
+def no_lag(monkeypatch):
+    """
+    Sync the changes up to now.
+    :param monkeypatch: pytest fixture for patching
+    """
+    monkeypatch.setattr(bases, 'SYNC_LAG', datetime.timedelta(0))
+
+def _sync_all(position, limit):
+    """
+    :param dict or None position: Position to sync from
+    :param int limit: Page size
+    :return tuple(list(str), list(str), dict): Titles changed, ids deleted, position after sync.
+    """
+    titles, deleted = [], []
+    while True:
+        document = sync.sync_page(CardsSchema, position, limit)
+        titles.extend(data['attributes']['title'] for data in document['data'])
+        deleted.extend(identifier['id'] for identifier in document['meta']['deleted'])
+        position = sync.decode_cursor(document['meta']['cursor'])
+        if not document['meta']['more']:
+            return titles, deleted, position
+
+def test_sync(dbsession):
+    """
+    The first sync returns every model, later ones the changes and deletions since.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    cards = []
+    for title in ('one', 'two', 'three'):
+        cards.append(Cards(title=title))
+        cards[-1].save()
+        dbsession.commit()
+
+    titles, deleted, position = _sync_all(None, 2)
+    assert titles == ['one', 'two', 'three'] and deleted == []
+
+    cards[0].title = 'one changed'
+    dbsession.commit()
+    deleted_id = str(cards[1].id)
+    cards[1].delete()
+    dbsession.commit()
+    Cards(title='four').save()
+    dbsession.commit()
+
+    titles, deleted, position = _sync_all(position, 1)
+    assert titles == ['one changed', 'four'] and deleted == [deleted_id]
+    assert _sync_all(position, 1)[:2] == ([], [])
+
+def test_sync_long_transaction(dbsession):
+    """
+    Rows of a transaction open during a sync, which have its earlier start as modified_at, are
+    synced once it commits, along with the changes held back behind it.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    position = _sync_all(None, 10)[2]
+    dbsession.commit()
+    with dbsession.ENGINE.connect() as connection:
+        transaction = connection.begin()
+        connection.execute(Cards.__table__.insert(), title='slow')
+        Cards(title='quick').save()
+        dbsession.commit()
+        assert _sync_all(position, 10)[0] == []
+        transaction.commit()
+    dbsession.commit()
+    assert _sync_all(position, 10)[0] == ['slow', 'quick']
+
+def test_cursor():
+    """ Cursors survive the round trip, anything else is a bad request. """
+    position = {'m': datetime.datetime(2018, 3, 4, 5, 6, 7), 'i': 8, 't': 9, 'd': None}
+    assert sync.decode_cursor(sync.encode_cursor(position)) == position
+    for cursor in ('abc', sync.encode_cursor({'m': None, 'i': None, 't': 1, 'd': 2})[:-4], 'e30='):
+        with pytest.raises(BadRequest):
+            sync.decode_cursor(cursor)
+
+def test_sync_endpoint(dbsession):
+    """
+    Listable versioned resources get a sync endpoint, links.next continues from meta.cursor.
+    :param sqlalchemy.orm.session.Session dbsession: pytest fixture for database session
+    """
+    app = flask.Flask(__name__)
+    CardsResource.register(app)
+    client = app.test_client()
+
+    response = client.get('/cards/sync')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/vnd.api+json'
+    document = json.loads(response.get_data(as_text=True))
+    assert document['data'] and document['data'][0]['type'] == 'cards'
+
+    Cards(title='five').save()
+    dbsession.commit()
+    document = json.loads(client.get(document['links']['next']).get_data(as_text=True))
+    assert [data['attributes']['title'] for data in document['data']] == ['five']
+    assert document['meta']['deleted'] == []
+
+    with app.test_request_context('/cards/sync?filter[cursor]=abc'):
+        with pytest.raises(BadRequest):
+            sync.sync_view(CardsSchema)()